@@ -0,0 +1,205 @@
+"""Офлайн-нагрузочный тест бота: настоящие обработчики fitness_bot, фейковый Telegram Bot API и fake_groq.py вместо Groq.
+
+    python bench_bot.py --users 1000,10000,100000 --output bench.json
+    python bench_bot.py --users 1000 --groq-latency lognormal:0.4,0.5 --groq-error-rate 0.05
+    GROQ_MODELS=gemma2-9b-it,llama-3.1-8b-instant python bench_bot.py --users 1000 --model-latency gemma2-9b-it=lognormal:3,0.5 --model-error-rate llama-3.1-8b-instant=0.2
+
+Для каждого масштаба N:
+  1. onboarding - N пользователей проходят /start и все шаги профиля; во время фазы работает tracemalloc,
+     по нему считается память на пользователя (user_data, состояния диалогов, кэши PTB).
+  2. mixed - --updates апдейтов от случайных пользователей: /addmeal (часть блюд уходит в AI), /todaycalories,
+     /train с выбором места и кнопки меню из general_message_handler. tracemalloc выключен.
+Результат - JSON (updates/sec, p50/p95/p99 по фазам и видам апдейтов), удобный для сравнения между релизами.
+tracemalloc замедляет онбординг в 2-3 раза: полный прогон до 100000 пользователей занимает десятки минут, --no-tracemalloc заметно быстрее.
+"""
+import argparse
+import asyncio
+import gc
+import itertools
+import json
+import logging
+import os
+import platform
+import random
+import sys
+import tempfile
+import time
+import tracemalloc
+from collections import Counter, defaultdict
+from datetime import datetime, timezone
+
+from telegram import Update
+from telegram.request import BaseRequest
+
+from fake_groq import FakeGroqServer, parse_latency, parse_model_options
+
+BOT_USER = {"id": 777000, "is_bot": True, "first_name": "FitGuru", "username": "fitguru_bench_bot"}
+LOCAL_MEALS = ["гречка 200 г, куриная грудка 150 г", "овсянка 60 г и банан", "2 яйца, хлеб 50 г", "творог 200 г", "рис 150 г, огурец"]
+AI_MEALS = ["борщ с пампушками", "шаурма с курицей", "паста карбонара", "плов домашний", "сырники со сметаной", "том ям с креветками"]
+MENU_BUTTONS = ["🗓️ Мои калории (/todaycalories)", "📊 Мой профиль (/myprofile)", "❓ Помощь (/help)"]
+
+class FakeTelegramRequest(BaseRequest):
+    """Bot API без сети: на send/edit отвечает правдоподобным Message, на остальное - True. Считает вызовы по методам."""
+    def __init__(self, latency: float = 0.0):
+        self.latency = latency
+        self.calls: Counter = Counter()
+        self._message_ids = itertools.count(1)
+    @property
+    def read_timeout(self) -> float | None: return None
+    async def initialize(self) -> None: pass
+    async def shutdown(self) -> None: pass
+    async def do_request(self, url, method, request_data=None, read_timeout=None, write_timeout=None, connect_timeout=None, pool_timeout=None) -> tuple[int, bytes]:
+        endpoint = url.rsplit("/", 1)[-1]; self.calls[endpoint] += 1
+        if self.latency: await asyncio.sleep(self.latency)
+        params = request_data.parameters if request_data is not None else {}
+        if endpoint == "getMe": result = BOT_USER
+        elif endpoint in ("sendMessage", "editMessageText"):
+            result = {"message_id": params.get("message_id") or next(self._message_ids), "date": int(time.time()), "chat": {"id": params.get("chat_id"), "type": "private"}, "from": BOT_USER, "text": params.get("text", "")}
+        else: result = True
+        return 200, json.dumps({"ok": True, "result": result}, ensure_ascii=False).encode()
+
+class UpdateFactory:
+    """Синтетические апдейты от пользователя user_id в его личном чате."""
+    def __init__(self, bot):
+        self.bot = bot
+        self._update_ids = itertools.count(1)
+    def _user(self, user_id: int) -> dict: return {"id": user_id, "is_bot": False, "first_name": f"User{user_id}", "username": f"user{user_id}", "language_code": "ru"}
+    def text(self, user_id: int, text: str) -> Update:
+        message = {"message_id": next(self._update_ids), "date": int(time.time()), "chat": {"id": user_id, "type": "private"}, "from": self._user(user_id), "text": text}
+        if text.startswith("/"): message["entities"] = [{"type": "bot_command", "offset": 0, "length": len(text.split()[0])}]
+        return Update.de_json({"update_id": next(self._update_ids), "message": message}, self.bot)
+    def callback(self, user_id: int, data: str) -> Update:
+        message = {"message_id": next(self._update_ids), "date": int(time.time()), "chat": {"id": user_id, "type": "private"}, "from": BOT_USER, "text": "..."}
+        query = {"id": str(next(self._update_ids)), "from": self._user(user_id), "chat_instance": str(user_id), "data": data, "message": message}
+        return Update.de_json({"update_id": next(self._update_ids), "callback_query": query}, self.bot)
+
+def onboarding_steps(factory: UpdateFactory, user_id: int, rng: random.Random) -> list:
+    return [("start", lambda: factory.text(user_id, "/start")),
+            ("profile_gender", lambda: factory.callback(user_id, rng.choice(["мужской", "женский"]))),
+            ("profile_age", lambda: factory.text(user_id, str(rng.randint(18, 70)))),
+            ("profile_height", lambda: factory.text(user_id, str(rng.randint(150, 200)))),
+            ("profile_weight", lambda: factory.text(user_id, str(rng.randint(50, 120)))),
+            ("profile_activity", lambda: factory.callback(user_id, rng.choice(["минимальная", "легкая", "средняя", "высокая", "экстремальная"]))),
+            ("profile_goal", lambda: factory.callback(user_id, rng.choice(["похудеть", "поддерживать вес", "набрать массу"])))]
+
+def mixed_steps(factory: UpdateFactory, user_id: int, rng: random.Random, ai_meal_ratio: float) -> list:
+    action = rng.choices(["addmeal", "todaycalories", "train", "menu"], weights=[4, 2, 1, 3])[0]
+    if action == "addmeal":
+        ai = rng.random() < ai_meal_ratio
+        return [("addmeal", lambda: factory.text(user_id, "/addmeal")), ("addmeal_type", lambda: factory.callback(user_id, f"meal_{rng.choice(['Завтрак', 'Обед', 'Ужин', 'Перекус'])}")),
+                ("addmeal_ai" if ai else "addmeal_local", lambda: factory.text(user_id, rng.choice(AI_MEALS if ai else LOCAL_MEALS)))]
+    if action == "todaycalories": return [("todaycalories", lambda: factory.text(user_id, "/todaycalories"))]
+    if action == "train": return [("train", lambda: factory.text(user_id, "/train")), ("train_generate", lambda: factory.callback(user_id, rng.choice(["train_home", "train_gym", "train_street"])))]
+    return [("menu_button", lambda: factory.text(user_id, rng.choice(MENU_BUTTONS)))]
+
+def percentiles(values: list[float]) -> dict:
+    if not values: return {"count": 0}
+    ordered = sorted(values)
+    pick = lambda q: ordered[min(len(ordered) - 1, max(0, int(q * len(ordered) + 0.5) - 1))]
+    return {"count": len(ordered), "p50_ms": round(pick(0.50) * 1000, 3), "p95_ms": round(pick(0.95) * 1000, 3), "p99_ms": round(pick(0.99) * 1000, 3), "max_ms": round(ordered[-1] * 1000, 3)}
+
+async def run_phase(app, sessions, concurrency: int) -> dict:
+    """Прогоняет сессии (списки шагов одного пользователя) в concurrency потоков; шаги одной сессии идут по порядку, как у живого пользователя."""
+    latencies: dict[str, list[float]] = defaultdict(list)
+    sessions = iter(sessions)
+    async def worker():
+        for steps in sessions:
+            for kind, make_update in steps:
+                update = make_update(); started = time.perf_counter()
+                await app.update_processor.process_update(update, app.process_update(update))
+                latencies[kind].append(time.perf_counter() - started)
+    started = time.perf_counter()
+    await asyncio.gather(*(worker() for _ in range(concurrency)))
+    elapsed = time.perf_counter() - started
+    all_latencies = [value for values in latencies.values() for value in values]
+    return {"updates": len(all_latencies), "seconds": round(elapsed, 3), "updates_per_sec": round(len(all_latencies) / elapsed, 1) if elapsed else None,
+            "latency": percentiles(all_latencies), "by_kind": {kind: percentiles(values) for kind, values in sorted(latencies.items())}}
+
+async def run_scale(fb, args, users: int, groq: FakeGroqServer, workdir: str) -> dict:
+    fb.BOT_DB_PATH = os.path.join(workdir, f"bench_{users}.db") if args.persistence else ""
+    fb.MEAL_HISTORY = fb.WORKOUT_POOL = fb.REMINDERS = fb.COHORT_ANALYTICS = None
+    fb.MEAL_CACHE = fb.MealEstimateCache(os.path.join(workdir, f"meal_cache_{users}.json"), fb.MEAL_CACHE_MAX_ENTRIES, fb.MEAL_CACHE_TTL, fb.MEAL_CACHE_SAVE_EVERY)
+    fb.AI_QUEUE = fb.AIWorkQueue(fb.GROQ_MAX_CONCURRENCY, fb.GROQ_QUEUE_MAX_WAITING)
+    fb._ai_json_counters.update(dict.fromkeys(fb._ai_json_counters, 0))
+    fb.GROQ_ROUTER = fb.ModelRouter(fb.GROQ_MODELS, fb.GROQ_ROUTER_WINDOW)
+    groq.requests_by_model.clear()
+    telegram = FakeTelegramRequest(args.telegram_latency)
+    app = fb.build_application(request=telegram)
+    handler_errors = Counter()
+    async def count_error(update, context): handler_errors[type(context.error).__name__] += 1
+    app.add_error_handler(count_error)
+    await app.initialize(); await fb.on_startup(app)
+    groq_requests_before, groq_errors_before = groq.requests_total, groq.errors_total
+    rng = random.Random(args.seed)
+    factory = UpdateFactory(app.bot)
+    result = {"users": users}
+    try:
+        gc.collect()
+        if args.tracemalloc: tracemalloc.start()
+        result["onboarding"] = await run_phase(app, (onboarding_steps(factory, user_id, rng) for user_id in range(1, users + 1)), args.concurrency)
+        if args.tracemalloc:
+            gc.collect(); current, peak = tracemalloc.get_traced_memory(); tracemalloc.stop()
+            result["onboarding"]["tracemalloc"] = True
+            result["memory"] = {"retained_bytes": current, "peak_bytes": peak, "bytes_per_user": round(current / users, 1)}
+        mixed_users = (rng.randint(1, users) for _ in itertools.count())
+        sessions, planned = [], 0
+        for user_id in mixed_users: # Сессии набираются, пока не наберется --updates апдейтов
+            if planned >= args.updates: break
+            steps = mixed_steps(factory, user_id, rng, args.ai_meal_ratio); sessions.append(steps); planned += len(steps)
+        result["mixed"] = await run_phase(app, sessions, args.concurrency)
+    finally:
+        await fb.on_shutdown(app); await app.shutdown()
+    result["handler_errors"] = dict(handler_errors)
+    result["telegram_calls"] = dict(telegram.calls.most_common())
+    result["groq"] = {"requests": groq.requests_total - groq_requests_before, "injected_errors": groq.errors_total - groq_errors_before, "requests_by_model": dict(groq.requests_by_model)}
+    result["router"] = fb.GROQ_ROUTER.stats()
+    result["ai_queue"] = fb.AI_QUEUE.stats()
+    result["meal_cache"] = fb.MEAL_CACHE.stats()
+    result["ai_json"] = fb.ai_json_stats()
+    return result
+
+async def main(args) -> dict:
+    # fitness_bot читает настройки из окружения при импорте
+    os.environ.setdefault("TELEGRAM_TOKEN", "123456:BENCHMARK")
+    os.environ.setdefault("GROQ_API_KEY", "bench")
+    os.environ["GROQ_RPM"], os.environ["GROQ_TPM"] = str(args.groq_rpm), str(args.groq_rpm * 1000)
+    os.environ["TRAIN_POOL_WARM_HOURS"] = "" # Фоновое пополнение пула в бенчмарке не нужно
+    os.environ.setdefault("METRICS_PORT", "")
+    import fitness_bot as fb
+    logging.getLogger().setLevel(args.log_level); logging.getLogger("httpx").setLevel(max(logging.WARNING, logging.getLevelName(args.log_level)))
+    models = parse_model_options(args.model_latency, args.model_error_rate, args.decommissioned)
+    async with FakeGroqServer(first_token_delay=parse_latency(args.groq_latency), chunk_delay=args.groq_chunk_delay, error_rate=args.groq_error_rate, error_status=args.groq_error_status, models=models) as groq:
+        fb.GROQ_API_URL = groq.url
+        with tempfile.TemporaryDirectory(prefix="fitbot_bench_") as workdir:
+            scales = [await run_scale(fb, args, users, groq, workdir) for users in args.users]
+    return {"benchmark": "fitness_bot", "started_at": datetime.now(timezone.utc).isoformat(timespec="seconds"), "python": sys.version.split()[0], "platform": platform.platform(),
+            "config": {"concurrency": args.concurrency, "mixed_updates": args.updates, "ai_meal_ratio": args.ai_meal_ratio, "persistence": args.persistence, "streaming": fb.GROQ_STREAMING,
+                       "groq_models": fb.GROQ_MODELS, "model_latency": args.model_latency, "model_error_rate": args.model_error_rate, "decommissioned": args.decommissioned, "groq_latency": args.groq_latency, "groq_error_rate": args.groq_error_rate, "groq_error_status": args.groq_error_status, "telegram_latency": args.telegram_latency,
+                       "bot_concurrent_updates": fb.BOT_CONCURRENT_UPDATES, "groq_max_concurrency": fb.GROQ_MAX_CONCURRENCY, "seed": args.seed},
+            "scales": scales}
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Офлайн-нагрузочный тест бота с фейковыми Telegram и Groq")
+    parser.add_argument("--users", type=lambda s: [int(x) for x in s.split(",")], default=[1000, 10000, 100000], help="Масштабы через запятую")
+    parser.add_argument("--updates", type=int, default=20000, help="Апдейтов в фазе смешанной нагрузки на каждом масштабе")
+    parser.add_argument("--concurrency", type=int, default=64, help="Одновременно активных пользователей")
+    parser.add_argument("--ai-meal-ratio", type=float, default=0.2, help="Доля приемов пищи, которые не находятся локально и уходят в AI")
+    parser.add_argument("--groq-latency", default="lognormal:0.3,0.4", help="Задержка fake Groq: 0.2 | uniform:a,b | normal:mu,sigma | lognormal:median,sigma | exp:mean")
+    parser.add_argument("--groq-chunk-delay", type=float, default=0.005)
+    parser.add_argument("--groq-error-rate", type=float, default=0.0)
+    parser.add_argument("--groq-error-status", type=int, default=503)
+    parser.add_argument("--model-latency", action="append", default=[], metavar="MODEL=SPEC", help="Задержка отдельной модели fake Groq (модели - из GROQ_MODELS)")
+    parser.add_argument("--model-error-rate", action="append", default=[], metavar="MODEL=RATE", help="Доля ошибок отдельной модели fake Groq")
+    parser.add_argument("--decommissioned", action="append", default=[], metavar="MODEL", help="Модель fake Groq отвечает 400 model_decommissioned")
+    parser.add_argument("--groq-rpm", type=float, default=1e6, help="Клиентский лимит запросов/мин (по умолчанию фактически без лимита)")
+    parser.add_argument("--telegram-latency", type=float, default=0.0, help="Задержка ответа фейкового Bot API, с")
+    parser.add_argument("--no-persistence", dest="persistence", action="store_false", help="Без SQLite (только память)")
+    parser.add_argument("--no-tracemalloc", dest="tracemalloc", action="store_false", help="Не измерять память (онбординг идет быстрее)")
+    parser.add_argument("--seed", type=int, default=1)
+    parser.add_argument("--log-level", default="WARNING")
+    parser.add_argument("--output", help="Файл для JSON-результата (по умолчанию stdout)")
+    args = parser.parse_args()
+    report = json.dumps(asyncio.run(main(args)), ensure_ascii=False, indent=2)
+    if args.output:
+        with open(args.output, "w", encoding="utf-8") as f: f.write(report + "\n")
+    else: print(report)
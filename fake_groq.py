@@ -0,0 +1,159 @@
+"""Локальный заменитель Groq API (OpenAI-совместимый /chat/completions) для офлайн-проверок бота.
+
+Поддерживает обычные ответы и SSE-стриминг (stream=true). Запуск отдельно:
+    python fake_groq.py --port 8081
+и затем GROQ_API_URL=http://127.0.0.1:8081/openai/v1/chat/completions python fitness_bot.py
+"""
+import argparse
+import asyncio
+import json
+import math
+import logging
+import random
+import re
+import time
+
+logger = logging.getLogger(__name__)
+
+DEFAULT_WORKOUT = ("## Разминка (5-7 минут)\n- *Бег на месте* - 2 минуты в спокойном темпе.\n- *Вращения руками* - по 10 раз вперед и назад.\n\n"
+                   "## Основная часть (20-30 минут)\n*Приседания*\nТехника выполнения: Спина прямая, колени смотрят в сторону носков.\nПодходы: 3-4\nПовторения: 12-15\nОтдых: 60 секунд\n\n"
+                   "*Отжимания*\nТехника выполнения: Корпус прямой, локти под углом 45 градусов.\nПодходы: 3\nПовторения: 10-12\nОтдых: 60-90 секунд\n\n"
+                   "## Заминка (5 минут)\n- Растяжка основных групп мышц.\n\n🔥 Примерно сожжено калорий за эту тренировку: 200-250 ккал.")
+DEFAULT_MEAL = {"items": [{"name": "Продукт", "quantity": "100 г", "calories": 150, "protein": 5, "fat": 5, "carbs": 20}], "total": {"calories": 150, "protein": 5, "fat": 5, "carbs": 20}}
+
+def default_responder(request: dict) -> str:
+    """Для промптов, ожидающих JSON, возвращает оценку КБЖУ (для пачки импорта - по одной на пронумерованную строку), иначе - тренировку."""
+    prompt = request["messages"][-1]["content"]
+    if '"meals"' in prompt:
+        meals = [{"index": int(n), **DEFAULT_MEAL} for n in re.findall(r"^(\d+)\. ", prompt, re.MULTILINE)]
+        return json.dumps({"meals": meals}, ensure_ascii=False)
+    return json.dumps(DEFAULT_MEAL, ensure_ascii=False) if "JSON" in prompt else DEFAULT_WORKOUT
+
+def parse_latency(spec: str):
+    """Распределение задержки из строки: "0.2" (константа), "uniform:0.1,0.5", "normal:0.3,0.1", "lognormal:0.3,0.5" (медиана, sigma), "exp:0.3" (среднее)."""
+    kind, _, params = spec.partition(":")
+    if not params: value = float(kind); return lambda: value
+    a, *rest = (float(x) for x in params.split(","))
+    b = rest[0] if rest else 0.0
+    distributions = {"uniform": lambda: random.uniform(a, b), "normal": lambda: max(0.0, random.gauss(a, b)),
+                     "lognormal": lambda: random.lognormvariate(math.log(a), b), "exp": lambda: random.expovariate(1 / a)}
+    if kind not in distributions: raise ValueError(f"Неизвестное распределение задержки: {spec}")
+    return distributions[kind]
+
+def parse_model_options(latencies=(), error_rates=(), decommissioned=()) -> dict:
+    """Поведение отдельных моделей из CLI: ["llama-3.1-8b-instant=exp:2"], ["gemma2-9b-it=0.5"], ["mixtral-8x7b-32768"] -> models для FakeGroqServer."""
+    models: dict[str, dict] = {}
+    for spec in latencies:
+        name, _, latency = spec.partition("="); models.setdefault(name, {})["first_token_delay"] = parse_latency(latency)
+    for spec in error_rates:
+        name, _, rate = spec.partition("="); models.setdefault(name, {})["error_rate"] = float(rate)
+    for name in decommissioned: models.setdefault(name, {})["decommissioned"] = True
+    return models
+
+class FakeGroqServer:
+    """HTTP/1.1 сервер с keep-alive. responder(request_json) -> текст ответа модели.
+    first_token_delay - задержка до первого байта (число или функция без аргументов, см. parse_latency), chunk_delay - пауза между SSE-чанками.
+    С вероятностью error_rate вместо ответа отдается error_status (429 - с Retry-After: retry_after).
+    models - поведение отдельных моделей поверх общего: {"имя": {"first_token_delay": ..., "error_rate": ..., "error_status": ..., "decommissioned": True}};
+    снятая модель отвечает 400 model_decommissioned, как настоящий Groq."""
+    def __init__(self, host: str = "127.0.0.1", port: int = 0, responder=default_responder, first_token_delay=0.2, chunk_delay: float = 0.02, chunk_words: int = 3,
+                 error_rate: float = 0.0, error_status: int = 503, retry_after: float = 1.0, models: dict | None = None):
+        self.host, self.port, self.responder = host, port, responder
+        self.first_token_delay, self.chunk_delay, self.chunk_words = first_token_delay, chunk_delay, chunk_words
+        self.error_rate, self.error_status, self.retry_after = error_rate, error_status, retry_after
+        self.models = models or {}
+        self.requests_total = self.errors_total = 0
+        self.requests_by_model: dict[str, int] = {}
+        self._server: asyncio.AbstractServer | None = None
+
+    @property
+    def url(self) -> str: return f"http://{self.host}:{self.port}/openai/v1/chat/completions"
+
+    async def start(self) -> "FakeGroqServer":
+        self._server = await asyncio.start_server(self._handle_connection, self.host, self.port)
+        self.port = self._server.sockets[0].getsockname()[1]
+        return self
+    async def stop(self) -> None:
+        if self._server is not None:
+            self._server.close(); await self._server.wait_closed(); self._server = None
+    async def __aenter__(self): return await self.start()
+    async def __aexit__(self, *exc): await self.stop()
+
+    async def _handle_connection(self, reader: asyncio.StreamReader, writer: asyncio.StreamWriter) -> None:
+        try:
+            while True:
+                request_line = await reader.readline()
+                if not request_line: break
+                headers = {}
+                while (line := await reader.readline()) not in (b"\r\n", b"\n", b""):
+                    name, _, value = line.decode("latin-1").partition(":"); headers[name.strip().lower()] = value.strip()
+                body = await reader.readexactly(int(headers.get("content-length", "0")))
+                await self._handle_request(json.loads(body or b"{}"), writer)
+        except (ConnectionError, asyncio.IncompleteReadError): pass
+        finally:
+            writer.close()
+
+    async def _handle_request(self, request: dict, writer: asyncio.StreamWriter) -> None:
+        self.requests_total += 1
+        model = request.get("model", "fake-model")
+        self.requests_by_model[model] = self.requests_by_model.get(model, 0) + 1
+        behaviour = self.models.get(model, {})
+        delay = behaviour.get("first_token_delay", self.first_token_delay)
+        await asyncio.sleep(delay() if callable(delay) else delay)
+        if behaviour.get("decommissioned"):
+            self.errors_total += 1
+            error = {"message": f"The model `{model}` has been decommissioned and is no longer supported.", "type": "invalid_request_error", "code": "model_decommissioned"}
+            await self._write_error(writer, 400, error); return
+        error_rate, error_status = behaviour.get("error_rate", self.error_rate), behaviour.get("error_status", self.error_status)
+        if error_rate and random.random() < error_rate:
+            self.errors_total += 1
+            await self._write_error(writer, error_status, {"message": "fake upstream error", "type": "internal_server_error" if error_status >= 500 else "rate_limit_exceeded"}); return
+        text = self.responder(request)
+        if not request.get("stream"):
+            payload = json.dumps({"id": f"fake-{self.requests_total}", "object": "chat.completion", "created": int(time.time()), "model": model,
+                                  "choices": [{"index": 0, "message": {"role": "assistant", "content": text}, "finish_reason": "stop"}],
+                                  "usage": {"prompt_tokens": 100, "completion_tokens": len(text) // 3, "total_tokens": 100 + len(text) // 3}}, ensure_ascii=False).encode()
+            writer.write(b"HTTP/1.1 200 OK\r\nContent-Type: application/json\r\nContent-Length: " + str(len(payload)).encode() + b"\r\n\r\n" + payload)
+            await writer.drain(); return
+        writer.write(b"HTTP/1.1 200 OK\r\nContent-Type: text/event-stream\r\nCache-Control: no-cache\r\nTransfer-Encoding: chunked\r\n\r\n")
+        words = text.split(" ")
+        for i in range(0, len(words), self.chunk_words):
+            delta = " ".join(words[i:i + self.chunk_words]) + (" " if i + self.chunk_words < len(words) else "")
+            await self._write_event(writer, {"id": f"fake-{self.requests_total}", "object": "chat.completion.chunk", "model": model, "choices": [{"index": 0, "delta": {"content": delta}, "finish_reason": None}]})
+            await asyncio.sleep(self.chunk_delay)
+        await self._write_event(writer, {"id": f"fake-{self.requests_total}", "object": "chat.completion.chunk", "model": model, "choices": [{"index": 0, "delta": {}, "finish_reason": "stop"}],
+                                         "x_groq": {"usage": {"prompt_tokens": 100, "completion_tokens": len(text) // 3, "total_tokens": 100 + len(text) // 3}}})
+        await self._write_chunk(writer, b"data: [DONE]\n\n")
+        await self._write_chunk(writer, b"")
+
+    async def _write_error(self, writer: asyncio.StreamWriter, status: int, error: dict) -> None:
+        payload = json.dumps({"error": error}).encode()
+        retry_after = f"Retry-After: {self.retry_after:g}\r\n".encode() if status == 429 else b""
+        writer.write(f"HTTP/1.1 {status} Error\r\nContent-Type: application/json\r\n".encode() + retry_after + b"Content-Length: " + str(len(payload)).encode() + b"\r\n\r\n" + payload)
+        await writer.drain()
+
+    async def _write_event(self, writer: asyncio.StreamWriter, event: dict) -> None:
+        await self._write_chunk(writer, b"data: " + json.dumps(event, ensure_ascii=False).encode() + b"\n\n")
+    @staticmethod
+    async def _write_chunk(writer: asyncio.StreamWriter, data: bytes) -> None:
+        writer.write(f"{len(data):x}\r\n".encode() + data + b"\r\n"); await writer.drain()
+
+async def _serve_forever(args) -> None:
+    models = parse_model_options(args.model_latency, args.model_error_rate, args.decommissioned)
+    server = await FakeGroqServer(args.host, args.port, first_token_delay=parse_latency(args.latency), chunk_delay=args.chunk_delay, error_rate=args.error_rate, error_status=args.error_status, models=models).start()
+    logger.info("Fake Groq слушает %s", server.url)
+    await asyncio.Event().wait()
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Локальный заменитель Groq API для офлайн-тестов бота")
+    parser.add_argument("--host", default="127.0.0.1")
+    parser.add_argument("--port", type=int, default=8081)
+    parser.add_argument("--latency", default="0.2", help="Задержка до первого байта: 0.2 | uniform:a,b | normal:mu,sigma | lognormal:median,sigma | exp:mean")
+    parser.add_argument("--error-rate", type=float, default=0.0, help="Доля запросов, на которые отдается ошибка")
+    parser.add_argument("--error-status", type=int, default=503)
+    parser.add_argument("--chunk-delay", type=float, default=0.02)
+    parser.add_argument("--model-latency", action="append", default=[], metavar="MODEL=SPEC", help="Задержка отдельной модели, формат как у --latency")
+    parser.add_argument("--model-error-rate", action="append", default=[], metavar="MODEL=RATE", help="Доля ошибок отдельной модели")
+    parser.add_argument("--decommissioned", action="append", default=[], metavar="MODEL", help="Модель отвечает 400 model_decommissioned")
+    logging.basicConfig(format="%(asctime)s - %(name)s - %(levelname)s - %(message)s", level=logging.INFO)
+    asyncio.run(_serve_forever(parser.parse_args()))
@@ -1,13 +1,37 @@
 import logging
 import os
+import re
+import time
+import copy
+import csv
+import random
+import asyncio
+import bisect
+import heapq
+import functools
+import sqlite3
+import threading
 import httpx
 import json
-from datetime import datetime, date
+import math
+import multiprocessing
+from collections import OrderedDict, deque
+from datetime import datetime, date, timedelta, timezone, tzinfo, time as dtime
+from email.utils import parsedate_to_datetime
+from zoneinfo import ZoneInfo, ZoneInfoNotFoundError, available_timezones
 
+try: import numpy as np # Нужен только для /adminstats; без него команда сообщит, что аналитика недоступна
+except ImportError: np = None
+
+from nutrition import FOODS, FoodIndex, MealLog, MealRecord, analyze_meal_locally, display_number, sum_meal_items
 from telegram import Update, InlineKeyboardMarkup, InlineKeyboardButton, ReplyKeyboardMarkup, KeyboardButton
 from telegram.constants import ParseMode
+from telegram.error import BadRequest, Forbidden, RetryAfter, TelegramError
 from telegram.ext import (
     ApplicationBuilder,
+    BasePersistence,
+    BaseUpdateProcessor,
+    PersistenceInput,
     CommandHandler,
     MessageHandler,
     ContextTypes,
@@ -34,7 +58,7 @@ SYSTEM_PROMPT_DIETITIAN = """...""" # Вставь сюда полный SYSTEM_
 (ADDMEAL_CHOOSE_TYPE, ADDMEAL_GET_DESCRIPTION) = range(PROFILE_GOAL + 1, PROFILE_GOAL + 3)
 GENDER, AGE, HEIGHT, CURRENT_WEIGHT, ACTIVITY_LEVEL, GOAL = "gender", "age", "height", "current_weight", "activity_level", "goal"
 PROFILE_COMPLETE, BMI, BMR, TDEE, TARGET_CALORIES = "profile_complete", "bmi", "bmr", "tdee", "target_calories"
-AWAITING_WEIGHT_UPDATE, TODAY_MEALS, LAST_MEAL_DATE = "awaiting_weight_update", "today_meals", "last_meal_date"
+AWAITING_WEIGHT_UPDATE, TODAY_MEALS, LAST_MEAL_DATE, TIMEZONE = "awaiting_weight_update", "today_meals", "last_meal_date", "timezone"
 ACTIVITY_FACTORS = {"минимальная": 1.2, "легкая": 1.375, "средняя": 1.55, "высокая": 1.725, "экстремальная": 1.9}
 GOAL_FACTORS = {"похудеть": -500, "поддерживать вес": 0, "набрать массу": 300}
 
@@ -56,66 +80,1522 @@ def get_bmi_interpretation(bmi):
     if bmi < 30: return " (⚠️ Избыточный вес)"
     return " (🆘 Ожирение)"
 
+# Векторные версии для аналитики по всем профилям (/adminstats): те же формулы над колонками NumPy, пропуски и неизвестные значения - NaN.
+# Пол, активность и цель передаются кодами: 0 - не указано, i + 1 - i-й ключ GENDER_CODES / ACTIVITY_FACTORS / GOAL_FACTORS.
+GENDER_CODES = ("мужской", "женский")
+BMI_CATEGORY_BOUNDS = (18.5, 25, 30) # Границы get_bmi_interpretation
+BMI_CATEGORY_LABELS = tuple(get_bmi_interpretation(bmi).strip(" ()") for bmi in (18, 20, 27, 35))
+def calculate_bmi_batch(w, h):
+    with np.errstate(divide="ignore", invalid="ignore"): return np.round(np.where(h > 0, w / ((h / 100) ** 2), np.nan), 1)
+def calculate_bmr_batch(w, h, a, gender_codes):
+    base = (10 * w) + (6.25 * h) - (5 * a)
+    return np.round(np.select([gender_codes == 1, gender_codes == 2], [base + 5, base - 161], np.nan))
+def calculate_tdee_batch(bmr, activity_codes): return np.round(bmr * np.array([np.nan, *ACTIVITY_FACTORS.values()])[activity_codes])
+def calculate_target_calories_batch(tdee, goal_codes): return tdee + np.array([np.nan, *GOAL_FACTORS.values()])[goal_codes]
+def bmi_category_batch(bmi):
+    """Индекс в BMI_CATEGORY_LABELS, -1 - ИМТ не рассчитан."""
+    return np.where(np.isnan(bmi), -1, np.digitize(bmi, BMI_CATEGORY_BOUNDS))
+
+
+# --- Метрики (формат Prometheus). METRICS_PORT пуст - метрики выключены, инструментирование ничего не делает ---
+METRICS_PORT = int(os.getenv("METRICS_PORT", "0") or 0) # У воркера i webhook-режима - METRICS_PORT + i
+METRICS_LISTEN = os.getenv("METRICS_LISTEN", "0.0.0.0")
+METRICS_ENABLED = METRICS_PORT > 0
+LATENCY_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60)
+
+def _format_labels(names: tuple, values: tuple) -> str:
+    if not names: return ""
+    escaped = (str(v).replace("\\", "\\\\").replace("\n", "\\n").replace('"', '\\"') for v in values)
+    return "{" + ",".join(f'{n}="{v}"' for n, v in zip(names, escaped)) + "}"
+
+class Counter:
+    """Счетчик с метками; значения меток передаются позиционно в порядке labelnames."""
+    kind = "counter"
+    def __init__(self, name: str, documentation: str, labelnames: tuple = ()):
+        self.name, self.documentation, self.labelnames = name, documentation, labelnames
+        self._values: dict[tuple, float] = {}
+    def inc(self, amount: float = 1, *labels) -> None:
+        if METRICS_ENABLED: self._values[labels] = self._values.get(labels, 0) + amount
+    def samples(self):
+        for labels, value in self._values.items(): yield self.name, _format_labels(self.labelnames, labels), value
+
+class Histogram:
+    """Гистограмма с фиксированными границами; хранит счетчики по корзинам, суммирование - при выдаче."""
+    kind = "histogram"
+    def __init__(self, name: str, documentation: str, labelnames: tuple = (), buckets: tuple = LATENCY_BUCKETS):
+        self.name, self.documentation, self.labelnames, self.buckets = name, documentation, labelnames, buckets
+        self._values: dict[tuple, list] = {} # метки -> [счетчики по корзинам..., +Inf, сумма]
+    def observe(self, value: float, *labels) -> None:
+        if not METRICS_ENABLED: return
+        counts = self._values.get(labels)
+        if counts is None: counts = self._values[labels] = [0] * (len(self.buckets) + 1) + [0.0]
+        counts[bisect.bisect_left(self.buckets, value)] += 1; counts[-1] += value
+    def samples(self):
+        for labels, counts in self._values.items():
+            cumulative = 0
+            for bound, count in zip((*self.buckets, "+Inf"), counts):
+                cumulative += count
+                yield f"{self.name}_bucket", _format_labels((*self.labelnames, "le"), (*labels, bound)), cumulative
+            yield f"{self.name}_count", _format_labels(self.labelnames, labels), cumulative
+            yield f"{self.name}_sum", _format_labels(self.labelnames, labels), counts[-1]
+
+class CallbackMetric:
+    """Значение снимается только при запросе /metrics: fn() -> число или {значения меток: число}."""
+    def __init__(self, name: str, documentation: str, fn, kind: str = "gauge", labelnames: tuple = ()):
+        self.name, self.documentation, self.fn, self.kind, self.labelnames = name, documentation, fn, kind, labelnames
+    def samples(self):
+        value = self.fn()
+        if not isinstance(value, dict): yield self.name, "", value; return
+        for labels, v in value.items(): yield self.name, _format_labels(self.labelnames, labels if isinstance(labels, tuple) else (labels,)), v
+
+METRICS: list = []
+def register_metric(metric):
+    METRICS.append(metric); return metric
+
+def render_metrics() -> str:
+    lines = []
+    for metric in METRICS:
+        try: samples = list(metric.samples())
+        except Exception as e: # Метрика, которую сейчас не снять (например, пул еще не создан), не ломает остальные
+            logger.debug("Метрика %s не снята: %s", metric.name, e); continue
+        lines += [f"# HELP {metric.name} {metric.documentation}", f"# TYPE {metric.name} {metric.kind}"]
+        lines += [f"{name}{labels} {value}" for name, labels, value in samples]
+    return "\n".join(lines) + "\n"
+
+HANDLER_LATENCY = register_metric(Histogram("fitbot_handler_latency_seconds", "Время работы обработчика апдейта", ("handler",)))
+HANDLER_CALLS = register_metric(Counter("fitbot_handler_calls_total", "Вызовы обработчиков по исходу (ok/error)", ("handler", "outcome")))
+GROQ_LATENCY = register_metric(Histogram("fitbot_groq_latency_seconds", "Время запроса к Groq, включая ожидание лимитов и повторы", ("model", "mode")))
+GROQ_CALLS = register_metric(Counter("fitbot_groq_calls_total", "Запросы к Groq по исходу (ok/timeout/rate_limited/http_error/network_error/parse_error/error)", ("model", "mode", "outcome")))
+GROQ_TOKENS = register_metric(Counter("fitbot_groq_tokens_total", "Токены по данным usage из ответов Groq", ("model", "kind")))
+MEAL_ESTIMATES = register_metric(Counter("fitbot_meal_estimates_total", "Откуда взята оценка КБЖУ приема пищи (local/cache/ai)", ("source",)))
+AI_QUEUE_WAIT = register_metric(Histogram("fitbot_ai_queue_wait_seconds", "Ожидание свободного слота в очереди AI"))
+
+def timed_callback(callback):
+    """Обертка обработчика, пишущая время и исход в HANDLER_LATENCY/HANDLER_CALLS."""
+    name = callback.__name__
+    @functools.wraps(callback)
+    async def wrapper(update, context):
+        started, outcome = time.perf_counter(), "ok"
+        try: return await callback(update, context)
+        except Exception: outcome = "error"; raise
+        finally:
+            HANDLER_LATENCY.observe(time.perf_counter() - started, name); HANDLER_CALLS.inc(1, name, outcome)
+    wrapper.timed = True
+    return wrapper
+
+def instrument_handlers(handlers) -> None:
+    """Оборачивает callback всех обработчиков, включая вложенные в ConversationHandler (точки входа, состояния, fallbacks)."""
+    for handler in handlers:
+        if isinstance(handler, ConversationHandler):
+            instrument_handlers((*handler.entry_points, *(h for state in handler.states.values() for h in state), *handler.fallbacks))
+        elif not getattr(handler.callback, "timed", False): handler.callback = timed_callback(handler.callback)
+
+async def _serve_metrics(reader: asyncio.StreamReader, writer: asyncio.StreamWriter) -> None:
+    try:
+        request_line = await reader.readline()
+        while (await reader.readline()) not in (b"\r\n", b"\n", b""): pass
+        path = request_line.split(b" ")[1] if request_line.count(b" ") >= 2 else b""
+        if path.split(b"?")[0] == b"/metrics": status, body = b"200 OK", render_metrics().encode()
+        else: status, body = b"404 Not Found", b"not found\n"
+        writer.write(b"HTTP/1.1 " + status + b"\r\nContent-Type: text/plain; version=0.0.4; charset=utf-8\r\nContent-Length: " + str(len(body)).encode() + b"\r\nConnection: close\r\n\r\n" + body)
+        await writer.drain()
+    except ConnectionError: pass
+    finally: writer.close()
+
+async def start_metrics_server(port: int):
+    server = await asyncio.start_server(_serve_metrics, METRICS_LISTEN, port)
+    logger.info("Метрики Prometheus доступны на http://%s:%d/metrics", METRICS_LISTEN, port)
+    return server
+
+# --- Общий HTTP-клиент для Groq (один пул соединений на всё приложение) ---
+# Настройки пула и таймаутов можно переопределить через переменные окружения.
+GROQ_API_URL = os.getenv("GROQ_API_URL", "https://api.groq.com/openai/v1/chat/completions") # Можно направить на fake_groq.py для офлайн-проверок
+GROQ_HTTP_MAX_CONNECTIONS = int(os.getenv("GROQ_HTTP_MAX_CONNECTIONS", "20"))
+GROQ_HTTP_MAX_KEEPALIVE = int(os.getenv("GROQ_HTTP_MAX_KEEPALIVE", "10"))
+GROQ_HTTP_KEEPALIVE_EXPIRY = float(os.getenv("GROQ_HTTP_KEEPALIVE_EXPIRY", "60"))
+GROQ_HTTP2 = os.getenv("GROQ_HTTP2", "0").lower() in ("1", "true", "yes")
+GROQ_CONNECT_TIMEOUT = float(os.getenv("GROQ_CONNECT_TIMEOUT", "5"))
+GROQ_READ_TIMEOUT = float(os.getenv("GROQ_READ_TIMEOUT", "30"))
+GROQ_WRITE_TIMEOUT = float(os.getenv("GROQ_WRITE_TIMEOUT", "10"))
+GROQ_POOL_TIMEOUT = float(os.getenv("GROQ_POOL_TIMEOUT", "5"))
+_groq_client: httpx.AsyncClient | None = None
+_groq_pool_counters = {"requests_total": 0, "in_flight": 0, "peak_in_flight": 0, "pool_timeouts": 0}
+
+def _build_groq_client() -> httpx.AsyncClient:
+    http2 = GROQ_HTTP2
+    if http2:
+        try: import h2  # noqa: F401  (httpx требует пакет h2 для HTTP/2)
+        except ImportError:
+            logger.warning("GROQ_HTTP2 включен, но пакет h2 не установлен (pip install httpx[http2]). Используется HTTP/1.1.")
+            http2 = False
+    limits = httpx.Limits(max_connections=GROQ_HTTP_MAX_CONNECTIONS, max_keepalive_connections=GROQ_HTTP_MAX_KEEPALIVE, keepalive_expiry=GROQ_HTTP_KEEPALIVE_EXPIRY)
+    timeout = httpx.Timeout(connect=GROQ_CONNECT_TIMEOUT, read=GROQ_READ_TIMEOUT, write=GROQ_WRITE_TIMEOUT, pool=GROQ_POOL_TIMEOUT)
+    return httpx.AsyncClient(limits=limits, timeout=timeout, http2=http2)
+
+async def groq_client_startup(app) -> None:
+    global _groq_client
+    if _groq_client is None:
+        _groq_client = _build_groq_client()
+        logger.info("HTTP-клиент Groq создан: max_connections=%s, keepalive=%s, http2=%s.", GROQ_HTTP_MAX_CONNECTIONS, GROQ_HTTP_MAX_KEEPALIVE, GROQ_HTTP2)
+
+async def groq_client_shutdown(app) -> None:
+    global _groq_client
+    if _groq_client is not None:
+        logger.info("Закрытие HTTP-клиента Groq. Статистика пула: %s", get_groq_pool_stats())
+        await _groq_client.aclose()
+        _groq_client = None
+
+def get_groq_pool_stats() -> dict:
+    """Снимок использования пула соединений Groq (для подбора лимитов под нагрузкой)."""
+    stats = dict(_groq_pool_counters, max_connections=GROQ_HTTP_MAX_CONNECTIONS, max_keepalive=GROQ_HTTP_MAX_KEEPALIVE)
+    pool = getattr(getattr(_groq_client, "_transport", None), "_pool", None) # httpcore.AsyncConnectionPool
+    connections = list(getattr(pool, "connections", []) or [])
+    stats["open_connections"] = len(connections)
+    stats["idle_connections"] = sum(1 for c in connections if c.is_idle())
+    stats["active_connections"] = stats["open_connections"] - stats["idle_connections"]
+    return stats
+
+register_metric(CallbackMetric("fitbot_groq_pool_connections", "Соединения в пуле HTTP-клиента Groq", lambda: {state: get_groq_pool_stats()[f"{state}_connections"] for state in ("open", "idle", "active")}, labelnames=("state",)))
+register_metric(CallbackMetric("fitbot_groq_pool_in_flight", "Запросы к Groq, ожидающие ответа", lambda: _groq_pool_counters["in_flight"]))
+
+# --- Клиентские лимиты Groq: token bucket по запросам/мин и токенам/мин, повторы с учетом Retry-After ---
+# Значения по умолчанию - бесплатный тариф Groq для gemma2-9b-it; для своего тарифа переопредели через окружение.
+GROQ_RPM = float(os.getenv("GROQ_RPM", "30"))
+GROQ_TPM = float(os.getenv("GROQ_TPM", "15000"))
+GROQ_EST_COMPLETION_TOKENS = int(os.getenv("GROQ_EST_COMPLETION_TOKENS", "700")) # Оценка длины ответа до получения usage
+GROQ_MAX_RETRIES = int(os.getenv("GROQ_MAX_RETRIES", "4"))
+GROQ_CALL_DEADLINE = float(os.getenv("GROQ_CALL_DEADLINE", "60")) # Общий бюджет одного вызова, включая ожидание лимитов и повторы
+GROQ_BACKOFF_BASE, GROQ_BACKOFF_CAP = 0.5, 20.0
+
+class GroqRateLimitTimeout(Exception):
+    pass
+
+class TokenBucket:
+    def __init__(self, capacity: float, refill_per_second: float):
+        self.capacity, self.rate = capacity, refill_per_second
+        self.tokens, self._updated = capacity, time.monotonic()
+    def refill(self) -> None:
+        now = time.monotonic()
+        self.tokens = min(self.capacity, self.tokens + (now - self._updated) * self.rate); self._updated = now
+    def wait_time(self, amount: float) -> float:
+        self.refill()
+        return 0.0 if self.tokens >= amount else (amount - self.tokens) / self.rate
+    def take(self, amount: float) -> None: self.tokens -= amount # Может уйти в минус (доплата по факту usage)
+    def block_for(self, seconds: float) -> None:
+        self.refill(); self.tokens = min(self.tokens, 1 - seconds * self.rate) # Следующий токен - не раньше чем через seconds
+
+class GroqRateLimiter:
+    """Два ведра (запросы/мин и токены/мин). Ждущие обслуживаются по очереди (FIFO через asyncio.Lock)."""
+    def __init__(self, rpm: float, tpm: float):
+        self.requests, self.tokens = TokenBucket(rpm, rpm / 60), TokenBucket(tpm, tpm / 60)
+        self._lock = asyncio.Lock()
+        self.throttled = self.throttle_time_total = 0
+    async def acquire(self, est_tokens: int, deadline: float) -> None:
+        est_tokens = min(est_tokens, self.tokens.capacity)
+        async with self._lock:
+            while True:
+                wait = max(self.requests.wait_time(1), self.tokens.wait_time(est_tokens))
+                if wait <= 0:
+                    self.requests.take(1); self.tokens.take(est_tokens); return
+                if time.monotonic() + wait > deadline: raise GroqRateLimitTimeout(f"Лимит Groq освободится только через {wait:.1f} с")
+                self.throttled += 1; self.throttle_time_total += wait
+                await asyncio.sleep(wait)
+    def settle(self, est_tokens: int, actual_tokens: int) -> None: self.tokens.take(actual_tokens - est_tokens)
+    def block_for(self, seconds: float) -> None: self.requests.block_for(seconds)
+
+class GroqRateLimits:
+    """Лимиты Groq считаются для каждой модели отдельно: у каждой модели свои ведра и своя пауза после 429,
+    так что 429 от одной модели не задерживает хедж и переход к другой."""
+    def __init__(self, rpm: float, tpm: float):
+        self.rpm, self.tpm = rpm, tpm
+        self.models: dict[str, GroqRateLimiter] = {}
+    def __getitem__(self, model: str) -> GroqRateLimiter:
+        limiter = self.models.get(model)
+        if limiter is None: limiter = self.models[model] = GroqRateLimiter(self.rpm, self.tpm)
+        return limiter
+    @property
+    def throttled(self) -> int: return sum(limiter.throttled for limiter in self.models.values())
+    @property
+    def throttle_time_total(self) -> float: return sum(limiter.throttle_time_total for limiter in self.models.values())
+
+GROQ_RATE_LIMITS = GroqRateLimits(GROQ_RPM, GROQ_TPM)
+_groq_inflight: dict[tuple, asyncio.Future] = {}
+_groq_call_counters = {"upstream_calls": 0, "coalesced": 0, "retries": 0}
+register_metric(CallbackMetric("fitbot_groq_upstream_total", "HTTP-запросы к Groq (upstream_calls), повторы (retries) и запросы, слитые с уже идущими (coalesced)", lambda: dict(_groq_call_counters), "counter", ("kind",)))
+register_metric(CallbackMetric("fitbot_groq_throttle_seconds_total", "Суммарное ожидание клиентских лимитов Groq", lambda: {model: limiter.throttle_time_total for model, limiter in GROQ_RATE_LIMITS.models.items()}, "counter", ("model",)))
+
+def _record_groq_usage(model: str, usage: dict | None) -> None:
+    if not METRICS_ENABLED or not usage: return
+    for kind in ("prompt", "completion"):
+        if isinstance(usage.get(f"{kind}_tokens"), int): GROQ_TOKENS.inc(usage[f"{kind}_tokens"], model, kind)
+
+def _parse_retry_after(value: str | None) -> float | None:
+    if not value: return None
+    try: return max(0.0, float(value))
+    except ValueError: pass
+    try: return max(0.0, (parsedate_to_datetime(value) - datetime.now(parsedate_to_datetime(value).tzinfo)).total_seconds())
+    except (TypeError, ValueError): return None
+
+def _backoff_delay(attempt: int) -> float: return random.uniform(0, min(GROQ_BACKOFF_CAP, GROQ_BACKOFF_BASE * 2 ** attempt)) # Экспоненциальная задержка с полным джиттером
+
+def _retry_delay(response: httpx.Response, attempt: int) -> float:
+    retry_after = _parse_retry_after(response.headers.get("retry-after"))
+    return retry_after + random.uniform(0, 0.5) if retry_after is not None else _backoff_delay(attempt)
+
+_GROQ_TRANSIENT_ERRORS = (httpx.NetworkError, httpx.RemoteProtocolError, httpx.ConnectTimeout) # Запрос до модели не дошел или соединение оборвалось - можно повторить
+
+async def _groq_post(client: httpx.AsyncClient, headers: dict, data: dict, model: str) -> dict:
+    """POST к Groq с ожиданием клиентских лимитов и повторами 429/5xx и сетевых сбоев; весь вызов, включая сами запросы, укладывается в GROQ_CALL_DEADLINE."""
+    deadline = time.monotonic() + GROQ_CALL_DEADLINE
+    est_tokens = sum(len(m["content"]) for m in data["messages"]) // 3 + GROQ_EST_COMPLETION_TOKENS
+    limiter, attempt = GROQ_RATE_LIMITS[model], 0
+    while True:
+        await limiter.acquire(est_tokens, deadline)
+        _groq_call_counters["upstream_calls"] += 1
+        try: response = await asyncio.wait_for(client.post(GROQ_API_URL, headers=headers, json=data), deadline - time.monotonic())
+        except asyncio.TimeoutError: raise httpx.TimeoutException(f"Вызов не уложился в GROQ_CALL_DEADLINE ({GROQ_CALL_DEADLINE:g} с)") from None
+        except _GROQ_TRANSIENT_ERRORS as e:
+            attempt += 1; delay = _backoff_delay(attempt)
+            if attempt > GROQ_MAX_RETRIES or time.monotonic() + delay > deadline: raise
+            _groq_call_counters["retries"] += 1
+            logger.warning("Сбой соединения с Groq (%s): %r, повтор %s/%s через %.1f с.", model, e, attempt, GROQ_MAX_RETRIES, delay)
+            await asyncio.sleep(delay); continue
+        if response.status_code == 429 or response.status_code >= 500:
+            attempt += 1; delay = _retry_delay(response, attempt)
+            if response.status_code == 429: limiter.block_for(delay) # Остальные вызовы этой модели тоже ждут, а не долбят API
+            if attempt > GROQ_MAX_RETRIES or time.monotonic() + delay > deadline: response.raise_for_status()
+            _groq_call_counters["retries"] += 1
+            logger.warning("Groq (%s) ответил %s, повтор %s/%s через %.1f с.", model, response.status_code, attempt, GROQ_MAX_RETRIES, delay)
+            await asyncio.sleep(delay); continue
+        response.raise_for_status()
+        response_data = response.json()
+        total_tokens = (response_data.get("usage") or {}).get("total_tokens")
+        if isinstance(total_tokens, int): limiter.settle(est_tokens, total_tokens)
+        _record_groq_usage(model, response_data.get("usage"))
+        return response_data
+
+# --- Маршрутизация по моделям Groq: скользящие p95 и доля ошибок, хеджированные запросы, circuit breaker ---
+GROQ_MODELS = [m.strip() for m in os.getenv("GROQ_MODELS", "gemma2-9b-it,llama-3.1-8b-instant").split(",") if m.strip()] # Порядок - приоритет, первая - основная
+GROQ_HEDGE = os.getenv("GROQ_HEDGE", "1").lower() in ("1", "true", "yes") # Не дождались основной модели за ее p95 - параллельно спрашиваем следующую
+GROQ_HEDGE_DEFAULT_DELAY = float(os.getenv("GROQ_HEDGE_DEFAULT_DELAY", "5")) # Пока у модели меньше GROQ_ROUTER_MIN_SAMPLES замеров
+GROQ_HEDGE_MIN_DELAY = float(os.getenv("GROQ_HEDGE_MIN_DELAY", "0.5"))
+GROQ_ROUTER_WINDOW = int(os.getenv("GROQ_ROUTER_WINDOW", "100")) # Последних вызовов модели в скользящем окне
+GROQ_ROUTER_MIN_SAMPLES = int(os.getenv("GROQ_ROUTER_MIN_SAMPLES", "20"))
+GROQ_BREAKER_ERROR_RATE = float(os.getenv("GROQ_BREAKER_ERROR_RATE", "0.5")) # Доля ошибок в окне, при которой модель отключается
+GROQ_BREAKER_MIN_CALLS = int(os.getenv("GROQ_BREAKER_MIN_CALLS", "10"))
+GROQ_BREAKER_CONSECUTIVE = int(os.getenv("GROQ_BREAKER_CONSECUTIVE", "5")) # ...или столько ошибок подряд
+GROQ_BREAKER_COOLDOWN = float(os.getenv("GROQ_BREAKER_COOLDOWN", "30")) # Через сколько секунд отключенной модели дается пробный запрос
+ROUTER_FAILURE_OUTCOMES = frozenset({"timeout", "http_error", "network_error", "parse_error", "error"}) # rate_limited и pool_timeout - не вина модели
+ROUTER_FAILOVER_OUTCOMES = ROUTER_FAILURE_OUTCOMES | {"decommissioned", "rate_limited"} # После них спрашиваем следующую модель: лимиты Groq у каждой модели свои
+AI_REPLY_OUTCOMES = frozenset({"ok", "json_invalid"}) # Текст пришел от модели; при остальных исходах ask_groq это сообщение об ошибке для пользователя
+MODEL_STATES = ("closed", "open", "half_open", "decommissioned")
+ALL_MODELS_DOWN_TEXT = "🔌 AI сейчас недоступен: все модели временно не отвечают. Попробуй, пожалуйста, через минуту."
+GROQ_ROUTER_DECISIONS = register_metric(Counter("fitbot_groq_router_decisions_total", "Решения маршрутизатора моделей (primary/hedge/failover/hedge_won/fail_fast) и переходы circuit breaker", ("model", "decision")))
+
+def _is_model_gone(status_code: int, body: str) -> bool:
+    return "model_decommissioned" in body or (status_code == 404 and "model_not_found" in body)
+
+class ModelHealth:
+    """Скользящее окно последних вызовов модели и состояние ее circuit breaker: closed -> open -> half_open -> closed/open."""
+    def __init__(self, model: str, window: int):
+        self.model = model
+        self.latencies = deque(maxlen=window); self.failures = deque(maxlen=window)
+        self.state, self.opened_at, self.consecutive_failures, self.probe_in_flight = "closed", 0.0, 0, False
+    def p95(self) -> float | None:
+        if len(self.latencies) < GROQ_ROUTER_MIN_SAMPLES: return None
+        return sorted(self.latencies)[int(len(self.latencies) * 0.95) - 1]
+    def error_rate(self) -> float: return sum(self.failures) / len(self.failures) if self.failures else 0.0
+
+class ModelRouter:
+    """Выбирает модели для запроса и учитывает исходы вызовов. Каждое решение видно в логе, в fitbot_groq_router_decisions_total и в stats()."""
+    def __init__(self, models: list[str], window: int):
+        self.models = {model: ModelHealth(model, window) for model in models}
+        self.decisions: dict[tuple, int] = {}
+    def decide(self, model: str, decision: str) -> None:
+        self.decisions[(model, decision)] = self.decisions.get((model, decision), 0) + 1
+        GROQ_ROUTER_DECISIONS.inc(1, model, decision)
+    def _transition(self, health: ModelHealth, state: str, reason: str) -> None:
+        log = logger.error if state in ("open", "decommissioned") else logger.warning
+        log("Модель %s: %s -> %s (%s; ошибок в окне %.0f%%, p95 %s)", health.model, health.state, state, reason, health.error_rate() * 100, health.p95())
+        health.state = state; self.decide(health.model, f"breaker_{state}")
+        if state == "open": health.opened_at = time.monotonic()
+        if state == "closed": health.failures.clear(); health.consecutive_failures = 0
+    def pick(self) -> list[str]:
+        """Модели, которым сейчас можно отправить запрос, в порядке приоритета. Пустой список - все отключены, вызов должен упасть сразу."""
+        now, available = time.monotonic(), []
+        for health in self.models.values():
+            if health.state == "open" and now - health.opened_at >= GROQ_BREAKER_COOLDOWN: self._transition(health, "half_open", "пауза прошла, нужен пробный запрос")
+            if health.state == "closed" or (health.state == "half_open" and not health.probe_in_flight): available.append(health.model)
+        return available
+    def started(self, model: str, decision: str) -> None:
+        health = self.models.get(model)
+        if health is not None and health.state == "half_open": health.probe_in_flight = True # Пока идет пробный запрос, остальные модель обходят
+        self.decide(model, decision)
+    def hedge_delay(self, model: str) -> float:
+        p95 = self.models[model].p95() if model in self.models else None
+        return max(GROQ_HEDGE_MIN_DELAY, p95) if p95 is not None else GROQ_HEDGE_DEFAULT_DELAY
+    def observe(self, model: str, latency: float, outcome: str, mode: str = "sync") -> None:
+        health = self.models.get(model)
+        if health is None or health.state == "decommissioned": return
+        health.probe_in_flight = False
+        if outcome == "decommissioned": self._transition(health, "decommissioned", "модель снята с обслуживания в Groq"); return
+        if outcome == "cancelled": # Проигравший хедж: время до отмены - нижняя оценка задержки, медленная модель не выглядит быстрой
+            if mode == "sync": health.latencies.append(latency)
+            return
+        if outcome in ("rate_limited", "pool_timeout"): return
+        failed = outcome in ROUTER_FAILURE_OUTCOMES
+        health.failures.append(failed)
+        if not failed and mode == "sync": health.latencies.append(latency)
+        health.consecutive_failures = health.consecutive_failures + 1 if failed else 0
+        if health.state == "half_open": self._transition(health, "open" if failed else "closed", f"пробный запрос: {outcome}")
+        elif failed and health.state == "closed":
+            if health.consecutive_failures >= GROQ_BREAKER_CONSECUTIVE: self._transition(health, "open", f"{health.consecutive_failures} ошибок подряд")
+            elif len(health.failures) >= GROQ_BREAKER_MIN_CALLS and health.error_rate() >= GROQ_BREAKER_ERROR_RATE: self._transition(health, "open", "доля ошибок выше порога")
+    def stats(self) -> dict:
+        models = {m: {"state": h.state, "p95_s": round(h.p95(), 3) if h.p95() is not None else None, "error_rate": round(h.error_rate(), 3), "window": len(h.failures)} for m, h in self.models.items()}
+        return {"models": models, "decisions": {f"{model}:{decision}": count for (model, decision), count in sorted(self.decisions.items())}}
+
+GROQ_ROUTER = ModelRouter(GROQ_MODELS, GROQ_ROUTER_WINDOW)
+register_metric(CallbackMetric("fitbot_groq_model_latency_p95_seconds", "Скользящий p95 задержки модели (0, пока мало замеров)", lambda: {m: h.p95() or 0.0 for m, h in GROQ_ROUTER.models.items()}, labelnames=("model",)))
+register_metric(CallbackMetric("fitbot_groq_model_error_rate", "Доля ошибок модели в скользящем окне", lambda: {m: h.error_rate() for m, h in GROQ_ROUTER.models.items()}, labelnames=("model",)))
+register_metric(CallbackMetric("fitbot_groq_model_state", "Состояние circuit breaker модели (1 у текущего)", lambda: {(m, s): int(h.state == s) for m, h in GROQ_ROUTER.models.items() for s in MODEL_STATES}, labelnames=("model", "state")))
 
 # --- Функция для запросов к Groq API (как в v2.7) ---
-async def ask_groq(user_message: str, model: str = "gemma2-9b-it", system_prompt_override: str = None, temperature: float = 0.5):
-    # (Вставь сюда полный код ask_groq из v2.7)
+async def ask_groq(user_message: str, model: str | None = None, system_prompt_override: str = None, temperature: float = 0.5, response_format: dict | None = None) -> tuple[str, str]:
+    """-> (текст ответа или ошибки для пользователя, исход); ответ модели - только при исходе из AI_REPLY_OUTCOMES.
+    Одинаковые одновременные запросы (модель, системный промпт, сообщение, температура, формат ответа) делят один ответ Groq.
+    model=None - модель выбирает GROQ_ROUTER из GROQ_MODELS."""
+    current_system_prompt = system_prompt_override if system_prompt_override else SYSTEM_PROMPT_DIETITIAN
+    key = (model, current_system_prompt, user_message, temperature, json.dumps(response_format, sort_keys=True) if response_format else None)
+    shared = _groq_inflight.get(key)
+    if shared is None:
+        shared = _groq_inflight[key] = asyncio.ensure_future(_ask_groq_routed(user_message, model, current_system_prompt, temperature, response_format))
+        shared.add_done_callback(lambda _: _groq_inflight.pop(key, None))
+    else: _groq_call_counters["coalesced"] += 1
+    return await asyncio.shield(shared) # Отмена одного ожидающего не отменяет общий запрос
+
+async def _ask_groq_routed(user_message: str, model: str | None, current_system_prompt: str, temperature: float, response_format: dict | None) -> tuple[str, str]:
+    """Основная модель; если она не ответила за свой p95 - хедж к следующей (побеждает первый успешный ответ, второй запрос отменяется);
+    если упала - переход к следующей. Когда все модели отключены circuit breaker, ошибка возвращается сразу, без ожидания таймаута."""
     if not GROQ_API_KEY:
         logger.warning("GROQ_API_KEY не установлен. AI запрос не будет выполнен.")
-        return "К сожалению, я сейчас не могу связаться со своим AI-мозгом. Попробуйте позже или проверьте настройки API ключа."
+        return "К сожалению, я сейчас не могу связаться со своим AI-мозгом. Попробуйте позже или проверьте настройки API ключа.", "no_api_key"
+    models = [model] if model else GROQ_ROUTER.pick()
+    if not models:
+        GROQ_ROUTER.decide("-", "fail_fast"); logger.warning("Все модели Groq отключены circuit breaker: %s", GROQ_ROUTER.stats()["models"])
+        return ALL_MODELS_DOWN_TEXT, "fail_fast"
+    tasks: dict[asyncio.Task, str] = {}
+    def launch(decision: str) -> None:
+        next_model = models[len(launched)]; launched.append(next_model)
+        GROQ_ROUTER.started(next_model, decision)
+        tasks[asyncio.ensure_future(_ask_groq_model(user_message, next_model, current_system_prompt, temperature, response_format))] = next_model
+    launched, hedged, reply, outcome = [], False, ALL_MODELS_DOWN_TEXT, "fail_fast"
+    launch("primary")
+    try:
+        while tasks:
+            can_hedge = GROQ_HEDGE and not hedged and len(launched) < len(models)
+            done, _ = await asyncio.wait(tasks, timeout=GROQ_ROUTER.hedge_delay(launched[-1]) if can_hedge else None, return_when=asyncio.FIRST_COMPLETED)
+            if not done:
+                logger.info("Groq (%s) не ответил за %.1f с (p95), хеджированный запрос к %s.", launched[-1], GROQ_ROUTER.hedge_delay(launched[-1]), models[len(launched)])
+                hedged = True; launch("hedge"); continue
+            for task in done:
+                answered_by = tasks.pop(task); reply, outcome = task.result()
+                if outcome in AI_REPLY_OUTCOMES:
+                    if answered_by != launched[0]: GROQ_ROUTER.decide(answered_by, "hedge_won" if hedged else "failover_ok")
+                    return reply, outcome
+            # Ошибка не побеждает: ждем еще идущий хедж, а если его нет - спрашиваем следующую модель (кроме pool_timeout - пул у всех моделей общий)
+            if not tasks and len(launched) < len(models) and outcome in ROUTER_FAILOVER_OUTCOMES:
+                logger.warning("Groq (%s) ответил ошибкой (%s), переход к модели %s.", answered_by, outcome, models[len(launched)])
+                launch("failover")
+        return reply, outcome
+    finally:
+        for task in tasks: task.cancel() # Проигравший хедж
+
+async def _ask_groq_model(user_message: str, model: str, current_system_prompt: str, temperature: float, response_format: dict | None = None) -> tuple[str, str]:
+    """Один вызов конкретной модели -> (текст ответа или ошибки для пользователя, исход для метрик и маршрутизатора)."""
+    # (Вставь сюда полный код ask_groq из v2.7)
     headers = {"Authorization": f"Bearer {GROQ_API_KEY}", "Content-Type": "application/json"}
-    current_system_prompt = system_prompt_override if system_prompt_override else SYSTEM_PROMPT_DIETITIAN
     data = {"messages": [{"role": "system", "content": current_system_prompt}, {"role": "user", "content": user_message}], "model": model, "temperature": temperature}
-    logger.info(f"Отправка запроса к Groq. Модель: {model}, Температура: {temperature}. Сообщение: {user_message[:100]}...")
+    if response_format: data["response_format"] = response_format
+    logger.info("Отправка запроса к Groq. Модель: %s, Температура: %s. Сообщение: %s...", model, temperature, user_message[:100])
+    client = _groq_client if _groq_client is not None else _build_groq_client() # Вне Application (скрипты) - временный клиент
+    started, outcome = time.perf_counter(), "error"
+    _groq_pool_counters["requests_total"] += 1; _groq_pool_counters["in_flight"] += 1
+    _groq_pool_counters["peak_in_flight"] = max(_groq_pool_counters["peak_in_flight"], _groq_pool_counters["in_flight"])
     try:
-        async with httpx.AsyncClient() as client:
-            response = await client.post("https://api.groq.com/openai/v1/chat/completions", headers=headers, json=data, timeout=30.0)
-            response.raise_for_status()
-            response_data = response.json()
-            if response_data.get("choices") and response_data["choices"][0].get("message"):
-                logger.info(f"Успешный ответ от Groq ({model}).")
-                return response_data["choices"][0]["message"]["content"]
-            logger.error(f"Неожиданная структура ответа от Groq ({model}): {response_data}")
-            return "🤖 Извини, у меня небольшие технические шоколадки с AI. Структура ответа некорректна."
+        response_data = await _groq_post(client, headers, data, model)
+        if response_data.get("choices") and response_data["choices"][0].get("message"):
+            logger.info("Успешный ответ от Groq (%s).", model)
+            outcome = "ok"; return response_data["choices"][0]["message"]["content"], outcome
+        outcome = "parse_error"
+        logger.error("Неожиданная структура ответа от Groq (%s): %s", model, response_data)
+        return "🤖 Извини, у меня небольшие технические шоколадки с AI. Структура ответа некорректна.", outcome
     except httpx.HTTPStatusError as e:
-        logger.error(f"Ошибка HTTP от Groq ({model}): {e.response.status_code} - {e.response.text}")
-        if "model_decommissioned" in e.response.text: return f"🔌 Ой, похоже, выбранная модель AI ({model}) больше не доступна. Разработчик уже в курсе!"
-        return f"🔌 Ошибка при обращении к AI (код: {e.response.status_code}). Пожалуйста, проверь свой API ключ Groq."
+        outcome = "http_error"
+        if response_format and e.response.status_code == 400 and "json_validate_failed" in e.response.text:
+            try: failed_generation = e.response.json()["error"]["failed_generation"]
+            except (ValueError, KeyError, TypeError): failed_generation = None
+            if failed_generation: # Groq сам отбраковал JSON - отдаем черновик на локальную починку вместо повторного запроса
+                logger.warning("Groq (%s) отбраковал JSON по response_format, ответ уйдет на локальную починку.", model)
+                outcome = "json_invalid"; return failed_generation, outcome
+        logger.error("Ошибка HTTP от Groq (%s): %s - %s", model, e.response.status_code, e.response.text)
+        if _is_model_gone(e.response.status_code, e.response.text):
+            outcome = "decommissioned"; return f"🔌 Ой, похоже, выбранная модель AI ({model}) больше не доступна. Разработчик уже в курсе!", outcome
+        if e.response.status_code == 429:
+            outcome = "rate_limited"; return "⏳ Упс, AI сейчас перегружен запросами. Попробуй, пожалуйста, еще раз через минуту.", outcome
+        return f"🔌 Ошибка при обращении к AI (код: {e.response.status_code}). Пожалуйста, проверь свой API ключ Groq.", outcome
     except httpx.ReadTimeout:
-        logger.error(f"Таймаут чтения ответа от Groq API ({model}). Модель слишком долго генерировала ответ.")
-        return "⏳ AI задумался слишком надолго и не успел ответить за 30 секунд. Попробуй, пожалуйста, еще раз или выбери другую опцию."
+        outcome = "timeout"
+        logger.error("Таймаут чтения ответа от Groq API (%s). Модель слишком долго генерировала ответ.", model)
+        return f"⏳ AI задумался слишком надолго и не успел ответить за {GROQ_READ_TIMEOUT:.0f} секунд. Попробуй, пожалуйста, еще раз или выбери другую опцию.", outcome
+    except httpx.PoolTimeout:
+        _groq_pool_counters["pool_timeouts"] += 1; outcome = "pool_timeout"
+        logger.error("Нет свободных соединений в пуле Groq (%s). Статистика пула: %s", model, get_groq_pool_stats())
+        return "⏳ Сейчас слишком много запросов к AI. Попробуй, пожалуйста, еще раз через минуту.", outcome
+    except GroqRateLimitTimeout as e:
+        outcome = "rate_limited"
+        logger.warning("Запрос к Groq (%s) не уложился в лимит запросов/токенов: %s", model, e)
+        return "⏳ Упс, лимит запросов к AI на эту минуту исчерпан. Попробуй, пожалуйста, еще раз чуть позже.", outcome
     except httpx.TimeoutException as e:
-        logger.error(f"Общий таймаут при запросе к Groq API ({model}): {e}")
-        return "⏳ Упс, не удалось связаться с AI вовремя (таймаут). Попробуй, пожалуйста, еще раз чуть позже."
+        outcome = "timeout"
+        logger.error("Общий таймаут при запросе к Groq API (%s): %s", model, e)
+        return "⏳ Упс, не удалось связаться с AI вовремя (таймаут). Попробуй, пожалуйста, еще раз чуть позже.", outcome
     except httpx.RequestError as e:
-        logger.error(f"Ошибка запроса к Groq API ({model}): {e}")
-        return "📡 Проблема с подключением к AI. Возможно, временные неполадки в сети."
+        outcome = "network_error"
+        logger.error("Ошибка запроса к Groq API (%s): %s", model, e)
+        return "📡 Проблема с подключением к AI. Возможно, временные неполадки в сети.", outcome
     except (KeyError, IndexError) as e:
-        logger.error(f"Ошибка парсинга ответа от Groq API ({model}): {e}")
-        return "🤯 Получен неожиданный или неполный ответ от AI. Попробуй еще раз."
+        outcome = "parse_error"
+        logger.error("Ошибка парсинга ответа от Groq API (%s): %s", model, e)
+        return "🤯 Получен неожиданный или неполный ответ от AI. Попробуй еще раз.", outcome
+    except asyncio.CancelledError:
+        outcome = "cancelled"; raise # Проигравший хеджированный запрос
     except Exception as e:
-        logger.error(f"Непредвиденная ошибка в ask_groq ({model}): {e}", exc_info=True)
-        return "💥 Ой, что-то пошло совсем не так с AI! Разработчик уже в курсе."
+        logger.error("Непредвиденная ошибка в ask_groq (%s): %s", model, e, exc_info=True)
+        return "💥 Ой, что-то пошло совсем не так с AI! Разработчик уже в курсе.", outcome
+    finally:
+        _groq_pool_counters["in_flight"] -= 1
+        GROQ_LATENCY.observe(time.perf_counter() - started, model, "sync"); GROQ_CALLS.inc(1, model, "sync", outcome)
+        GROQ_ROUTER.observe(model, time.perf_counter() - started, outcome)
+        if client is not _groq_client: await client.aclose()
+
+# --- Структурированные JSON-ответы AI: схема, проверка (компилируется один раз), локальная починка сломанного JSON ---
+GROQ_JSON_MODE = os.getenv("GROQ_JSON_MODE", "json_object").lower() # json_schema (схема уходит в API) | json_object (JSON-режим, схема - в промпте) | off
+_NUMBER_SCHEMA = {"type": "number", "minimum": 0}
+_NUTRIENT_PROPERTIES = {"calories": _NUMBER_SCHEMA, "protein": _NUMBER_SCHEMA, "fat": _NUMBER_SCHEMA, "carbs": _NUMBER_SCHEMA}
+MEAL_ITEM_SCHEMA = {"type": "object", "properties": {"name": {"type": "string"}, "quantity": {"type": "string", "default": "?"}, **_NUTRIENT_PROPERTIES}, "required": ["name", "calories", "protein", "fat", "carbs"]}
+MEAL_ESTIMATE_SCHEMA = {"title": "meal_estimate", "type": "object", "properties": {"items": {"type": "array", "items": MEAL_ITEM_SCHEMA, "default": []},
+                        "total": {"type": "object", "properties": _NUTRIENT_PROPERTIES, "required": list(_NUTRIENT_PROPERTIES)}}, "required": ["total"]}
+IMPORT_MEAL_SCHEMA = {**MEAL_ESTIMATE_SCHEMA, "title": "import_meal", "properties": {"index": {"type": "integer", "minimum": 1}, **MEAL_ESTIMATE_SCHEMA["properties"]}}
+IMPORT_BATCH_SCHEMA = {"title": "import_batch", "type": "object", "properties": {"meals": {"type": "array", "items": IMPORT_MEAL_SCHEMA}}, "required": ["meals"]}
+_NUMERIC_STRING_RE = re.compile(r"^\s*(-?\d+(?:[.,]\d+)?)\s*(?:ккал|kcal|гр|г|g)?\.?\s*$", re.IGNORECASE)
+_ai_json_counters = {"ok": 0, "repaired": 0, "invalid": 0, "rerequested": 0}
+register_metric(CallbackMetric("fitbot_ai_json_replies_total", "JSON-ответы AI: ok, repaired (починены локально), invalid; rerequested - повторные запросы к Groq из-за невалидного ответа", lambda: dict(_ai_json_counters), "counter", ("result",)))
+
+def compile_schema(schema: dict, path: str = "$"):
+    """Подмножество JSON Schema (object/array/number/integer/string, required, default, minimum) -> функция проверки.
+    Схема разбирается один раз; функция возвращает очищенное значение (лишние поля отброшены, числа из строк вида "150" или "12,5 г" приведены) или бросает ValueError."""
+    kind = schema.get("type")
+    if kind == "object":
+        fields = tuple((name, compile_schema(sub, f"{path}.{name}"), "default" in sub, sub.get("default")) for name, sub in schema.get("properties", {}).items())
+        required = frozenset(schema.get("required", ()))
+        def check(value):
+            if not isinstance(value, dict): raise ValueError(f"{path}: ожидался объект")
+            result = {}
+            for name, check_field, has_default, default in fields:
+                if value.get(name) is not None: result[name] = check_field(value[name])
+                elif has_default: result[name] = copy.copy(default)
+                elif name in required: raise ValueError(f"{path}.{name}: нет обязательного поля")
+            return result
+    elif kind == "array":
+        check_item = compile_schema(schema.get("items", {}), f"{path}[]")
+        def check(value):
+            if not isinstance(value, list): raise ValueError(f"{path}: ожидался массив")
+            return [check_item(item) for item in value]
+    elif kind in ("number", "integer"):
+        minimum = schema.get("minimum")
+        def check(value):
+            if isinstance(value, str) and (match := _NUMERIC_STRING_RE.match(value)):
+                value = float(match.group(1).replace(",", ".")); value = int(value) if value.is_integer() else value
+            if isinstance(value, bool) or not isinstance(value, (int, float)) or not math.isfinite(value): raise ValueError(f"{path}: ожидалось число, получено {value!r}")
+            if kind == "integer":
+                if value != int(value): raise ValueError(f"{path}: ожидалось целое число")
+                value = int(value)
+            if minimum is not None and value < minimum: raise ValueError(f"{path}: {value} меньше {minimum}")
+            return value
+    elif kind == "string":
+        def check(value):
+            if isinstance(value, str): return value
+            if isinstance(value, (int, float)) and not isinstance(value, bool): return f"{value:g}"
+            raise ValueError(f"{path}: ожидалась строка")
+    else: check = lambda value: value
+    return check
+
+MEAL_ESTIMATE_VALIDATOR = compile_schema(MEAL_ESTIMATE_SCHEMA)
+IMPORT_MEAL_VALIDATOR = compile_schema(IMPORT_MEAL_SCHEMA)
+
+def json_response_format(schema: dict) -> dict | None:
+    """response_format для Groq по GROQ_JSON_MODE. json_object принимает только объект верхнего уровня и требует слово JSON в промпте."""
+    if GROQ_JSON_MODE == "json_schema": return {"type": "json_schema", "json_schema": {"name": schema["title"], "schema": schema}}
+    return {"type": "json_object"} if GROQ_JSON_MODE == "json_object" else None
+
+def repair_json(text: str):
+    """Чинит типичные поломки ответа модели: текст вокруг JSON, висячие запятые и обрыв на середине
+    (отрезает недописанный элемент и закрывает скобки). Возвращает разобранный объект или None.
+    При обрыве внутри массива отбрасывается весь недописанный элемент внешнего открытого массива, а не только его хвост:
+    из '{"items":[{...},{"name":"b","cal' получится '{"items":[{...}]}', а не объект без КБЖУ."""
+    start = min((i for i in (text.find("{"), text.find("[")) if i >= 0), default=-1)
+    if start < 0: return None
+    out, closers, in_string, escaped = [], "", False, False
+    safe = [] # safe[d] - (длина out, незакрытые скобки) после последнего целого элемента контейнера closers[d]
+    for ch in text[start:]:
+        if in_string:
+            out.append(ch)
+            if escaped: escaped = False
+            elif ch == "\\": escaped = True
+            elif ch == '"': in_string = False
+            continue
+        if ch == '"': in_string = True
+        elif ch in "{[":
+            closers += "}" if ch == "{" else "]"
+            safe.append((len(out) + 1, closers) if ch == "[" else None) # Пустой массив - тоже целый
+        elif ch in "}]":
+            if not closers or ch != closers[-1]: return None
+            while out and out[-1].isspace(): out.pop()
+            if out and out[-1] == ",": out.pop() # Висячая запятая перед скобкой
+            out.append(ch); closers = closers[:-1]; safe.pop()
+            if not closers: break # Текст после закрывающей скобки не нужен
+            safe[-1] = (len(out), closers); continue
+        elif ch == ",": safe[-1] = (len(out), closers) # Запятая своего уровня: элементы вложенных контейнеров сюда не попадают
+        out.append(ch)
+    else:
+        outer_array = closers.find("]")
+        point = safe[outer_array] if outer_array >= 0 else next((p for p in reversed(safe) if p is not None), None)
+        if point is None: return None
+        length, closers = point
+        out = out[:length] + list(reversed(closers))
+    try: return json.loads("".join(out))
+    except json.JSONDecodeError: return None
+
+def parse_ai_json(reply: str, validator=None):
+    """JSON из ответа модели: как есть, иначе после repair_json; затем validator, если задан. None - ответ не удалось использовать."""
+    text = reply.strip().removeprefix("```json").removeprefix("```").removesuffix("```").strip()
+    try: data, result = json.loads(text), "ok"
+    except json.JSONDecodeError: data, result = repair_json(text), "repaired"
+    if data is not None and validator is not None:
+        try: data = validator(data)
+        except ValueError as e: logger.info("Ответ AI не прошел проверку схемы: %s", e); data = None
+    _ai_json_counters["invalid" if data is None else result] += 1
+    return data
+
+def ai_json_stats() -> dict:
+    replies = _ai_json_counters["ok"] + _ai_json_counters["repaired"] + _ai_json_counters["invalid"]
+    return {**_ai_json_counters, "rerequest_rate": round(_ai_json_counters["rerequested"] / replies, 3) if replies else 0.0}
+
+# --- Кэш оценок КБЖУ (LRU + TTL, с сохранением на диск) ---
+MEAL_CACHE_PATH = os.getenv("MEAL_CACHE_PATH", "meal_cache.json")
+MEAL_CACHE_MAX_ENTRIES = int(os.getenv("MEAL_CACHE_MAX_ENTRIES", "5000"))
+MEAL_CACHE_TTL = float(os.getenv("MEAL_CACHE_TTL_DAYS", "30")) * 86400
+MEAL_CACHE_SAVE_EVERY = int(os.getenv("MEAL_CACHE_SAVE_EVERY", "50")) # Сохранять на диск после N новых записей
+_MEAL_ITEM_SPLIT_RE = re.compile(r"[,;\n]+")
+_MEAL_UNIT_RE = re.compile(r"(\d+(?:[.,]\d+)?)\s*(граммов|грамма|грамм|гр|г|g|gr|килограммов|килограмма|килограмм|кг|kg|миллилитров|миллилитра|миллилитр|мл|ml|литров|литра|литр|л|l|штук|штуки|штука|шт|pcs)(?=\W|$)")
+_MEAL_UNIT_CANON = {"граммов": "г", "грамма": "г", "грамм": "г", "гр": "г", "g": "г", "gr": "г", "килограммов": "кг", "килограмма": "кг", "килограмм": "кг", "kg": "кг", "миллилитров": "мл", "миллилитра": "мл", "миллилитр": "мл", "ml": "мл", "литров": "л", "литра": "л", "литр": "л", "l": "л", "штук": "шт", "штуки": "шт", "штука": "шт", "pcs": "шт"}
+_MEAL_QTY_TOKEN_RE = re.compile(r"^\d+(?:\.\d+)?(?:г|кг|мл|л|шт)?$")
+
+def normalize_meal_description(text: str) -> str:
+    """Ключ кэша: регистр, пробелы, порядок продуктов через запятую и написание единиц не важны."""
+    text = text.lower().replace("ё", "е")
+    text = _MEAL_UNIT_RE.sub(lambda m: m.group(1).replace(",", ".") + _MEAL_UNIT_CANON.get(m.group(2), m.group(2)), text)
+    items = []
+    for raw_item in _MEAL_ITEM_SPLIT_RE.split(text):
+        tokens = re.findall(r"[\w.]+", raw_item)
+        if not tokens: continue
+        name_tokens = [t for t in tokens if not _MEAL_QTY_TOKEN_RE.match(t)]
+        qty_tokens = [t for t in tokens if _MEAL_QTY_TOKEN_RE.match(t)]
+        items.append(" ".join(name_tokens + qty_tokens))
+    return "|".join(sorted(items))
+
+class MealEstimateCache:
+    """LRU-кэш с TTL для проверенных ответов AI ({items, total}), переживающий рестарт через JSON-файл."""
+    def __init__(self, path: str, max_entries: int, ttl: float, save_every: int):
+        self.path, self.max_entries, self.ttl, self.save_every = path, max_entries, ttl, save_every
+        self._entries: OrderedDict[str, tuple[float, dict]] = OrderedDict()
+        self._unsaved = 0
+        self.hits = self.misses = self.expired = self.evictions = 0
+    def get(self, key: str) -> dict | None:
+        entry = self._entries.get(key)
+        if entry is None:
+            self.misses += 1; return None
+        stored_at, value = entry
+        if time.time() - stored_at > self.ttl:
+            del self._entries[key]; self.expired += 1; self.misses += 1; return None
+        self._entries.move_to_end(key); self.hits += 1
+        return copy.deepcopy(value)
+    def put(self, key: str, value: dict) -> None:
+        self._entries[key] = (time.time(), copy.deepcopy(value)); self._entries.move_to_end(key)
+        while len(self._entries) > self.max_entries:
+            self._entries.popitem(last=False); self.evictions += 1
+        self._unsaved += 1
+    @property
+    def needs_save(self) -> bool: return self._unsaved >= self.save_every
+    def stats(self) -> dict:
+        lookups = self.hits + self.misses
+        return {"entries": len(self._entries), "hits": self.hits, "misses": self.misses, "expired": self.expired, "evictions": self.evictions, "hit_rate": round(self.hits / lookups, 3) if lookups else 0.0}
+    def load(self) -> None:
+        try:
+            with open(self.path, encoding="utf-8") as f: raw_entries = json.load(f)
+        except FileNotFoundError: return
+        except (OSError, ValueError) as e:
+            logger.warning("Не удалось прочитать кэш оценок КБЖУ %s: %s. Начинаем с пустого кэша.", self.path, e); return
+        if not isinstance(raw_entries, list):
+            logger.warning("Кэш оценок КБЖУ %s: ожидался список записей. Начинаем с пустого кэша.", self.path); return
+        now, skipped = time.time(), 0
+        for entry in raw_entries[-self.max_entries:]: # Файл хранится от старых к новым
+            try:
+                key, stored_at, value = entry
+                if not isinstance(key, str) or not isinstance(value, dict): raise TypeError(f"запись {key!r}")
+                stored_at = float(stored_at)
+            except (TypeError, ValueError): skipped += 1; continue # Битая запись не мешает загрузить остальные
+            if now - stored_at <= self.ttl: self._entries[key] = (stored_at, value)
+        if skipped: logger.warning("Кэш оценок КБЖУ %s: пропущено битых записей: %s.", self.path, skipped)
+        logger.info("Кэш оценок КБЖУ загружен: %s записей из %s.", len(self._entries), self.path)
+    def save(self) -> None:
+        snapshot = [[key, stored_at, value] for key, (stored_at, value) in list(self._entries.items())]
+        self._unsaved = 0
+        tmp_path = f"{self.path}.{os.getpid()}.tmp" # Свой временный файл у каждого процесса: воркеры вебхука сохраняют кэш одновременно
+        try:
+            with open(tmp_path, "w", encoding="utf-8") as f: json.dump(snapshot, f, ensure_ascii=False)
+            os.replace(tmp_path, self.path) # Атомарная замена, чтобы не оставить битый файл при падении
+        except OSError as e:
+            logger.error("Не удалось сохранить кэш оценок КБЖУ в %s: %s", self.path, e)
+            try: os.remove(tmp_path)
+            except OSError: pass
+
+MEAL_CACHE = MealEstimateCache(MEAL_CACHE_PATH, MEAL_CACHE_MAX_ENTRIES, MEAL_CACHE_TTL, MEAL_CACHE_SAVE_EVERY)
+register_metric(CallbackMetric("fitbot_meal_cache_lookups_total", "Обращения к кэшу оценок КБЖУ (hit/miss)", lambda: {"hit": MEAL_CACHE.hits, "miss": MEAL_CACHE.misses}, "counter", ("result",)))
+register_metric(CallbackMetric("fitbot_meal_cache_entries", "Записей в кэше оценок КБЖУ", lambda: len(MEAL_CACHE._entries)))
+
+# --- Локальная таблица КБЖУ (продукты из неё оцениваются без AI) ---
+NUTRITION_DB_PATH = os.getenv("NUTRITION_DB_PATH") # Необязательный CSV с дополнительными продуктами
+FOOD_INDEX = FoodIndex(FOODS)
+if NUTRITION_DB_PATH:
+    try: logger.info("Загружено %s продуктов из %s. Всего в таблице КБЖУ: %s.", FOOD_INDEX.load_csv(NUTRITION_DB_PATH), NUTRITION_DB_PATH, len(FOOD_INDEX))
+    except OSError as e: logger.error("Не удалось загрузить таблицу КБЖУ %s: %s", NUTRITION_DB_PATH, e)
+
+# --- Хранение user_data в SQLite (WAL, ленивая загрузка, запись только изменившихся пользователей) ---
+BOT_DB_PATH = os.getenv("BOT_DB_PATH", "fitness_bot.db") # Пустая строка - без сохранения данных между рестартами
+PERSISTENCE_FLUSH_INTERVAL = float(os.getenv("PERSISTENCE_FLUSH_INTERVAL", "60"))
+PERSISTENCE_WRITE_RETRIES = int(os.getenv("PERSISTENCE_WRITE_RETRIES", "5")) # Повторов неудачной записи (database is locked и т.п.) с паузой 2, 4, 8... с
+SHARED_LEASE_TTL = float(os.getenv("SHARED_LEASE_TTL", "180")) # Сколько секунд воркер может держать пользователя (дольше самого долгого AI-ответа)
+_PROFILE_COLUMNS = (GENDER, AGE, HEIGHT, CURRENT_WEIGHT, ACTIVITY_LEVEL, GOAL, BMI, BMR, TDEE, TARGET_CALORIES, PROFILE_COMPLETE, LAST_MEAL_DATE, TIMEZONE)
+_MEAL_COLUMNS = ("meal_name", "user_description", "timestamp")
+_SQLITE_SCHEMA = f"""
+CREATE TABLE IF NOT EXISTS profiles (user_id INTEGER PRIMARY KEY, {", ".join(f"{c}" for c in _PROFILE_COLUMNS)}, extra TEXT, updated_at REAL NOT NULL, version INTEGER NOT NULL DEFAULT 0);
+CREATE TABLE IF NOT EXISTS today_meals (user_id INTEGER NOT NULL, position INTEGER NOT NULL, meal_name TEXT, user_description TEXT, timestamp TEXT, calories NUMERIC, protein NUMERIC, fat NUMERIC, carbs NUMERIC, items TEXT, PRIMARY KEY (user_id, position)) WITHOUT ROWID;
+CREATE TABLE IF NOT EXISTS conversations (name TEXT NOT NULL, conv_key TEXT NOT NULL, state INTEGER, PRIMARY KEY (name, conv_key)) WITHOUT ROWID;
+CREATE TABLE IF NOT EXISTS user_leases (user_id INTEGER PRIMARY KEY, owner TEXT NOT NULL, expires_at REAL NOT NULL) WITHOUT ROWID;
+CREATE TABLE IF NOT EXISTS job_leases (name TEXT PRIMARY KEY, owner TEXT NOT NULL, expires_at REAL NOT NULL) WITHOUT ROWID;
+"""
+
+def _epoch(value) -> float:
+    """Время приема пищи из базы: секунды epoch (колонка TEXT хранит их строкой) или ISO-строка записей до перехода на числовое время."""
+    try: return float(value or 0)
+    except ValueError: pass
+    try: return datetime.fromisoformat(value).timestamp()
+    except ValueError: return 0.0
+
+def open_bot_db(path: str) -> sqlite3.Connection:
+    """Соединение с общей базой бота; запросы выполняются в потоках через asyncio.to_thread."""
+    conn = sqlite3.connect(path, check_same_thread=False, timeout=30, uri=path.startswith("file:")) # file:...?mode=memory&cache=shared - общая база в памяти для проверок
+    conn.execute("PRAGMA journal_mode=WAL"); conn.execute("PRAGMA synchronous=NORMAL")
+    return conn
+
+class SQLitePersistence(BasePersistence):
+    """Профили и TODAY_MEALS в таблицах SQLite. user_data пользователя читается из базы при первом обращении
+    (refresh_user_data), а при сбросе пишутся только пользователи, чьи данные реально изменились с прошлой записи.
+    shared=True - базу делят несколько процессов: версия профиля сверяется перед каждым апдейтом, а пользователь
+    на время обработки захватывается арендой в user_leases, чтобы его апдейты не шли в двух воркерах одновременно."""
+    def __init__(self, path: str, update_interval: float = 60, shared: bool = False):
+        super().__init__(store_data=PersistenceInput(bot_data=False, chat_data=False, user_data=True, callback_data=False), update_interval=update_interval)
+        self.path, self.shared = path, shared
+        self.owner = f"{os.uname().nodename}:{os.getpid()}"
+        self._conn = open_bot_db(path)
+        self._db_lock = threading.Lock()
+        with self._db_lock, self._conn:
+            self._conn.executescript(_SQLITE_SCHEMA)
+            columns = {row[1] for row in self._conn.execute("PRAGMA table_info(profiles)")}
+            for column in _PROFILE_COLUMNS: # База от версии, где этой колонки профиля еще не было (например, timezone)
+                if column not in columns: self._conn.execute(f"ALTER TABLE profiles ADD COLUMN {column}")
+            if "version" not in columns: # База от версии без общего режима
+                self._conn.execute("ALTER TABLE profiles ADD COLUMN version INTEGER NOT NULL DEFAULT 0")
+            self._conn.execute(f"CREATE INDEX IF NOT EXISTS profiles_day ON profiles ({TIMEZONE}, {LAST_MEAL_DATE})")
+        self._loaded_users: set[int] = set()
+        self._versions: dict[int, int] = {} # user_id -> версия профиля, с которой синхронизирован этот процесс
+        self._written: dict[int, tuple[int, int]] = {} # user_id -> (хэш профиля, хэш приемов пищи) последней записи
+        self._pending_users: dict[int, tuple[tuple | None, list | None]] = {}
+        self._pending_conversations: dict[tuple[str, str], object] = {}
+        self._write_task: asyncio.Task | None = None
+        self.flush_stats = {"flushes": 0, "users_written": 0, "users_skipped": 0}
+
+    def _run(self, fn, *args):
+        with self._db_lock: return fn(*args)
+
+    # --- Чтение ---
+    def _load_user(self, user_id: int, known_version: int | None = None) -> tuple[int | None, dict | None]:
+        """(версия, данные); если версия в базе равна known_version, данные не читаются и возвращается (версия, None)."""
+        row = self._conn.execute(f"SELECT {', '.join(_PROFILE_COLUMNS)}, extra, version FROM profiles WHERE user_id = ?", (user_id,)).fetchone()
+        if row is None: return None, None
+        version, row = row[-1], row[:-1]
+        if version == known_version: return version, None
+        data = json.loads(row[-1]) if row[-1] else {}
+        data.update({key: value for key, value in zip(_PROFILE_COLUMNS, row) if value is not None})
+        if PROFILE_COMPLETE in data: data[PROFILE_COMPLETE] = bool(data[PROFILE_COMPLETE])
+        meals = self._conn.execute("SELECT meal_name, user_description, timestamp, calories, protein, fat, carbs, items FROM today_meals WHERE user_id = ? ORDER BY position", (user_id,)).fetchall()
+        data[TODAY_MEALS] = MealLog(MealRecord.from_estimate(name, description, {"items": json.loads(items) if items else [], "total": {"calories": kcal, "protein": protein, "fat": fat, "carbs": carbs}}, _epoch(ts)) for name, description, ts, kcal, protein, fat, carbs, items in meals)
+        return version, data
+    async def get_user_data(self) -> dict:
+        return {} # Пользователи подгружаются лениво в refresh_user_data, старт не зависит от их числа
+    async def refresh_user_data(self, user_id: int, user_data: dict) -> None:
+        if self.shared: # Другой воркер мог изменить пользователя - сверяем версию на каждом апдейте
+            known = self._versions.get(user_id)
+            version, stored = await asyncio.to_thread(self._run, self._load_user, user_id, known)
+            if version == known: return
+            user_data.clear(); user_data.update(stored or {})
+            self._versions[user_id] = version; self._written[user_id] = self._digest(user_data)
+            return
+        if user_id in self._loaded_users: return
+        _, stored = await asyncio.to_thread(self._run, self._load_user, user_id)
+        self._loaded_users.add(user_id)
+        if stored is None: return
+        for key, value in stored.items(): user_data.setdefault(key, value)
+        self._written[user_id] = self._digest(user_data)
+    async def read_conversation_states(self, keys: list[tuple[str, tuple]]) -> dict[tuple[str, tuple], object]:
+        """Состояния нескольких диалогов одним запросом: {(имя, ключ): состояние}; диалогов без записи в ответе нет."""
+        def query():
+            where = " OR ".join(["(name = ? AND conv_key = ?)"] * len(keys))
+            return self._conn.execute(f"SELECT name, conv_key, state FROM conversations WHERE {where}", [v for name, key in keys for v in (name, json.dumps(key))]).fetchall()
+        rows = await asyncio.to_thread(self._run, query) if keys else []
+        return {(name, tuple(json.loads(key))): state for name, key, state in rows}
+    async def get_conversations(self, name: str) -> dict:
+        rows = await asyncio.to_thread(self._run, lambda: self._conn.execute("SELECT conv_key, state FROM conversations WHERE name = ?", (name,)).fetchall())
+        return {tuple(json.loads(key)): state for key, state in rows}
+    async def get_chat_data(self) -> dict: return {}
+    async def get_bot_data(self) -> dict: return {}
+    async def get_callback_data(self) -> None: return None
+
+    # --- Запись ---
+    @staticmethod
+    def _split(data: dict) -> tuple[tuple, list]:
+        profile = tuple(data.get(key) for key in _PROFILE_COLUMNS)
+        extra = {key: value for key, value in data.items() if key not in _PROFILE_COLUMNS and key != TODAY_MEALS}
+        meals = [(m.meal_name, m.description, m.timestamp, *m.totals, json.dumps(m.items_as_dicts(), ensure_ascii=False)) for m in data.get(TODAY_MEALS) or ()]
+        return profile + (json.dumps(extra, ensure_ascii=False, default=str) if extra else None,), meals
+    def _digest(self, data: dict) -> tuple[int, int]:
+        profile, meals = self._split(data)
+        return hash(profile), hash(tuple(meals))
+    async def update_user_data(self, user_id: int, data: dict) -> None:
+        profile, meals = self._split(data)
+        profile_hash, meals_hash = hash(profile), hash(tuple(meals))
+        old_profile_hash, old_meals_hash = self._written.get(user_id, (None, None))
+        if profile_hash == old_profile_hash and meals_hash == old_meals_hash:
+            self.flush_stats["users_skipped"] += 1; return
+        self._written[user_id] = (profile_hash, meals_hash)
+        # Профиль пишется при любом изменении: вместе с ним растет версия, по которой другие воркеры видят изменения
+        self._pending_users[user_id] = (profile if self.shared or profile_hash != old_profile_hash else None, meals if meals_hash != old_meals_hash else None)
+        self._schedule_write()
+    async def drop_user_data(self, user_id: int) -> None:
+        self._written.pop(user_id, None); self._loaded_users.discard(user_id); self._versions.pop(user_id, None)
+        self._pending_users[user_id] = (None, None) # (None, None) в очереди - удаление пользователя
+        self._schedule_write()
+    async def update_conversation(self, name: str, key: tuple, new_state: object | None) -> None:
+        self._pending_conversations[(name, json.dumps(key))] = new_state
+        self._schedule_write()
+    async def update_chat_data(self, chat_id: int, data: dict) -> None: pass
+    async def update_bot_data(self, data: dict) -> None: pass
+    async def update_callback_data(self, data) -> None: pass
+    async def drop_chat_data(self, chat_id: int) -> None: pass
+    async def refresh_chat_data(self, chat_id: int, chat_data: dict) -> None: pass
+    async def refresh_bot_data(self, bot_data: dict) -> None: pass
+
+    def _schedule_write(self) -> None:
+        # Все update_* одного цикла update_persistence попадают в одну транзакцию
+        if self._write_task is None or self._write_task.done(): self._write_task = asyncio.create_task(self._write_pending())
+    async def _write_pending(self) -> None:
+        await asyncio.sleep(0)
+        failures = 0
+        while self._pending_users or self._pending_conversations: # То, что добавилось во время записи, уходит следующей транзакцией
+            users, self._pending_users = self._pending_users, {}
+            conversations, self._pending_conversations = self._pending_conversations, {}
+            try: await asyncio.to_thread(self._run, self._write_batch, users, conversations)
+            except sqlite3.Error as e:
+                self._requeue(users, conversations); failures += 1
+                if failures > PERSISTENCE_WRITE_RETRIES:
+                    logger.error("Запись в SQLite не удалась %s раз подряд (%s); %s пользователей и %s диалогов ждут следующей записи.", failures, e, len(self._pending_users), len(self._pending_conversations)); return
+                delay = min(2.0 ** failures, self.update_interval)
+                logger.warning("Не удалось записать в SQLite %s пользователей и %s диалогов (%s), повтор через %.1f с.", len(users), len(conversations), e, delay)
+                await asyncio.sleep(delay)
+    def _requeue(self, users: dict, conversations: dict) -> None:
+        """Возвращает незаписанную пачку в очередь. Пришедшее во время записи новее и остается; хэши последней записи
+        сбрасываются, иначе следующий update_user_data счел бы этих пользователей уже записанными."""
+        for user_id, (profile, meals) in users.items():
+            self._written.pop(user_id, None)
+            newer = self._pending_users.get(user_id)
+            if newer is None: self._pending_users[user_id] = (profile, meals)
+            elif newer != (None, None) and (profile, meals) != (None, None): # Частичная запись поверх незаписанной - дополняем ее недостающей частью
+                self._pending_users[user_id] = (newer[0] if newer[0] is not None else profile, newer[1] if newer[1] is not None else meals)
+        for key, state in conversations.items(): self._pending_conversations.setdefault(key, state)
+    def _write_batch(self, users: dict, conversations: dict) -> None:
+        now = time.time()
+        with self._conn:
+            for user_id, (profile, meals) in users.items():
+                if profile is None and meals is None:
+                    self._conn.execute("DELETE FROM profiles WHERE user_id = ?", (user_id,)); self._conn.execute("DELETE FROM today_meals WHERE user_id = ?", (user_id,)); continue
+                if profile is not None:
+                    columns = (*_PROFILE_COLUMNS, "extra", "updated_at")
+                    self._versions[user_id] = self._conn.execute(f"INSERT INTO profiles (user_id, {', '.join(columns)}) VALUES ({', '.join('?' * (len(columns) + 1))}) ON CONFLICT(user_id) DO UPDATE SET {', '.join(f'{c} = excluded.{c}' for c in columns)}, version = profiles.version + 1 RETURNING version", (user_id, *profile, now)).fetchone()[0]
+                if meals is not None:
+                    self._conn.execute("DELETE FROM today_meals WHERE user_id = ?", (user_id,))
+                    self._conn.executemany("INSERT INTO today_meals VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?)", [(user_id, position, *meal) for position, meal in enumerate(meals)])
+            for (name, key), state in conversations.items():
+                if state is None: self._conn.execute("DELETE FROM conversations WHERE name = ? AND conv_key = ?", (name, key))
+                else: self._conn.execute("INSERT OR REPLACE INTO conversations VALUES (?, ?, ?)", (name, key, state))
+        self.flush_stats["flushes"] += 1; self.flush_stats["users_written"] += len(users)
+    async def wait_written(self) -> None:
+        """Дожидается записи всего, что уже передано через update_*."""
+        while self._write_task is not None and not self._write_task.done(): await self._write_task
+    async def flush(self) -> None:
+        if self._write_task is not None: await self._write_task
+        await self._write_pending()
+        logger.info("SQLite-хранилище сброшено на диск. Статистика: %s", self.flush_stats)
+
+    # --- Аренда пользователя между процессами (shared=True) ---
+    def _try_lease(self, user_id: int) -> bool:
+        now = time.time()
+        with self._conn:
+            return self._conn.execute("INSERT INTO user_leases VALUES (?, ?, ?) ON CONFLICT(user_id) DO UPDATE SET owner = excluded.owner, expires_at = excluded.expires_at WHERE user_leases.expires_at < ?", (user_id, self.owner, now + SHARED_LEASE_TTL, now)).rowcount == 1
+    async def acquire_user_lease(self, user_id: int) -> None:
+        delay = 0.02
+        while not await asyncio.to_thread(self._run, self._try_lease, user_id): # Пользователя обрабатывает другой воркер
+            await asyncio.sleep(delay); delay = min(delay * 2, 0.5)
+    async def release_user_lease(self, user_id: int) -> None:
+        def release():
+            with self._conn: self._conn.execute("DELETE FROM user_leases WHERE user_id = ? AND owner = ?", (user_id, self.owner))
+        await asyncio.to_thread(self._run, release)
+    def _try_job_lease(self, name: str, ttl: float) -> bool:
+        now = time.time()
+        with self._conn:
+            return self._conn.execute("INSERT INTO job_leases VALUES (?, ?, ?) ON CONFLICT(name) DO UPDATE SET expires_at = excluded.expires_at, owner = excluded.owner WHERE job_leases.expires_at < ? OR job_leases.owner = excluded.owner", (name, self.owner, now + ttl, now)).rowcount == 1
+    async def acquire_job_lease(self, name: str, ttl: float) -> bool:
+        """Фоновую задачу name выполняет один воркер: владелец продлевает аренду каждым запуском, после его падения ее через ttl заберет другой."""
+        return await asyncio.to_thread(self._run, self._try_job_lease, name, ttl)
+
+    # --- Смена дня прямо в базе (задача rollover_days): пользователи, которых нет в памяти, тоже не копят вчерашние приемы пищи ---
+    def _profile_timezones(self) -> list[str | None]:
+        return [row[0] for row in self._conn.execute(f"SELECT DISTINCT {TIMEZONE} FROM profiles")]
+    def _finalize_days_batch(self, zone: str | None, today: str, limit: int) -> int:
+        now = time.time()
+        with self._conn:
+            user_ids = [(user_id,) for user_id, in self._conn.execute(f"SELECT user_id FROM profiles WHERE {TIMEZONE} IS ? AND {LAST_MEAL_DATE} < ? AND user_id NOT IN (SELECT user_id FROM user_leases WHERE expires_at > ?) LIMIT ?", (zone, today, now, limit))]
+            self._conn.executemany(f"UPDATE profiles SET {LAST_MEAL_DATE} = ?, updated_at = ?, version = version + 1 WHERE user_id = ?", [(today, now, user_id) for user_id, in user_ids])
+            self._conn.executemany("DELETE FROM today_meals WHERE user_id = ?", user_ids)
+        return len(user_ids)
+    async def finalize_stale_days(self, batch: int) -> int:
+        """Закрывает прошедшие дни по часовому поясу каждого пользователя, пачками по batch пользователей на транзакцию.
+        Захваченные другим воркером пользователи пропускаются до следующего запуска; растущая версия заставит воркеры перечитать профиль."""
+        finalized = 0
+        for zone in await asyncio.to_thread(self._run, self._profile_timezones):
+            today = datetime.now(get_timezone(zone)).date().isoformat()
+            while True:
+                count = await asyncio.to_thread(self._run, self._finalize_days_batch, zone, today, batch)
+                finalized += count
+                if count < batch: break
+        return finalized
+
+# --- Архив приемов пищи и инкрементальные итоги по дням/неделям/месяцам ---
+_ROLLUP_SCHEMA = """
+CREATE TABLE IF NOT EXISTS meal_archive (id INTEGER PRIMARY KEY, user_id INTEGER NOT NULL, day TEXT NOT NULL, meal_name TEXT, user_description TEXT, timestamp TEXT, calories NUMERIC, protein NUMERIC, fat NUMERIC, carbs NUMERIC, items TEXT);
+CREATE TABLE IF NOT EXISTS daily_totals (user_id INTEGER NOT NULL, period TEXT NOT NULL, calories NUMERIC NOT NULL, protein NUMERIC NOT NULL, fat NUMERIC NOT NULL, carbs NUMERIC NOT NULL, meals INTEGER NOT NULL, days INTEGER NOT NULL, PRIMARY KEY (user_id, period)) WITHOUT ROWID;
+CREATE TABLE IF NOT EXISTS weekly_totals (user_id INTEGER NOT NULL, period TEXT NOT NULL, calories NUMERIC NOT NULL, protein NUMERIC NOT NULL, fat NUMERIC NOT NULL, carbs NUMERIC NOT NULL, meals INTEGER NOT NULL, days INTEGER NOT NULL, PRIMARY KEY (user_id, period)) WITHOUT ROWID;
+CREATE TABLE IF NOT EXISTS monthly_totals (user_id INTEGER NOT NULL, period TEXT NOT NULL, calories NUMERIC NOT NULL, protein NUMERIC NOT NULL, fat NUMERIC NOT NULL, carbs NUMERIC NOT NULL, meals INTEGER NOT NULL, days INTEGER NOT NULL, PRIMARY KEY (user_id, period)) WITHOUT ROWID;
+"""
+_IMPORT_SCHEMA = """
+CREATE TABLE IF NOT EXISTS import_jobs (id INTEGER PRIMARY KEY, user_id INTEGER NOT NULL, chat_id INTEGER NOT NULL, message_id INTEGER, path TEXT NOT NULL, total_lines INTEGER NOT NULL, byte_offset INTEGER NOT NULL DEFAULT 0, lines_done INTEGER NOT NULL DEFAULT 0, imported INTEGER NOT NULL DEFAULT 0, failed INTEGER NOT NULL DEFAULT 0, skipped INTEGER NOT NULL DEFAULT 0, status TEXT NOT NULL, owner TEXT, created_at REAL NOT NULL, updated_at REAL NOT NULL);
+CREATE INDEX IF NOT EXISTS import_jobs_status ON import_jobs (status, user_id);
+"""
+_IMPORT_JOB_COLUMNS = ("id", "user_id", "chat_id", "message_id", "path", "total_lines", "byte_offset", "lines_done", "imported", "failed", "skipped", "status")
+STATS_PERIODS = (7, 30, 365)
+
+def _rollup_periods(start: date, end: date) -> dict[str, list[str]]:
+    """Покрывает [start, end] минимальным набором месяцев, недель (пн-вс) и дней: не больше ~70 строк для любого окна до года."""
+    periods = {"monthly_totals": [], "weekly_totals": [], "daily_totals": []}
+    d = start
+    while d <= end:
+        next_month = (d.replace(day=28) + timedelta(days=4)).replace(day=1)
+        if d.day == 1 and next_month - timedelta(days=1) <= end: periods["monthly_totals"].append(d.isoformat()); d = next_month
+        elif d.weekday() == 0 and d + timedelta(days=6) <= end: periods["weekly_totals"].append(d.isoformat()); d += timedelta(days=7)
+        else: periods["daily_totals"].append(d.isoformat()); d += timedelta(days=1)
+    return periods
+
+class MealHistory:
+    """Append-only архив приемов пищи. Итоги за день, неделю и месяц обновляются при каждой записи (O(1)),
+    поэтому /stats за любой период читает только агрегаты, не пересчитывая сырые записи."""
+    def __init__(self, path: str):
+        self._conn = open_bot_db(path)
+        self._db_lock = threading.Lock()
+        with self._db_lock, self._conn: self._conn.executescript(_ROLLUP_SCHEMA + _IMPORT_SCHEMA)
+    def _insert(self, user_id: int, day: date, meal: MealRecord) -> None:
+        """Запись в архив и итоги; вызывается внутри транзакции."""
+        values = tuple(meal.totals)
+        week, month = day - timedelta(days=day.weekday()), day.replace(day=1)
+        self._conn.execute("INSERT INTO meal_archive (user_id, day, meal_name, user_description, timestamp, calories, protein, fat, carbs, items) VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?)", (user_id, day.isoformat(), meal.meal_name, meal.description, datetime.fromtimestamp(meal.timestamp).isoformat(), *values, json.dumps(meal.items_as_dicts(), ensure_ascii=False)))
+        new_day = self._conn.execute("SELECT 1 FROM daily_totals WHERE user_id = ? AND period = ?", (user_id, day.isoformat())).fetchone() is None
+        for table, period in (("daily_totals", day), ("weekly_totals", week), ("monthly_totals", month)):
+            self._conn.execute(f"INSERT INTO {table} VALUES (?, ?, ?, ?, ?, ?, 1, ?) ON CONFLICT(user_id, period) DO UPDATE SET calories = calories + excluded.calories, protein = protein + excluded.protein, fat = fat + excluded.fat, carbs = carbs + excluded.carbs, meals = meals + 1, days = days + excluded.days", (user_id, period.isoformat(), *values, int(new_day)))
+    def _record(self, user_id: int, day: date, meal: MealRecord) -> None:
+        with self._db_lock, self._conn: self._insert(user_id, day, meal)
+    async def record_meal(self, user_id: int, day: date, meal: MealRecord) -> None:
+        await asyncio.to_thread(self._record, user_id, day, meal)
+
+    # --- Задания импорта (import_jobs): прогресс пишется в той же транзакции, что и импортированные приемы пищи ---
+    def _import_job(self, where: str, params: tuple) -> dict | None:
+        row = self._conn.execute(f"SELECT {', '.join(_IMPORT_JOB_COLUMNS)} FROM import_jobs WHERE {where}", params).fetchone()
+        return dict(zip(_IMPORT_JOB_COLUMNS, row)) if row else None
+    def _create_import(self, user_id: int, chat_id: int, message_id: int, path: str, total_lines: int, owner: str) -> dict:
+        now = time.time()
+        with self._db_lock, self._conn:
+            job_id = self._conn.execute("INSERT INTO import_jobs (user_id, chat_id, message_id, path, total_lines, status, owner, created_at, updated_at) VALUES (?, ?, ?, ?, ?, 'running', ?, ?, ?)", (user_id, chat_id, message_id, path, total_lines, owner, now, now)).lastrowid
+            return self._import_job("id = ?", (job_id,))
+    async def create_import(self, user_id: int, chat_id: int, message_id: int, path: str, total_lines: int, owner: str) -> dict:
+        return await asyncio.to_thread(self._create_import, user_id, chat_id, message_id, path, total_lines, owner)
+    async def active_import(self, user_id: int) -> dict | None:
+        def query():
+            with self._db_lock: return self._import_job("user_id = ? AND status IN ('running', 'paused') ORDER BY id LIMIT 1", (user_id,))
+        return await asyncio.to_thread(query)
+    def _claim_imports(self, owner: str, stale_before: float, user_id: int | None, include_paused: bool) -> list[dict]:
+        """Забирает незавершенные задания без владельца или с владельцем, не писавшим прогресс с stale_before (и приостановленные, если include_paused)."""
+        with self._db_lock, self._conn:
+            rows = self._conn.execute("UPDATE import_jobs SET owner = ?, status = 'running', updated_at = ? WHERE ((status = 'running' AND (owner IS NULL OR owner = ? OR updated_at < ?)) OR (status = 'paused' AND ?)) AND (? IS NULL OR user_id = ?) RETURNING id",
+                                      (owner, time.time(), owner, stale_before, include_paused, user_id, user_id)).fetchall()
+            return [self._import_job("id = ?", (job_id,)) for job_id, in rows]
+    async def claim_imports(self, owner: str, stale_before: float, user_id: int | None = None, include_paused: bool = False) -> list[dict]:
+        return await asyncio.to_thread(self._claim_imports, owner, stale_before, user_id, include_paused)
+    def _record_import_batch(self, job: dict, meals: list[tuple[date, MealRecord]]) -> None:
+        with self._db_lock, self._conn:
+            for day, meal in meals: self._insert(job["user_id"], day, meal)
+            self._conn.execute("UPDATE import_jobs SET byte_offset = ?, lines_done = ?, imported = ?, failed = ?, skipped = ?, updated_at = ? WHERE id = ?", (job["byte_offset"], job["lines_done"], job["imported"], job["failed"], job["skipped"], time.time(), job["id"]))
+    async def record_import_batch(self, job: dict, meals: list[tuple[date, MealRecord]]) -> None:
+        """Приемы пищи пачкой и новая позиция в файле - одной транзакцией: после падения импорт продолжится ровно с нее."""
+        await asyncio.to_thread(self._record_import_batch, job, meals)
+    async def set_import_status(self, job_id: int, status: str, owner: str | None = None) -> None:
+        def update():
+            with self._db_lock, self._conn: self._conn.execute("UPDATE import_jobs SET status = ?, owner = ?, updated_at = ? WHERE id = ?", (status, owner, time.time(), job_id))
+        await asyncio.to_thread(update)
+    async def release_imports(self, owner: str) -> None:
+        """При остановке: незавершенные задания этого процесса отдаются следующему, кто их заберет."""
+        def update():
+            with self._db_lock, self._conn: self._conn.execute("UPDATE import_jobs SET owner = NULL WHERE owner = ? AND status = 'running'", (owner,))
+        await asyncio.to_thread(update)
+    def _summarize(self, user_id: int, start: date, end: date) -> dict:
+        summary = {"calories": 0, "protein": 0, "fat": 0, "carbs": 0, "meals": 0, "days": 0}
+        with self._db_lock:
+            for table, periods in _rollup_periods(start, end).items():
+                if not periods: continue
+                row = self._conn.execute(f"SELECT SUM(calories), SUM(protein), SUM(fat), SUM(carbs), SUM(meals), SUM(days) FROM {table} WHERE user_id = ? AND period IN ({', '.join('?' * len(periods))})", (user_id, *periods)).fetchone()
+                for key, value in zip(summary, row): summary[key] += value or 0
+        return summary
+    async def summarize(self, user_id: int, days: int, today: date) -> dict:
+        return await asyncio.to_thread(self._summarize, user_id, today - timedelta(days=days - 1), today)
+
+MEAL_HISTORY: MealHistory | None = None # Создается в on_startup, если задан BOT_DB_PATH
+
+# --- Пул готовых тренировок по "корзинам" профиля (пол, возраст, ИМТ, активность, цель, место) ---
+TRAIN_POOL_VARIANTS = int(os.getenv("TRAIN_POOL_VARIANTS", "3")) # Сколько вариантов держать в каждой корзине
+TRAIN_POOL_WARM_HOURS = [int(h) for h in os.getenv("TRAIN_POOL_WARM_HOURS", "2,3,4").split(",") if h.strip()] # Часы (UTC) фонового пополнения
+TRAIN_POOL_WARM_BATCH = int(os.getenv("TRAIN_POOL_WARM_BATCH", "40")) # Максимум генераций за один запуск
+TRAIN_PLAN_CURSOR = "train_plan_cursor"
+TRAIN_LOCATIONS = {"train_home": ("для дома", "без специального оборудования"), "train_gym": ("для тренажерного зала", "с использованием стандартного оборудования зала"), "train_street": ("для улицы", "с минимальным оборудованием или без него")}
+_AGE_BANDS = ((18, "до 18"), (30, "18-29"), (45, "30-44"), (60, "45-59"), (200, "60+"))
+_BMI_BANDS = ((18.5, "до 18.5"), (25, "18.5-24.9"), (30, "25-29.9"), (1000, "30+")) # Те же границы, что в get_bmi_interpretation
+
+def workout_bucket(ud: dict, location_choice: str) -> str | None:
+    age, bmi = ud.get(AGE), ud.get(BMI)
+    if not isinstance(age, (int, float)) or not isinstance(bmi, (int, float)) or location_choice not in TRAIN_LOCATIONS: return None
+    age_band = next(label for limit, label in _AGE_BANDS if age < limit)
+    bmi_band = next(label for limit, label in _BMI_BANDS if bmi < limit)
+    return "|".join([str(ud.get(GENDER)), age_band, bmi_band, str(ud.get(ACTIVITY_LEVEL)), str(ud.get(GOAL)), location_choice])
+
+def workout_prompt(profile_info: str, location_choice: str) -> str:
+    location_text, equipment_text = TRAIN_LOCATIONS.get(location_choice, ("", ""))
+    return (f"{profile_info} Пользователь хочет тренировку {location_text}, {equipment_text}. Твоя задача - сгенерировать программу тренировок. Ответ должен быть полностью на русском языке, очень грамотным и естественным, без выдуманных слов или странных фраз. Для каждого упражнения четко укажи:\n1. *Название упражнения* (жирный шрифт, без Markdown заголовков перед названием).\n2. Техника выполнения: Краткое и понятное описание техники (2-3 предложения).\n3. Подходы: Количество (например, 3-4).\n4. Повторения: Количество в каждом подходе (например, 10-15 или до около отказа).\n5. Отдых: Время между подходами (например, 60-90 секунд).\nНе обсуждай рабочий вес, если это не тренировка в зале или не просили отдельно. Раздели тренировку на секции: '## Разминка (5-7 минут)', '## Основная часть (20-30 минут)', '## Заминка (5 минут)'. Используй именно такие Markdown заголовки. В самом конце, отдельным абзацем, четко укажи: '🔥 Примерно сожжено калорий за эту тренировку: X-Y ккал.'. Замени X-Y на реалистичную оценку. Стиль — дружелюбный тренер. Ответ хорошо структурирован с Markdown (списки -, жирный шрифт *).")
+
+def workout_prompt_for_bucket(bucket: str) -> str:
+    """Промпт только по признакам корзины - план из пула подходит любому пользователю этой корзины и не содержит чужих данных."""
+    gender, age_band, bmi_band, activity, goal, location_choice = bucket.split("|")
+    profile_info = (f"ВАЖНО: Это данные профиля пользователя, используй их: Пол:{gender}, Возраст:{age_band} лет, ИМТ:{bmi_band}, Активность:{activity}, Цель:{goal}. Не упоминай точные рост, вес и возраст и не запрашивай эти данные у пользователя.")
+    return workout_prompt(profile_info, location_choice)
+
+class WorkoutPlanPool:
+    """Готовые планы тренировок в SQLite (несколько вариантов на корзину) + счетчик спроса, по которому корзины пополняются в фоне."""
+    def __init__(self, path: str, variants_per_bucket: int):
+        self.variants_per_bucket = variants_per_bucket
+        self._conn = open_bot_db(path)
+        self._db_lock = threading.Lock()
+        with self._db_lock, self._conn: self._conn.executescript("""
+            CREATE TABLE IF NOT EXISTS workout_plans (bucket TEXT NOT NULL, variant INTEGER NOT NULL, plan TEXT NOT NULL, created_at REAL NOT NULL, PRIMARY KEY (bucket, variant)) WITHOUT ROWID;
+            CREATE TABLE IF NOT EXISTS workout_plan_demand (bucket TEXT PRIMARY KEY, requests INTEGER NOT NULL, last_requested REAL NOT NULL) WITHOUT ROWID;""")
+        self._plans: dict[str, tuple[tuple, list[str]]] = {} # Кэш прочитанных корзин: (число вариантов, MAX(created_at)) -> планы
+        self.served = self.cold = 0
+    def _pick(self, bucket: str, cursor: int) -> tuple[str | None, int]:
+        with self._db_lock:
+            with self._conn: self._conn.execute("INSERT INTO workout_plan_demand VALUES (?, 1, ?) ON CONFLICT(bucket) DO UPDATE SET requests = requests + 1, last_requested = excluded.last_requested", (bucket, time.time()))
+            # Корзину пополняет или обновляет и другой воркер: кэш годен, пока не изменились число вариантов и время последней записи
+            stamp = self._conn.execute("SELECT COUNT(*), MAX(created_at) FROM workout_plans WHERE bucket = ?", (bucket,)).fetchone()
+            cached = self._plans.get(bucket)
+            if cached is not None and cached[0] == stamp: plans = cached[1]
+            else:
+                plans = [row[0] for row in self._conn.execute("SELECT plan FROM workout_plans WHERE bucket = ? ORDER BY variant", (bucket,))]
+                self._plans[bucket] = (stamp, plans)
+        return (plans[cursor % len(plans)], len(plans)) if plans else (None, 0)
+    async def pick(self, bucket: str, cursor: int) -> tuple[str | None, int]:
+        plan, count = await asyncio.to_thread(self._pick, bucket, cursor)
+        if plan is None: self.cold += 1
+        else: self.served += 1
+        return plan, count
+    def _add(self, bucket: str, plan: str) -> None:
+        with self._db_lock, self._conn:
+            rows = self._conn.execute("SELECT variant FROM workout_plans WHERE bucket = ? ORDER BY created_at", (bucket,)).fetchall()
+            variant = len(rows) if len(rows) < self.variants_per_bucket else rows[0][0] # Полная корзина - заменяем самый старый вариант
+            self._conn.execute("INSERT OR REPLACE INTO workout_plans VALUES (?, ?, ?, ?)", (bucket, variant, plan, time.time()))
+    async def add(self, bucket: str, plan: str) -> None: await asyncio.to_thread(self._add, bucket, plan)
+    def _buckets_to_warm(self, limit: int) -> list[tuple[str, int]]:
+        with self._db_lock:
+            return self._conn.execute("SELECT d.bucket, COUNT(p.variant) AS variants FROM workout_plan_demand d LEFT JOIN workout_plans p ON p.bucket = d.bucket GROUP BY d.bucket HAVING variants < ? ORDER BY d.requests DESC LIMIT ?", (self.variants_per_bucket, limit)).fetchall()
+    async def buckets_to_warm(self, limit: int) -> list[tuple[str, int]]: return await asyncio.to_thread(self._buckets_to_warm, limit)
+
+WORKOUT_POOL: WorkoutPlanPool | None = None # Создается в on_startup, если задан BOT_DB_PATH
+register_metric(CallbackMetric("fitbot_workout_pool_requests_total", "Запросы тренировки: из пула (served) и без готового плана (cold)", lambda: {"served": WORKOUT_POOL.served, "cold": WORKOUT_POOL.cold}, "counter", ("result",)))
+
+async def warm_workout_pool(context: ContextTypes.DEFAULT_TYPE) -> None:
+    """Задача JobQueue: в часы низкой нагрузки догенерирует варианты для самых востребованных неполных корзин."""
+    if WORKOUT_POOL is None: return
+    generated = failed = 0
+    for bucket, variants in await WORKOUT_POOL.buckets_to_warm(TRAIN_POOL_WARM_BATCH):
+        for _ in range(WORKOUT_POOL.variants_per_bucket - variants):
+            if generated + failed >= TRAIN_POOL_WARM_BATCH: break
+            plan, outcome = await ask_groq_queued(workout_prompt_for_bucket(bucket), temperature=0.7) # Повыше температура - варианты разнообразнее
+            if outcome not in AI_REPLY_OUTCOMES or not plan.strip(): # Корзину пропускаем до следующего запуска, остальные пополняем
+                failed += 1; logger.warning("Пул тренировок: план для корзины %s не получен (%s): %s", bucket, outcome, plan[:200]); break
+            await WORKOUT_POOL.add(bucket, plan); generated += 1
+    logger.info("Пул тренировок пополнен: %s новых планов, не удалось: %s.", generated, failed)
+
+# --- Хуки жизненного цикла Application ---
+_metrics_server = None
+WORKER_INDEX = 0 # Номер воркера в webhook-режиме (сдвиг портов)
+
+async def holds_job_lease(app, name: str, ttl: float) -> bool:
+    """Без общей базы задачи выполняет каждый процесс сам; при SHARED_STATE - только владелец аренды задачи в job_leases."""
+    persistence = app.persistence
+    return not (isinstance(persistence, SQLitePersistence) and persistence.shared) or await persistence.acquire_job_lease(name, ttl)
+
+def singleton_job(callback, ttl: float):
+    """Задача JobQueue, которую при нескольких воркерах выполняет один из них: пополнение пула, смена дня в базе и пересчет
+    аналитики в каждом воркере только умножили бы запросы к Groq и полные проходы по базе."""
+    @functools.wraps(callback)
+    async def run(context: ContextTypes.DEFAULT_TYPE) -> None:
+        if await holds_job_lease(context.application, context.job.name, ttl): await callback(context)
+    return run
+
+async def on_startup(app) -> None:
+    global MEAL_HISTORY, WORKOUT_POOL, REMINDERS, COHORT_ANALYTICS, _metrics_server
+    await groq_client_startup(app)
+    if METRICS_ENABLED and _metrics_server is None:
+        try: _metrics_server = await start_metrics_server(METRICS_PORT + WORKER_INDEX)
+        except OSError as e: logger.error("Не удалось запустить сервер метрик на порту %d: %s", METRICS_PORT + WORKER_INDEX, e)
+    if isinstance(app.update_processor, PerUserUpdateProcessor): app.update_processor.application = app
+    if BOT_DB_PATH and MEAL_HISTORY is None: MEAL_HISTORY = await asyncio.to_thread(MealHistory, BOT_DB_PATH)
+    if MEAL_HISTORY is not None: await resume_imports(app)
+    if BOT_DB_PATH and ADMIN_IDS and COHORT_ANALYTICS is None:
+        if np is None: logger.warning("ADMIN_IDS задан, но numpy не установлен (pip install numpy) - /adminstats недоступна.")
+        else: COHORT_ANALYTICS = await asyncio.to_thread(CohortAnalytics, BOT_DB_PATH, ADMIN_STATS_DAYS, SHARED_STATE)
+    if COHORT_ANALYTICS is not None: schedule_admin_stats(app)
+    if BOT_DB_PATH and REMINDERS is None: REMINDERS = await asyncio.to_thread(ReminderSchedule, BOT_DB_PATH)
+    if REMINDERS is not None: BROADCASTER.on_forbidden = REMINDERS.disable_chat
+    BROADCASTER.start(app.bot)
+    schedule_day_jobs(app)
+    if BOT_DB_PATH and WORKOUT_POOL is None: WORKOUT_POOL = await asyncio.to_thread(WorkoutPlanPool, BOT_DB_PATH, TRAIN_POOL_VARIANTS)
+    if WORKOUT_POOL is not None:
+        if app.job_queue is None: logger.warning("JobQueue недоступна (pip install \"python-telegram-bot[job-queue]\") - пул тренировок не будет пополняться в фоне.")
+        else:
+            for hour in TRAIN_POOL_WARM_HOURS: app.job_queue.run_daily(singleton_job(warm_workout_pool, 3600), time=dtime(hour=hour, tzinfo=timezone.utc), name=f"warm_workout_pool_{hour}")
+    await asyncio.to_thread(MEAL_CACHE.load)
+async def on_shutdown(app) -> None:
+    await stop_imports()
+    await BROADCASTER.stop()
+    logger.info("Рассылка: %s, смена дня: %s, напоминаний пропущено из-за опоздания: %s", BROADCASTER.stats(), _rollover_counters, REMINDERS.late_skipped if REMINDERS is not None else 0)
+    await asyncio.to_thread(MEAL_CACHE.save)
+    logger.info("Кэш оценок КБЖУ сохранен. Статистика: %s", MEAL_CACHE.stats())
+    logger.info("Очередь AI при остановке: %s", AI_QUEUE.stats())
+    logger.info("JSON-ответы AI: %s", ai_json_stats())
+    logger.info("Маршрутизатор моделей Groq: %s", GROQ_ROUTER.stats())
+    logger.info("Вызовы Groq: %s, ожиданий лимита: %s (%.1f с)", _groq_call_counters, GROQ_RATE_LIMITS.throttled, GROQ_RATE_LIMITS.throttle_time_total)
+    await groq_client_shutdown(app)
+    if _metrics_server is not None: _metrics_server.close()
+
+# --- Очередь AI-запросов (ограниченная параллельность, перегрузка видна как очередь, а не таймауты) ---
+GROQ_MAX_CONCURRENCY = int(os.getenv("GROQ_MAX_CONCURRENCY", "8"))
+GROQ_QUEUE_MAX_WAITING = int(os.getenv("GROQ_QUEUE_MAX_WAITING", "200"))
+
+class AIQueueFullError(Exception):
+    pass
+
+class AIWorkQueue:
+    """Не больше concurrency AI-запросов одновременно, остальные ждут в очереди (до max_waiting) строго по порядку прихода.
+    Место в очереди занимается сразу, без await: сообщение пользователю о номере уходит фоновой задачей и не задерживает его очередь."""
+    def __init__(self, concurrency: int, max_waiting: int):
+        self.concurrency, self.max_waiting = concurrency, max_waiting
+        self._slots = asyncio.Semaphore(concurrency)
+        self.waiting = self.running = 0
+        self.submitted = self.rejected = self.queued = 0
+        self.wait_time_total = self.wait_time_max = 0.0
+        self._recent_waits = deque(maxlen=1000)
+        self._notices: set[asyncio.Task] = set() # Ссылки на фоновые уведомления, чтобы их не собрал GC
+    async def _notify(self, on_queued, position: int) -> None:
+        try: await on_queued(position)
+        except Exception as e: logger.warning("Не удалось сообщить пользователю о месте в очереди AI: %s", e)
+    async def run(self, job_factory, on_queued=None):
+        self.submitted += 1
+        if self._slots.locked() or self.waiting:
+            if self.waiting >= self.max_waiting:
+                self.rejected += 1; raise AIQueueFullError(f"В очереди уже {self.waiting} запросов")
+            self.queued += 1
+            if on_queued is not None:
+                notice = asyncio.create_task(self._notify(on_queued, self.waiting + 1)); self._notices.add(notice); notice.add_done_callback(self._notices.discard)
+        self.waiting += 1; enqueued_at = time.monotonic() # До acquire нет ни одного await: место в очереди семафора соответствует номеру
+        try: await self._slots.acquire()
+        finally: self.waiting -= 1
+        waited = time.monotonic() - enqueued_at; AI_QUEUE_WAIT.observe(waited)
+        self.wait_time_total += waited; self.wait_time_max = max(self.wait_time_max, waited); self._recent_waits.append(waited)
+        self.running += 1
+        try: return await job_factory()
+        finally:
+            self.running -= 1; self._slots.release()
+    def stats(self) -> dict:
+        recent = sorted(self._recent_waits)
+        started = self.submitted - self.rejected - self.waiting
+        return {"depth": self.waiting, "running": self.running, "concurrency": self.concurrency, "submitted": self.submitted, "queued": self.queued, "rejected": self.rejected,
+                "wait_avg_s": round(self.wait_time_total / started, 3) if started > 0 else 0.0, "wait_max_s": round(self.wait_time_max, 3),
+                "wait_p95_s": round(recent[int(len(recent) * 0.95) - 1], 3) if recent else 0.0}
+
+AI_QUEUE = AIWorkQueue(GROQ_MAX_CONCURRENCY, GROQ_QUEUE_MAX_WAITING)
+register_metric(CallbackMetric("fitbot_ai_queue_jobs", "AI-задачи в очереди (waiting) и в работе (running)", lambda: {"waiting": AI_QUEUE.waiting, "running": AI_QUEUE.running}, labelnames=("state",)))
+register_metric(CallbackMetric("fitbot_ai_queue_rejected_total", "AI-задачи, отклоненные из-за переполненной очереди", lambda: AI_QUEUE.rejected, "counter"))
+
+AI_QUEUE_FULL_TEXT = "⏳ Упс, сейчас слишком много запросов к AI. Попробуй, пожалуйста, через пару минут."
+
+async def run_ai_job(job_factory, notify_message=None):
+    """Выполняет AI-задачу через AI_QUEUE; если она ждет в очереди, пользователю сообщается его номер."""
+    async def on_queued(position: int):
+        await notify_message.reply_text(f"⏳ Сейчас много запросов к AI. Ты #{position} в очереди - ответ придет автоматически.")
+    return await AI_QUEUE.run(job_factory, on_queued if notify_message is not None else None)
+
+async def ask_groq_queued(user_message: str, notify_message=None, **kwargs) -> tuple[str, str]:
+    """ask_groq через AI_QUEUE -> (текст, исход); переполненная очередь - исход queue_full."""
+    try: return await run_ai_job(lambda: ask_groq(user_message, **kwargs), notify_message)
+    except AIQueueFullError as e:
+        logger.warning("Очередь AI переполнена, запрос отклонен: %s", e)
+        return AI_QUEUE_FULL_TEXT, "queue_full"
+
+async def ask_groq_json(user_message: str, schema: dict, validator, notify_message=None, **kwargs) -> tuple[object | None, str, str]:
+    """Запрос в JSON-режиме по схеме -> (проверенный объект или None, последний ответ, его исход).
+    Сломанный JSON сначала чинится локально; повторный запрос - только если ответила модель, но ни починка, ни проверка не помогли."""
+    reply, outcome = await ask_groq_queued(user_message, notify_message, response_format=json_response_format(schema), **kwargs)
+    data = parse_ai_json(reply, validator) if outcome in AI_REPLY_OUTCOMES else None
+    if data is None and outcome in AI_REPLY_OUTCOMES:
+        _ai_json_counters["rerequested"] += 1
+        logger.info("Ответ AI по схеме %s не удалось использовать, повторный запрос.", schema["title"])
+        reply, outcome = await ask_groq_queued(user_message + "\n\nВерни ТОЛЬКО корректный JSON строго по указанной структуре.", response_format=json_response_format(schema), **kwargs)
+        data = parse_ai_json(reply, validator) if outcome in AI_REPLY_OUTCOMES else None
+    return data, reply, outcome
+
+# --- Параллельная обработка апдейтов: разные пользователи параллельно, апдейты одного пользователя - строго по порядку ---
+BOT_CONCURRENT_UPDATES = int(os.getenv("BOT_CONCURRENT_UPDATES", "64"))
+
+class PerUserUpdateProcessor(BaseUpdateProcessor):
+    """Сериализует апдейты одного пользователя (иначе состояния ConversationHandler гонялись бы), остальные идут параллельно.
+    С общим хранилищем (shared_state) пользователь еще и арендуется в базе, а его данные записываются до снятия аренды -
+    так следующий апдейт, пришедший в другой воркер, увидит их."""
+    def __init__(self, max_concurrent_updates: int, shared_state: "SQLitePersistence | None" = None):
+        # Семафор базового класса только считает принятые апдейты (current_concurrent_updates), включая ждущих своего пользователя;
+        # одновременную обработку ограничивают слоты в do_process_update
+        super().__init__(1 << 30)
+        self.shared_state = shared_state
+        self.application = None # Выставляется в on_startup, нужен для записи данных после апдейта
+        self._slots = asyncio.BoundedSemaphore(max_concurrent_updates)
+        self._locks: dict[int, asyncio.Lock] = {}
+        self._lock_refs: dict[int, int] = {}
+    async def do_process_update(self, update: object, coroutine) -> None:
+        """Сначала очередь пользователя, потом слот из max_concurrent_updates: апдейты, ждущие своего пользователя
+        (например, пока идет его 30-секундный AI-запрос), слотов не занимают и не задерживают остальных."""
+        key = None
+        if isinstance(update, Update): key = update.effective_user.id if update.effective_user else (update.effective_chat.id if update.effective_chat else None)
+        if key is None:
+            async with self._slots: await coroutine
+            return
+        lock = self._locks.get(key)
+        if lock is None: lock = self._locks[key] = asyncio.Lock()
+        self._lock_refs[key] = self._lock_refs.get(key, 0) + 1
+        try:
+            async with lock:
+                if self.shared_state is None:
+                    async with self._slots: await coroutine
+                else: await self._process_shared(key, update, coroutine)
+        finally:
+            self._lock_refs[key] -= 1
+            if not self._lock_refs[key]: del self._lock_refs[key]; del self._locks[key] # Не копим блокировки для всех когда-либо писавших
+    def _shared_conversations(self, update: Update) -> list[tuple["SharedConversationHandler", tuple]]:
+        handlers = (h for group in self.application.handlers.values() for h in group if isinstance(h, SharedConversationHandler)) if self.application is not None else ()
+        return [(handler, key) for handler in handlers if (key := handler.conversation_key(update)) is not None]
+    async def _process_shared(self, key: int, update: Update, coroutine) -> None:
+        await self.shared_state.acquire_user_lease(key) # Тоже до слота: пользователя может держать другой воркер
+        try:
+            # Предыдущий шаг диалога мог обработать другой процесс - состояния перечитываются здесь, check_update смотрит только в память
+            conversations = self._shared_conversations(update)
+            states = await self.shared_state.read_conversation_states([(handler.name, conv_key) for handler, conv_key in conversations])
+            for handler, conv_key in conversations: handler.sync_state(conv_key, states.get((handler.name, conv_key)))
+            async with self._slots: await coroutine
+            # Пишется только этот пользователь: update_persistence сбросил бы и тех, кого другие задачи обрабатывают прямо сейчас
+            if update.effective_user and (data := self.application.user_data.get(key)) is not None: await self.shared_state.update_user_data(key, data)
+            for handler, conv_key in conversations:
+                if (state := handler.current_state(conv_key)) != states.get((handler.name, conv_key)): await self.shared_state.update_conversation(handler.name, conv_key, state)
+            await self.shared_state.wait_written()
+        finally:
+            await self.shared_state.release_user_lease(key)
+    async def initialize(self) -> None: pass
+    async def shutdown(self) -> None: pass
+
+class SharedConversationHandler(ConversationHandler):
+    """ConversationHandler для нескольких воркеров: PerUserUpdateProcessor перед апдейтом подставляет состояние диалога из общей базы
+    (предыдущий шаг мог обработать другой процесс) и после апдейта записывает его обратно."""
+    def conversation_key(self, update: object) -> tuple | None:
+        return self._get_key(update) if isinstance(update, Update) and update.effective_chat and update.effective_user else None
+    def current_state(self, key: tuple) -> object | None:
+        state = self._conversations.get(key)
+        return state if isinstance(state, int) else None
+    def sync_state(self, key: tuple, state: object | None) -> None:
+        current = self._conversations.get(key)
+        if isinstance(current, (int, type(None))) and current != state: # PendingState (незавершенный шаг этого процесса) не трогаем
+            states = getattr(self._conversations, "data", self._conversations) # Мимо TrackingDict: это не новое состояние, писать его обратно не нужно
+            if state is None: states.pop(key, None)
+            else: states[key] = state
+
+# --- Стриминг ответа Groq (SSE) с постепенным редактированием сообщения ---
+GROQ_STREAMING = os.getenv("GROQ_STREAMING", "1").lower() in ("1", "true", "yes")
+STREAM_EDIT_INTERVAL = float(os.getenv("STREAM_EDIT_INTERVAL", "1.5")) # Не чаще одного редактирования в N секунд (flood-лимиты Telegram)
+TELEGRAM_MESSAGE_LIMIT = 4000 # Запас до лимита Telegram в 4096 символов
+
+class GroqStreamError(Exception):
+    """Стрим не удалось начать или он оборвался; args[0] - текст для пользователя, outcome - исход для метрик и маршрутизатора."""
+    def __init__(self, text: str, outcome: str = "error"):
+        super().__init__(text); self.outcome = outcome
+
+async def ask_groq_stream(user_message: str, model: str | None = None, system_prompt_override: str = None, temperature: float = 0.5):
+    """Асинхронный генератор кусочков текста ответа. model=None - модели из GROQ_ROUTER по очереди: если стрим не начался из-за
+    ошибки модели, запрос уходит к следующей. Хеджирования у стрима нет - два параллельных стрима в одно сообщение не показать."""
+    if not GROQ_API_KEY: raise GroqStreamError("К сожалению, я сейчас не могу связаться со своим AI-мозгом. Попробуйте позже или проверьте настройки API ключа.")
+    models = [model] if model else GROQ_ROUTER.pick()
+    if not models:
+        GROQ_ROUTER.decide("-", "fail_fast"); raise GroqStreamError(ALL_MODELS_DOWN_TEXT, "fail_fast")
+    for position, current_model in enumerate(models):
+        GROQ_ROUTER.started(current_model, "failover" if position else "primary")
+        streamed = False
+        try:
+            async for delta in _ask_groq_stream_model(user_message, current_model, system_prompt_override, temperature):
+                streamed = True; yield delta
+            return
+        except GroqStreamError as e:
+            if streamed or position + 1 == len(models) or e.outcome not in ROUTER_FAILOVER_OUTCOMES: raise
+            logger.warning("Стрим Groq (%s) не начался (%s), переход к модели %s.", current_model, e.outcome, models[position + 1])
+
+async def _next_sse_data(lines) -> str | None:
+    """Полезная нагрузка следующего события data: из SSE-стрима; None - стрим закончился."""
+    async for line in lines:
+        if line.startswith("data:"): return line[5:].strip()
+    return None
+
+async def _open_groq_stream(client: httpx.AsyncClient, headers: dict, data: dict, model: str, est_tokens: int, deadline: float):
+    """Начинает стрим -> (ответ, строки, первый чанк); строки None - ответ с ошибкой HTTP, его разбирает вызывающий.
+    Как в _groq_post, 429/5xx и сетевые сбои повторяются, но здесь - пока не пришел первый чанк: ожидание лимитов,
+    заголовки ответа и первый чанк укладываются в deadline. Дальше повторять нельзя - текст уже показан пользователю."""
+    limiter, attempt = GROQ_RATE_LIMITS[model], 0
+    while True:
+        await limiter.acquire(est_tokens, deadline)
+        _groq_call_counters["upstream_calls"] += 1
+        response, started = None, False
+        try:
+            response = await asyncio.wait_for(client.send(client.build_request("POST", GROQ_API_URL, headers=headers, json=data), stream=True), deadline - time.monotonic())
+            if response.status_code == 429 or response.status_code >= 500:
+                attempt += 1; delay = _retry_delay(response, attempt)
+                if response.status_code == 429: limiter.block_for(delay)
+                if attempt <= GROQ_MAX_RETRIES and time.monotonic() + delay <= deadline:
+                    _groq_call_counters["retries"] += 1
+                    logger.warning("Groq (%s) ответил %s на стриминговый запрос, повтор %s/%s через %.1f с.", model, response.status_code, attempt, GROQ_MAX_RETRIES, delay)
+                    await response.aclose(); response = None; await asyncio.sleep(delay); continue
+            if response.status_code >= 400: started = True; return response, None, None
+            lines = response.aiter_lines()
+            first = await asyncio.wait_for(_next_sse_data(lines), deadline - time.monotonic())
+            started = True; return response, lines, first
+        except asyncio.TimeoutError: raise httpx.TimeoutException(f"Первый чанк не пришел за GROQ_CALL_DEADLINE ({GROQ_CALL_DEADLINE:g} с)") from None
+        except _GROQ_TRANSIENT_ERRORS as e:
+            attempt += 1; delay = _backoff_delay(attempt)
+            if attempt > GROQ_MAX_RETRIES or time.monotonic() + delay > deadline: raise
+            _groq_call_counters["retries"] += 1
+            logger.warning("Сбой соединения с Groq (%s) до начала стрима: %r, повтор %s/%s через %.1f с.", model, e, attempt, GROQ_MAX_RETRIES, delay)
+            if response is not None: await response.aclose(); response = None
+            await asyncio.sleep(delay)
+        finally:
+            if response is not None and not started: await response.aclose()
+
+async def _ask_groq_stream_model(user_message: str, model: str, system_prompt_override: str = None, temperature: float = 0.5):
+    """Стрим одной модели. Повторы 429/5xx и сетевых сбоев возможны только до первого чанка (_open_groq_stream)."""
+    headers = {"Authorization": f"Bearer {GROQ_API_KEY}", "Content-Type": "application/json"}
+    data = {"messages": [{"role": "system", "content": system_prompt_override or SYSTEM_PROMPT_DIETITIAN}, {"role": "user", "content": user_message}], "model": model, "temperature": temperature, "stream": True}
+    est_tokens = sum(len(m["content"]) for m in data["messages"]) // 3 + GROQ_EST_COMPLETION_TOKENS
+    deadline = time.monotonic() + GROQ_CALL_DEADLINE
+    client, limiter = _groq_client if _groq_client is not None else _build_groq_client(), GROQ_RATE_LIMITS[model]
+    logger.info("Стриминговый запрос к Groq. Модель: %s, Температура: %s.", model, temperature)
+    started, outcome = time.perf_counter(), "error"
+    try:
+        response, lines, payload = await _open_groq_stream(client, headers, data, model, est_tokens, deadline)
+        try:
+            if lines is None:
+                outcome = "http_error"
+                body = (await response.aread()).decode(errors="replace")
+                logger.error("Ошибка HTTP от Groq при стриминге (%s): %s - %s", model, response.status_code, body)
+                if _is_model_gone(response.status_code, body):
+                    outcome = "decommissioned"; raise GroqStreamError(f"🔌 Ой, похоже, выбранная модель AI ({model}) больше не доступна. Разработчик уже в курсе!", outcome)
+                if response.status_code == 429: outcome = "rate_limited"
+                raise GroqStreamError(f"🔌 Ошибка при обращении к AI (код: {response.status_code}). Попробуй, пожалуйста, позже.", outcome)
+            while payload is not None and payload != "[DONE]":
+                chunk = json.loads(payload)
+                usage = (chunk.get("x_groq") or {}).get("usage") or chunk.get("usage")
+                if usage and isinstance(usage.get("total_tokens"), int): limiter.settle(est_tokens, usage["total_tokens"])
+                if usage: _record_groq_usage(model, usage)
+                if chunk.get("choices") and (delta := chunk["choices"][0].get("delta", {}).get("content")): yield delta
+                payload = await _next_sse_data(lines)
+            outcome = "ok"; return
+        finally: await response.aclose()
+    except GroqRateLimitTimeout:
+        outcome = "rate_limited"; raise GroqStreamError("⏳ Упс, лимит запросов к AI на эту минуту исчерпан. Попробуй, пожалуйста, еще раз чуть позже.", outcome)
+    except httpx.PoolTimeout:
+        outcome = "pool_timeout"; raise GroqStreamError("⏳ Упс, сейчас слишком много запросов к AI. Попробуй, пожалуйста, еще раз через минуту.", outcome)
+    except httpx.TimeoutException:
+        outcome = "timeout"; raise GroqStreamError("⏳ Упс, не удалось получить ответ от AI вовремя (таймаут). Попробуй, пожалуйста, еще раз чуть позже.", outcome)
+    except httpx.RequestError as e:
+        outcome = "network_error"
+        logger.error("Ошибка стримингового запроса к Groq API (%s): %s", model, e)
+        raise GroqStreamError("📡 Проблема с подключением к AI. Возможно, временные неполадки в сети.", outcome)
+    except json.JSONDecodeError as e:
+        outcome = "parse_error"
+        logger.error("Некорректный SSE-чанк от Groq (%s): %s", model, e)
+        raise GroqStreamError("🤯 Получен неожиданный или неполный ответ от AI. Попробуй еще раз.", outcome)
+    except (asyncio.CancelledError, GeneratorExit):
+        outcome = "cancelled"; raise
+    finally:
+        GROQ_LATENCY.observe(time.perf_counter() - started, model, "stream"); GROQ_CALLS.inc(1, model, "stream", outcome)
+        GROQ_ROUTER.observe(model, time.perf_counter() - started, outcome, "stream")
+        if client is not _groq_client: await client.aclose()
+
+_MARKDOWN_MARKERS = ("```", "`", "*", "_")
+
+def close_open_markdown(text: str) -> str:
+    """Делает недописанный кусок безопасным для ParseMode.MARKDOWN: отрезает незакрытую ссылку и висящий маркер, закрывает открытые * _ `."""
+    if text.rfind("[") > text.rfind(")"): text = text[:text.rfind("[")]
+    text = text.rstrip()
+    closers = ""
+    for marker in _MARKDOWN_MARKERS:
+        if marker == "`" and text.count("```") % 2: continue # Внутри блока кода остальные маркеры не действуют
+        count = text.count(marker) if marker == "```" else text.replace("```", "").count(marker)
+        if count % 2:
+            if text.endswith(marker): text = text[:-len(marker)].rstrip() # Пустую сущность Telegram не примет
+            else: closers = marker + closers
+        if marker == "```" and text.count("```") % 2: break
+    return text + closers
+
+def split_for_telegram(text: str, limit: int = TELEGRAM_MESSAGE_LIMIT) -> tuple[str, str]:
+    """(голова до limit символов по границе абзаца/строки, остаток)."""
+    if len(text) <= limit: return text, ""
+    cut = max(text.rfind("\n\n", 0, limit), text.rfind("\n", 0, limit))
+    if cut <= limit // 2: cut = text.rfind(" ", 0, limit)
+    if cut <= 0: cut = limit
+    return text[:cut].rstrip(), text[cut:].lstrip()
+
+def _retry_after_seconds(error: RetryAfter) -> float:
+    return error.retry_after.total_seconds() if isinstance(error.retry_after, timedelta) else float(error.retry_after)
+
+class StreamingReply:
+    """Показывает растущий ответ: первое сообщение сразу с первым текстом, дальше редактирование не чаще STREAM_EDIT_INTERVAL.
+    Длинный ответ переносится в новые сообщения по границе абзаца."""
+    def __init__(self, reply_to, edit_interval: float = STREAM_EDIT_INTERVAL):
+        self.reply_to, self.edit_interval = reply_to, edit_interval
+        self.text = ""; self.message = None
+        self._shown = ""; self._next_edit_at = 0.0
+        self.edits = 0
+    async def append(self, delta: str) -> None:
+        self.text += delta
+        while len(self.text) > TELEGRAM_MESSAGE_LIMIT: # Голова уходит в отдельное законченное сообщение
+            head, self.text = split_for_telegram(self.text)
+            await self._show(head, final=True); self.message = None; self._shown = ""
+        if time.monotonic() >= self._next_edit_at: await self._show(self.text, final=False)
+    async def finish(self, suffix: str = "") -> None:
+        self.text += suffix
+        if self.text.strip(): await self._show(self.text, final=True)
+    async def _show(self, text: str, final: bool) -> None:
+        rendered = text if final else close_open_markdown(text)
+        if not rendered.strip() or rendered == self._shown: return
+        try: await self._send(rendered, ParseMode.MARKDOWN)
+        except BadRequest as e:
+            if "not modified" in str(e).lower(): pass
+            else: # Модель выдала Markdown, который Telegram не разбирает - показываем как обычный текст
+                logger.debug("Markdown отклонен Telegram при стриминге (%s), отправка без разметки.", e)
+                await self._send(rendered, None)
+        except RetryAfter as e:
+            self._next_edit_at = time.monotonic() + _retry_after_seconds(e)
+            if final:
+                await asyncio.sleep(_retry_after_seconds(e)); await self._show(text, final)
+            return
+        self._shown = rendered; self._next_edit_at = time.monotonic() + self.edit_interval
+    async def _send(self, text: str, parse_mode) -> None:
+        if self.message is None: self.message = await self.reply_to.reply_text(text, parse_mode=parse_mode)
+        else: await self.message.edit_text(text, parse_mode=parse_mode)
+        self.edits += 1
+
+async def stream_groq_reply(reply_to, user_message: str, **kwargs) -> tuple[str, bool]:
+    """Стримит ответ AI в чат; возвращает (итоговый текст или текст ошибки, дошел ли ответ до конца)."""
+    reply = StreamingReply(reply_to); started_at = time.monotonic(); first_content_at = None
+    try:
+        async for delta in ask_groq_stream(user_message, **kwargs):
+            if first_content_at is None: first_content_at = time.monotonic() - started_at
+            await reply.append(delta)
+    except GroqStreamError as e:
+        if not reply.text: await reply_to.reply_text(e.args[0]); return e.args[0], False
+        await reply.finish("\n\n⚠️ Ответ AI оборвался. Попробуй запросить еще раз."); return reply.text, False
+    await reply.finish()
+    logger.info("Стрим Groq завершен: первый текст через %.2f с, всего %.2f с, правок сообщения: %s.", first_content_at if first_content_at is not None else -1, time.monotonic() - started_at, reply.edits)
+    return reply.text, bool(reply.text.strip())
 
 # --- Функции для ConversationHandler (создание профиля - как в v2.7) ---
 # (Вставь сюда start_command ... process_final_profile, cancel_onboarding из v2.7)
 # --- Копипаста функций онбординга из v2.7 (с коррекцией для LAST_MEAL_DATE в cancel_onboarding) ---
 async def start_command(update: Update, context: ContextTypes.DEFAULT_TYPE) -> int:
     user = update.effective_user
-    today_str = date.today().isoformat()
-    if context.user_data.get(LAST_MEAL_DATE) != today_str:
-        context.user_data[TODAY_MEALS] = []
-        context.user_data[LAST_MEAL_DATE] = today_str
-        logger.info(f"User {user.id}: Новый день, данные о приемах пищи сброшены.")
+    if ensure_current_day(context.user_data): logger.info("User %s: Новый день, данные о приемах пищи сброшены.", user.id)
     if context.user_data.get(PROFILE_COMPLETE):
         await update.message.reply_text(f"👋 С возвращением, {user.first_name}!\nТвой профиль уже со мной. Чем могу быть полезен сегодня?\nИспользуй /menu для навигации или просто спроси!",parse_mode=ParseMode.MARKDOWN)
         return ConversationHandler.END
     if not context.user_data.get(GENDER):
-        context.user_data.clear()
-        context.user_data[LAST_MEAL_DATE] = today_str 
-        context.user_data[TODAY_MEALS] = []
-        logger.info(f"User {user.id} ({user.username}) начинает создание профиля.")
-    else: logger.info(f"User {user.id} ({user.username}) продолжает создание профиля.")
+        reset_user_data(context.user_data)
+        logger.info("User %s (%s) начинает создание профиля.", user.id, user.username)
+    else: logger.info("User %s (%s) продолжает создание профиля.", user.id, user.username)
     await update.message.reply_text(f"🌟 Привет, {user.first_name}! Я *ФитГуру* – твой личный AI-диетолог и тренер.\n\nЧтобы наши тренировки и планы питания были максимально эффективными, мне нужно немного узнать о тебе. Это быстро и абсолютно конфиденциально! 🤫\n\n🚹🚺 Для начала, укажи, пожалуйста, свой *пол*:",reply_markup=InlineKeyboardMarkup([[InlineKeyboardButton("👨 Мужской", callback_data="мужской"), InlineKeyboardButton("👩 Женский", callback_data="женский")]]),parse_mode=ParseMode.MARKDOWN)
     return PROFILE_GENDER
 async def handle_gender_and_ask_age(update: Update, context: ContextTypes.DEFAULT_TYPE) -> int:
@@ -130,7 +1610,7 @@ async def handle_age_and_ask_height(update: Update, context: ContextTypes.DEFAUL
         await update.message.reply_text(text=f"Возраст: *{age} лет*. Замечательно! ✅\n\n📏 Теперь введи свой *рост* (в сантиметрах):",parse_mode=ParseMode.MARKDOWN)
         return PROFILE_HEIGHT
     except ValueError as e:
-        logger.warning(f"User {update.effective_user.id} ввел некорректный возраст: {update.message.text}. Ошибка: {e}")
+        logger.warning("User %s ввел некорректный возраст: %s. Ошибка: %s", update.effective_user.id, update.message.text, e)
         await update.message.reply_text("🤔 Хм, возраст должен быть целым числом от 10 до 100 (например, 25). Попробуй еще раз!")
         return PROFILE_AGE
 async def handle_height_and_ask_weight(update: Update, context: ContextTypes.DEFAULT_TYPE) -> int:
@@ -141,7 +1621,7 @@ async def handle_height_and_ask_weight(update: Update, context: ContextTypes.DEF
         await update.message.reply_text(text=f"Рост: *{height} см*. Записал! 📝\n\n⚖️ Теперь введи свой текущий *вес* (в кг, например, 70.5):",parse_mode=ParseMode.MARKDOWN)
         return PROFILE_WEIGHT
     except ValueError as e:
-        logger.warning(f"User {update.effective_user.id} ввел некорректный рост: {update.message.text}. Ошибка: {e}")
+        logger.warning("User %s ввел некорректный рост: %s. Ошибка: %s", update.effective_user.id, update.message.text, e)
         await update.message.reply_text("🤔 Рост должен быть целым числом в сантиметрах от 100 до 250 (например, 175). Попробуй снова!")
         return PROFILE_HEIGHT
 async def handle_weight_and_ask_activity(update: Update, context: ContextTypes.DEFAULT_TYPE) -> int:
@@ -153,7 +1633,7 @@ async def handle_weight_and_ask_activity(update: Update, context: ContextTypes.D
         await update.message.reply_text(text=f"Вес: *{weight} кг*. Принято! 👌\n\n🤸‍♀️ Оцени свой обычный уровень *физической активности*:", reply_markup=InlineKeyboardMarkup(activity_buttons), parse_mode=ParseMode.MARKDOWN)
         return PROFILE_ACTIVITY
     except ValueError as e:
-        logger.warning(f"User {update.effective_user.id} ввел некорректный вес: {update.message.text}. Ошибка: {e}")
+        logger.warning("User %s ввел некорректный вес: %s. Ошибка: %s", update.effective_user.id, update.message.text, e)
         await update.message.reply_text("🤔 Вес должен быть числом от 30 до 300 (например, 70.5). Давай еще разок!")
         return PROFILE_WEIGHT
 async def handle_activity_and_ask_goal(update: Update, context: ContextTypes.DEFAULT_TYPE) -> int:
@@ -162,26 +1642,26 @@ async def handle_activity_and_ask_goal(update: Update, context: ContextTypes.DEF
     return PROFILE_GOAL
 async def process_final_profile(update: Update, context: ContextTypes.DEFAULT_TYPE) -> int:
     query = update.callback_query; user_id = update.effective_user.id
-    logger.info(f"User {user_id}: Entered process_final_profile with callback_data: {query.data}")
+    logger.info("User %s: Entered process_final_profile with callback_data: %s", user_id, query.data)
     await query.answer(); context.user_data[GOAL] = query.data; ud = context.user_data
-    logger.info(f"User {user_id}: Goal '{ud.get(GOAL)}' saved. User data before calcs: {ud}")
+    logger.info("User %s: Goal '%s' saved.", user_id, ud.get(GOAL))
     try:
         required_keys = [CURRENT_WEIGHT, HEIGHT, AGE, GENDER, ACTIVITY_LEVEL, GOAL]
         missing_keys = [key for key in required_keys if ud.get(key) is None]
         if missing_keys:
-            logger.error(f"User {user_id}: Missing keys for calculation: {missing_keys}")
+            logger.error("User %s: Missing keys for calculation: %s", user_id, missing_keys)
             await query.edit_message_text("Ой, не хватает данных. 😥 /start заново.")
             ud.pop(PROFILE_COMPLETE, None); return ConversationHandler.END
         ud[BMI] = calculate_bmi(ud.get(CURRENT_WEIGHT), ud.get(HEIGHT))
         ud[BMR] = calculate_bmr(ud.get(CURRENT_WEIGHT), ud.get(HEIGHT), ud.get(AGE), ud.get(GENDER))
         ud[TDEE] = calculate_tdee(ud.get(BMR), ud.get(ACTIVITY_LEVEL))
         ud[TARGET_CALORIES] = calculate_target_calories(ud.get(TDEE), ud.get(GOAL))
-        logger.info(f"User {user_id}: Calcs complete. BMI:{ud.get(BMI)}, BMR:{ud.get(BMR)}, TDEE:{ud.get(TDEE)}, TARGET_CALORIES:{ud.get(TARGET_CALORIES)}")
+        logger.info("User %s: Calcs complete. BMI:%s, BMR:%s, TDEE:%s, TARGET_CALORIES:%s", user_id, ud.get(BMI), ud.get(BMR), ud.get(TDEE), ud.get(TARGET_CALORIES))
         if None in [ud.get(BMI), ud.get(BMR), ud.get(TDEE), ud.get(TARGET_CALORIES)]:
-            logger.error(f"User {user_id}: Calculated values are None. Data: BMI={ud.get(BMI)}, BMR={ud.get(BMR)}, TDEE={ud.get(TDEE)}, TARGET_CALORIES={ud.get(TARGET_CALORIES)}")
+            logger.error("User %s: Calculated values are None. Data: BMI=%s, BMR=%s, TDEE=%s, TARGET_CALORIES=%s", user_id, ud.get(BMI), ud.get(BMR), ud.get(TDEE), ud.get(TARGET_CALORIES))
             await query.edit_message_text("Ой, ошибка при расчете. 😥 /start заново.")
             ud.pop(PROFILE_COMPLETE, None); return ConversationHandler.END
-        ud[PROFILE_COMPLETE] = True; logger.info(f"User {user_id}: PROFILE_COMPLETE set to True.")
+        ud[PROFILE_COMPLETE] = True; logger.info("User %s: PROFILE_COMPLETE set to True.", user_id)
         ud.pop(AWAITING_WEIGHT_UPDATE, None)
         weight_change_prediction_text = ""
         if ud.get(TDEE) and ud.get(TARGET_CALORIES):
@@ -193,19 +1673,17 @@ async def process_final_profile(update: Update, context: ContextTypes.DEFAULT_TY
         bmi_interp = get_bmi_interpretation(ud.get(BMI))
         summary = (f"🎉 *Поздравляю!* Твой профиль полностью готов. Вот твои ключевые показатели:\n\n👤 *Твой профиль:*\n  - Пол: _{ud.get(GENDER, 'N/A').capitalize()}_\n  - Возраст: _{ud.get(AGE, 'N/A')} лет_\n  - Рост: _{ud.get(HEIGHT, 'N/A')} см_\n  - Вес: _{ud.get(CURRENT_WEIGHT, 'N/A')} кг_\n  - Активность: _{ud.get(ACTIVITY_LEVEL, 'N/A').capitalize()}_\n  - Цель: _{ud.get(GOAL, 'N/A').capitalize()}_\n\n📊 *Расчетные показатели:*\n  - ИМТ: *{ud.get(BMI, 'N/A')}*{bmi_interp}\n  - BMR (базальный метаболизм): *{ud.get(BMR, 'N/A')} ккал/день*\n  - TDEE (суточная потребность): *{ud.get(TDEE, 'N/A')} ккал/день*\n  - ✨ *Рекомендуемые калории для цели:* `{ud.get(TARGET_CALORIES, 'N/A')}` *ккал/день* ✨\n{weight_change_prediction_text}\nТеперь я готов помогать тебе на пути к цели! Используй /menu для быстрого доступа к функциям.\n\n⚠️ *Помни, эти расчеты и прогнозы носят рекомендательный характер. Для точных медицинских советов проконсультируйся с врачом.*")
         await query.edit_message_text(text=summary, parse_mode=ParseMode.MARKDOWN)
-        logger.info(f"User {user_id}: Profile summary sent. Exiting."); return ConversationHandler.END
+        logger.info("User %s: Profile summary sent. Exiting.", user_id); return ConversationHandler.END
     except Exception as e:
-        logger.error(f"User {user_id}: ERROR in process_final_profile: {e}", exc_info=True)
+        logger.error("User %s: ERROR in process_final_profile: %s", user_id, e, exc_info=True)
         try: await query.edit_message_text("Ой, что-то пошло не так при расчете твоего профиля. 😥 Попробуй начать заново с /start.")
-        except Exception as e_fallback: logger.error(f"User {user_id}: Failed to send fallback error message: {e_fallback}")
+        except Exception as e_fallback: logger.error("User %s: Failed to send fallback error message: %s", user_id, e_fallback)
         ud.pop(PROFILE_COMPLETE, None); return ConversationHandler.END
 async def cancel_onboarding(update: Update, context: ContextTypes.DEFAULT_TYPE) -> int:
     user_id = update.effective_user.id
     if not context.user_data.get(PROFILE_COMPLETE):
-        logger.info(f"User {user_id} отменил создание профиля.")
-        context.user_data.clear()
-        context.user_data[LAST_MEAL_DATE] = date.today().isoformat()
-        context.user_data[TODAY_MEALS] = []
+        logger.info("User %s отменил создание профиля.", user_id)
+        reset_user_data(context.user_data)
         await update.message.reply_text("❌ Создание профиля отменено. Можешь начать заново командой /start.")
     else: await update.message.reply_text("👍 Твой профиль уже создан. Если хочешь начать заново, используй /start (старый профиль будет сброшен).")
     for key in ['current_meal_type', 'current_meal_description', AWAITING_WEIGHT_UPDATE]: context.user_data.pop(key, None)
@@ -216,12 +1694,9 @@ async def cancel_onboarding(update: Update, context: ContextTypes.DEFAULT_TYPE)
 async def add_meal_start(update: Update, context: ContextTypes.DEFAULT_TYPE) -> int:
     # ... (код add_meal_start из v2.7, с логами и проверкой дня) ...
     user_id = update.effective_user.id
-    logger.info(f"User {user_id}: Initiating /addmeal.")
-    today_str = date.today().isoformat()
-    if context.user_data.get(LAST_MEAL_DATE) != today_str:
-        context.user_data[TODAY_MEALS] = []
-        context.user_data[LAST_MEAL_DATE] = today_str
-        logger.info(f"User {user_id}: Новый день, данные о приемах пищи сброшены для /addmeal.")
+    logger.info("User %s: Initiating /addmeal.", user_id)
+    if ensure_current_day(context.user_data):
+        logger.info("User %s: Новый день, данные о приемах пищи сброшены для /addmeal.", user_id)
         if update.message: await update.message.reply_text("☀️ Новый день - новые записи о питании!")
     if not context.user_data.get(PROFILE_COMPLETE):
         msg = update.callback_query.message if update.callback_query else update.message
@@ -231,7 +1706,7 @@ async def add_meal_start(update: Update, context: ContextTypes.DEFAULT_TYPE) ->
     msg_text = "Какой прием пищи ты хочешь записать?"
     target_message = update.message if update.message else update.callback_query.message
     if update.callback_query and update.callback_query.message.text == msg_text: # Предотвращаем редактирование того же сообщения с теми же кнопками
-        logger.info(f"User {user_id}: add_meal_start called from callback, message text is the same, not editing.")
+        logger.info("User %s: add_meal_start called from callback, message text is the same, not editing.", user_id)
         # Можно просто ничего не делать или отправить новое сообщение, если edit_text нежелателен
         # await update.callback_query.message.reply_text("Пожалуйста, выбери тип приема пищи:", reply_markup=InlineKeyboardMarkup(keyboard))
     elif update.callback_query:
@@ -242,55 +1717,75 @@ async def add_meal_start(update: Update, context: ContextTypes.DEFAULT_TYPE) ->
 async def add_meal_choose_type(update: Update, context: ContextTypes.DEFAULT_TYPE) -> int:
     query = update.callback_query
     user_id = update.effective_user.id
-    logger.info(f"User {user_id}: In add_meal_choose_type, callback_data: {query.data}")
+    logger.info("User %s: In add_meal_choose_type, callback_data: %s", user_id, query.data)
     await query.answer()
     meal_type_name = query.data.split('_')[1]
     context.user_data['current_meal_type'] = meal_type_name
     await query.edit_message_text(f"Записываем '{meal_type_name}'.\nОпиши подробно, что ты съел(а) и примерное количество (например, 'Овсянка на молоке 200г, 1 банан, кофе'):")
     return ADDMEAL_GET_DESCRIPTION
+async def _record_meal(update: Update, context: ContextTypes.DEFAULT_TYPE, meal_data: dict, meal_description: str, current_meal_type: str) -> None:
+    """Сохраняет проверенный прием пищи в TODAY_MEALS (MealLog) и отправляет итог за день."""
+    ud = context.user_data
+    meal = MealRecord.from_estimate(current_meal_type, meal_description, meal_data, time.time())
+    ensure_current_day(ud) # Описание могли прислать уже после полуночи
+    if not isinstance(ud.get(TODAY_MEALS), MealLog): ud[TODAY_MEALS] = MealLog()
+    ud[TODAY_MEALS].append(meal)
+    if MEAL_HISTORY is not None:
+        try: await MEAL_HISTORY.record_meal(update.effective_user.id, date.fromisoformat(ud[LAST_MEAL_DATE]), meal)
+        except sqlite3.Error as e: logger.error("User %s: Не удалось записать прием пищи в архив: %s", update.effective_user.id, e)
+    response_text = f"✅ Прием пищи '{current_meal_type}' записан!\nТы съел(а): {meal_description}\n"
+    if len(meal):
+        response_text += "Примерная оценка по продуктам:\n"
+        for name, quantity, kcal, *_ in meal.items(): response_text += f"  - {name} ({quantity}) ≈ {display_number(kcal)} ккал\n"
+    response_text += f"Всего за этот прием: *{display_number(meal.calories)} ккал*.\n\n"
+    ud.pop('current_meal_type', None); ud.pop('current_meal_description', None)
+    await show_today_calories(update, context, pre_text=response_text)
 async def add_meal_get_description(update: Update, context: ContextTypes.DEFAULT_TYPE) -> int:
     # ... (код add_meal_get_description из v2.7, с логами, JSON парсингом и вызовом show_today_calories) ...
     meal_description = update.message.text; ud = context.user_data; current_meal_type = ud.get('current_meal_type', 'Прием пищи'); user_id = update.effective_user.id
-    logger.info(f"User {user_id}: In add_meal_get_description, meal_type: {current_meal_type}, description: {meal_description}")
+    logger.info("User %s: In add_meal_get_description, meal_type: %s, description: %s", user_id, current_meal_type, meal_description)
+    local_items, unknown_items = analyze_meal_locally(meal_description, FOOD_INDEX)
+    if local_items and not unknown_items:
+        logger.info("User %s: Все продукты найдены в локальной таблице КБЖУ, AI не вызывается.", user_id)
+        MEAL_ESTIMATES.inc(1, "local")
+        await _record_meal(update, context, {"meal_name": current_meal_type, "items": local_items, "total": sum_meal_items(local_items)}, meal_description, current_meal_type)
+        return ConversationHandler.END
+    cache_key = normalize_meal_description(meal_description)
+    cached_estimate = MEAL_CACHE.get(cache_key) if cache_key else None
+    if cached_estimate is not None:
+        logger.info("User %s: Оценка КБЖУ взята из кэша (ключ: %s).", user_id, cache_key)
+        MEAL_ESTIMATES.inc(1, "cache")
+        await _record_meal(update, context, {"meal_name": current_meal_type, **cached_estimate}, meal_description, current_meal_type)
+        return ConversationHandler.END
     await update.message.reply_text(f"Понял! Анализирую калорийность для '{current_meal_type}'... 🤔 Это может занять до 30 секунд.")
     profile_info = (f"Профиль пользователя: Цель калорий в день: {ud.get(TARGET_CALORIES, 'не указана')} ккал. Текущий вес: {ud.get(CURRENT_WEIGHT, 'N/A')} кг. Цель: {ud.get(GOAL, 'N/A')}.")
-    prompt = (f"{profile_info} Пользователь описывает съеденную пищу для приема '{current_meal_type}':\n'{meal_description}'\n\nТвоя задача: Оцени КБЖУ для каждого продукта/блюда. Верни ответ в СТРОГОМ JSON формате (только JSON, без текста до/после, все значения КБЖУ - числа):\n{{\n  \"meal_name\": \"{current_meal_type}\",\n  \"items\": [\n    {{\"name\": \"[Продукт 1]\", \"quantity\": \"[Кол-во 1]\", \"calories\": X, \"protein\": Y, \"fat\": Z, \"carbs\": W}},\n    {{\"name\": \"[Продукт 2]\", \"quantity\": \"[Кол-во 2]\", \"calories\": X, \"protein\": Y, \"fat\": Z, \"carbs\": W}}\n  ],\n  \"total\": {{\"calories\": X_total, \"protein\": Y_total, \"fat\": Z_total, \"carbs\": W_total}}\n}}\nЕсли продукт не можешь оценить, КБЖУ 0 или пропусти, но посчитай итог по остальным. Будь точным.")
-    ai_response_json_str = await ask_groq(prompt, temperature=0.1)
-    try:
-        if ai_response_json_str.startswith("```json"): ai_response_json_str = ai_response_json_str[7:]
-        if ai_response_json_str.endswith("```"): ai_response_json_str = ai_response_json_str[:-3]
-        ai_response_json_str = ai_response_json_str.strip()
-        logger.info(f"User {user_id}: AI response for meal: {ai_response_json_str}")
-        meal_data = json.loads(ai_response_json_str)
-        if not isinstance(meal_data, dict) or 'total' not in meal_data or not all(k in meal_data['total'] for k in ['calories', 'protein', 'fat', 'carbs']) or not all(isinstance(meal_data['total'][k], (int, float)) for k in ['calories', 'protein', 'fat', 'carbs']):
-            raise ValueError("Ответ AI не содержит корректные числовые поля total КБЖУ или имеет неверную структуру.")
-        meal_data['user_description'] = meal_description; meal_data['timestamp'] = datetime.now().isoformat()
-        if TODAY_MEALS not in ud or not isinstance(ud[TODAY_MEALS], list): ud[TODAY_MEALS] = []
-        ud[TODAY_MEALS].append(meal_data)
-        total_cals = meal_data.get('total', {}).get('calories', 0)
-        response_text = f"✅ Прием пищи '{current_meal_type}' записан!\nТы съел(а): {meal_description}\n"
-        if isinstance(meal_data.get("items"), list) and meal_data["items"]:
-            response_text += "Примерная оценка по продуктам:\n"
-            for item in meal_data["items"]: response_text += f"  - {item.get('name','?')} ({item.get('quantity','?')}) ≈ {item.get('calories',0)} ккал\n"
-        response_text += f"Всего за этот прием: *{total_cals} ккал*.\n\n"
-        ud.pop('current_meal_type', None); ud.pop('current_meal_description', None)
-        await show_today_calories(update, context, pre_text=response_text)
-        return ConversationHandler.END
-    except json.JSONDecodeError as e:
-        logger.error(f"User {user_id}: Ошибка декодирования JSON от AI для еды: {e}. Ответ AI: '{ai_response_json_str}'")
-        await update.message.reply_text("Ой, не смог разобрать ответ от AI по калориям. 🤖 Попробуй описать блюдо иначе.")
-    except ValueError as e:
-        logger.error(f"User {user_id}: Ошибка в структуре JSON от AI для еды: {e}. Ответ AI: '{ai_response_json_str}'")
-        await update.message.reply_text("AI вернул данные в неожиданном формате. Попробуй еще раз.")
-    except Exception as e:
-        logger.error(f"User {user_id}: Непредвиденная ошибка в add_meal_get_description: {e}", exc_info=True)
-        await update.message.reply_text("Произошла внутренняя ошибка при обработке приема пищи.")
+    if local_items: # Часть продуктов уже оценена локально - спрашиваем AI только про остальные
+        logger.info("User %s: Локально оценено %s позиций, в AI уходят только: %s", user_id, len(local_items), unknown_items)
+        prompt = (f"Оцени КБЖУ для продуктов: '{', '.join(unknown_items)}'. Верни ТОЛЬКО JSON (все значения КБЖУ - числа):\n{{\"items\": [{{\"name\": \"...\", \"quantity\": \"...\", \"calories\": X, \"protein\": Y, \"fat\": Z, \"carbs\": W}}], \"total\": {{\"calories\": X, \"protein\": Y, \"fat\": Z, \"carbs\": W}}}}")
+    else: prompt = (f"{profile_info} Пользователь описывает съеденную пищу для приема '{current_meal_type}':\n'{meal_description}'\n\nТвоя задача: Оцени КБЖУ для каждого продукта/блюда. Верни ответ в СТРОГОМ JSON формате (только JSON, без текста до/после, все значения КБЖУ - числа):\n{{\n  \"meal_name\": \"{current_meal_type}\",\n  \"items\": [\n    {{\"name\": \"[Продукт 1]\", \"quantity\": \"[Кол-во 1]\", \"calories\": X, \"protein\": Y, \"fat\": Z, \"carbs\": W}},\n    {{\"name\": \"[Продукт 2]\", \"quantity\": \"[Кол-во 2]\", \"calories\": X, \"protein\": Y, \"fat\": Z, \"carbs\": W}}\n  ],\n  \"total\": {{\"calories\": X_total, \"protein\": Y_total, \"fat\": Z_total, \"carbs\": W_total}}\n}}\nЕсли продукт не можешь оценить, КБЖУ 0 или пропусти, но посчитай итог по остальным. Будь точным.")
+    MEAL_ESTIMATES.inc(1, "ai")
+    meal_data, ai_reply, ai_outcome = await ask_groq_json(prompt, MEAL_ESTIMATE_SCHEMA, MEAL_ESTIMATE_VALIDATOR, update.message, temperature=0.1)
+    logger.debug("User %s: AI response for meal: %s", user_id, ai_reply)
+    if meal_data is None:
+        logger.error("User %s: AI не вернул корректную оценку КБЖУ. Ответ AI: '%s'", user_id, ai_reply)
+        await update.message.reply_text(ai_reply if ai_outcome not in AI_REPLY_OUTCOMES else "AI вернул данные в неожиданном формате. 🤖 Попробуй описать блюдо иначе.")
+    else:
+        try:
+            if local_items:
+                meal_data = {"meal_name": current_meal_type, "items": local_items + meal_data["items"], "total": sum_meal_items(local_items + [meal_data["total"]])}
+            if cache_key: MEAL_CACHE.put(cache_key, {"items": meal_data["items"], "total": meal_data["total"]})
+            if MEAL_CACHE.needs_save: context.application.create_task(asyncio.to_thread(MEAL_CACHE.save))
+            await _record_meal(update, context, meal_data, meal_description, current_meal_type)
+            return ConversationHandler.END
+        except Exception as e:
+            logger.error("User %s: Непредвиденная ошибка в add_meal_get_description: %s", user_id, e, exc_info=True)
+            await update.message.reply_text("Произошла внутренняя ошибка при обработке приема пищи.")
     ud.pop('current_meal_type', None); ud.pop('current_meal_description', None)
     return ConversationHandler.END
 async def add_meal_cancel(update: Update, context: ContextTypes.DEFAULT_TYPE) -> int:
     # ... (код add_meal_cancel из v2.7) ...
     user_id = update.effective_user.id
-    logger.info(f"User {user_id}: Отмена записи приема пищи.")
+    logger.info("User %s: Отмена записи приема пищи.", user_id)
     await update.message.reply_text("❌ Запись приема пищи отменена.")
     context.user_data.pop('current_meal_type', None)
     context.user_data.pop('current_meal_description', None)
@@ -300,36 +1795,26 @@ async def add_meal_cancel(update: Update, context: ContextTypes.DEFAULT_TYPE) ->
 async def show_today_calories(update: Update, context: ContextTypes.DEFAULT_TYPE, pre_text=""):
     # ... (код show_today_calories из v2.7, но с исправленной строкой для "нет записей") ...
     user = update.effective_user
-    today_str = date.today().isoformat()
-    if context.user_data.get(LAST_MEAL_DATE) != today_str:
-        context.user_data[TODAY_MEALS] = []
-        context.user_data[LAST_MEAL_DATE] = today_str
-        logger.info(f"User {user.id}: Новый день, данные о приемах пищи сброшены для /todaycalories.")
+    if ensure_current_day(context.user_data): logger.info("User %s: Новый день, данные о приемах пищи сброшены для /todaycalories.", user.id)
     if not context.user_data.get(PROFILE_COMPLETE):
         msg_target = update.message if update.message else update.callback_query.message
         await msg_target.reply_text("Сначала создай профиль через /start, чтобы я мог отслеживать твои калории. 🌟")
         return
-    today_meals_data = context.user_data.get(TODAY_MEALS, [])
-    total_calories_today, total_protein_today, total_fat_today, total_carbs_today = 0,0,0,0
+    today_meals = context.user_data.get(TODAY_MEALS)
+    if not isinstance(today_meals, MealLog): today_meals = context.user_data[TODAY_MEALS] = MealLog()
+    total_calories_today, total_protein_today, total_fat_today, total_carbs_today = today_meals.totals # Накоплено при добавлении, не пересчитывается
     summary_meals_text = ""
-    if not today_meals_data: # ИСПРАВЛЕНО
+    if not today_meals: # ИСПРАВЛЕНО
         summary_meals_text = "🫙 За сегодня еще не было записано приемов пищи. Используй команду /addmeal, чтобы добавить первый!\n"
     else:
-        summary_meals_text = "*За сегодня ты съел(а):*\n"
-        for meal_entry in today_meals_data:
-            meal_name = meal_entry.get('meal_name', 'Прием пищи')
-            items_text_list = []
-            if isinstance(meal_entry.get("items"), list):
-                for item in meal_entry["items"]: items_text_list.append(f"  - {item.get('name','?')} ({item.get('quantity','?')}) ≈ {item.get('calories',0)} ккал")
-            total_meal_cals = meal_entry.get('total', {}).get('calories', 0)
-            total_meal_p = meal_entry.get('total', {}).get('protein', 0)
-            total_meal_f = meal_entry.get('total', {}).get('fat', 0)
-            total_meal_c = meal_entry.get('total', {}).get('carbs', 0)
-            summary_meals_text += f"\n🍽️ *{meal_name}* (Общ: {total_meal_cals} ккал, Б:{total_meal_p:.1f} Ж:{total_meal_f:.1f} У:{total_meal_c:.1f}):\n" # Добавил округление БЖУ
-            if items_text_list: summary_meals_text += "\n".join(items_text_list) + "\n"
-            else: summary_meals_text += f"  _{meal_entry.get('user_description', 'Детали не распознаны')}_\n"
-            total_calories_today += total_meal_cals; total_protein_today += total_meal_p; total_fat_today += total_meal_f; total_carbs_today += total_meal_c
-        summary_meals_text += f"\n*📊 Итого за сегодня:*\n  Ккал: *{total_calories_today}*,\n  Белки: {total_protein_today:.1f} г,\n  Жиры: {total_fat_today:.1f} г,\n  Углеводы: {total_carbs_today:.1f} г\n"
+        if not pre_text: # После /addmeal только что записанный прием уже расписан в pre_text - показываем лишь итог дня
+            summary_meals_text = "*За сегодня ты съел(а):*\n"
+            for meal in today_meals:
+                kcal, protein, fat, carbs = meal.totals
+                summary_meals_text += f"\n🍽️ *{meal.meal_name}* (Общ: {display_number(kcal)} ккал, Б:{protein:.1f} Ж:{fat:.1f} У:{carbs:.1f}):\n" # Добавил округление БЖУ
+                if len(meal): summary_meals_text += "\n".join(f"  - {name} ({quantity}) ≈ {display_number(item_kcal)} ккал" for name, quantity, item_kcal, *_ in meal.items()) + "\n"
+                else: summary_meals_text += f"  _{meal.description or 'Детали не распознаны'}_\n"
+        summary_meals_text += f"\n*📊 Итого за сегодня (приемов пищи: {len(today_meals)}):*\n  Ккал: *{display_number(total_calories_today)}*,\n  Белки: {total_protein_today:.1f} г,\n  Жиры: {total_fat_today:.1f} г,\n  Углеводы: {total_carbs_today:.1f} г\n"
     target_cals = context.user_data.get(TARGET_CALORIES)
     remaining_cals_text = ""
     if target_cals is not None and isinstance(target_cals, (int, float)):
@@ -342,6 +1827,720 @@ async def show_today_calories(update: Update, context: ContextTypes.DEFAULT_TYPE
 async def today_calories_command(update: Update, context: ContextTypes.DEFAULT_TYPE):
     await show_today_calories(update, context)
 
+async def stats_command(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    if not context.user_data.get(PROFILE_COMPLETE):
+        await update.message.reply_text("Сначала создай профиль через /start, чтобы я мог вести статистику питания. 🌟")
+        return
+    if MEAL_HISTORY is None:
+        await update.message.reply_text("📊 История питания сейчас недоступна (хранилище не настроено).")
+        return
+    target_cals = context.user_data.get(TARGET_CALORIES); today = user_today(context.user_data)
+    stats_text = "📊 *Статистика питания:*\n"
+    for days in STATS_PERIODS:
+        summary = await MEAL_HISTORY.summarize(update.effective_user.id, days, today)
+        stats_text += f"\n*За {days} дн.:* "
+        if not summary["days"]: stats_text += "записей нет.\n"; continue
+        logged_days = summary["days"]; avg_cals = summary["calories"] / logged_days
+        stats_text += f"записей {summary['meals']} за {logged_days} дн.\n  В среднем в день: *{avg_cals:.0f} ккал*, Б: {summary['protein'] / logged_days:.1f} г, Ж: {summary['fat'] / logged_days:.1f} г, У: {summary['carbs'] / logged_days:.1f} г\n"
+        if isinstance(target_cals, (int, float)) and target_cals: stats_text += f"  От цели ({target_cals} ккал): *{avg_cals / target_cals * 100:.0f}%*\n"
+    await update.message.reply_text(stats_text, parse_mode=ParseMode.MARKDOWN)
+
+# --- Импорт истории приемов пищи из CSV/TXT: файл читается потоково, описания уходят в AI пачками, прогресс - в одном сообщении ---
+IMPORT_DIR = os.getenv("IMPORT_DIR", "imports") # Загруженные файлы лежат здесь до конца импорта
+IMPORT_MAX_BYTES = int(os.getenv("IMPORT_MAX_BYTES", str(5 * 1024 * 1024)))
+IMPORT_AI_BATCH = int(os.getenv("IMPORT_AI_BATCH", "10")) # Приемов пищи в одном запросе к Groq
+IMPORT_READ_LINES = int(os.getenv("IMPORT_READ_LINES", "50")) # Строк за одно чтение файла и одну транзакцию
+IMPORT_PROGRESS_INTERVAL = float(os.getenv("IMPORT_PROGRESS_INTERVAL", "3")) # Не чаще одного редактирования сообщения о прогрессе в N секунд
+IMPORT_STALE_AFTER = float(os.getenv("IMPORT_STALE_AFTER", "600")) # SHARED_STATE: задание воркера, молчащего N секунд, забирает другой воркер
+IMPORT_MAX_LINE_CHARS = 500
+IMPORT_OWNER = f"{os.uname().nodename}:{os.getpid()}"
+_IMPORT_MEAL_TYPES = {"завтрак": ("Завтрак", 8), "обед": ("Обед", 13), "перекус": ("Перекус", 16), "ужин": ("Ужин", 19)} # Час по умолчанию, если время не указано
+_IMPORT_LINE_RE = re.compile(r"^(\d{4}-\d{1,2}-\d{1,2}|\d{1,2}\.\d{1,2}\.\d{4})(?:([ T,;\t|]+)(\d{1,2}:\d{2}))? *([,;\t|]?)\s*(.*)$")
+_IMPORT_MEAL_PREFIX_RE = re.compile(r"^(завтрак|обед|ужин|перекус)\s*[:\-—]\s*", re.IGNORECASE)
+IMPORT_HELP_TEXT = ("📥 *Импорт истории питания*\n\nПришли файл .csv или .txt (до {max_mb} МБ), по одному приему пищи в строке:\n"
+                    "`2024-05-01 08:30 Завтрак: овсянка 200г, банан`\n`01.05.2024 Обед: борщ, хлеб`\nили CSV: `дата,время,прием,описание`.\n\n"
+                    "Время и тип приема необязательны. Строки без даты (например, заголовок) пропускаются. Записи попадут в /stats.")
+_import_tasks: dict[int, asyncio.Task] = {} # user_id -> задача импорта в этом процессе
+
+class ImportPaused(Exception):
+    """AI недоступен: задание приостанавливается с текущей позиции, /import продолжит его."""
+
+def parse_import_line(line: str) -> tuple[datetime, str, str] | None:
+    """Строка файла -> (время, прием пищи, описание) или None, если строка не распознана."""
+    match = _IMPORT_LINE_RE.match(line.lstrip("\ufeff").strip())
+    if not match: return None
+    raw_day, time_sep, raw_time, sep, rest = match.groups()
+    try:
+        day = date.fromisoformat("-".join(f"{int(p):02d}" for p in raw_day.split("-"))) if "-" in raw_day else datetime.strptime(raw_day, "%d.%m.%Y").date()
+        at = datetime.strptime(raw_time, "%H:%M").time() if raw_time else None
+    except ValueError: return None
+    sep = sep or (time_sep or "").strip(" T")[:1] # Табуляция - тоже разделитель, пробелы и T из ISO - нет
+    cells = [c.strip() for c in (next(csv.reader([rest], delimiter=sep)) if sep else [rest])]
+    while len(cells) > 1 and not cells[0]: cells.pop(0) # Пустая колонка времени в CSV
+    meal_name, hour = "Прием пищи", 12
+    if len(cells) > 1 and cells[0].lower() in _IMPORT_MEAL_TYPES: meal_name, hour = _IMPORT_MEAL_TYPES[cells.pop(0).lower()]
+    elif cells and (prefix := _IMPORT_MEAL_PREFIX_RE.match(cells[0])):
+        meal_name, hour = _IMPORT_MEAL_TYPES[prefix.group(1).lower()]; cells[0] = cells[0][prefix.end():]
+    description = ", ".join(c for c in cells if c)
+    if not description or len(description) > IMPORT_MAX_LINE_CHARS: return None
+    return datetime.combine(day, at or dtime(hour=hour)), meal_name, description
+
+def _decode_import_line(raw: bytes) -> str:
+    try: return raw.decode("utf-8")
+    except UnicodeDecodeError: return raw.decode("cp1251", errors="replace") # Выгрузки из Excel под Windows
+
+def _read_import_chunk(path: str, offset: int, max_lines: int) -> tuple[list[bytes], int]:
+    """До max_lines строк начиная с байта offset и позиция после них - файл целиком в память не читается."""
+    with open(path, "rb") as f:
+        f.seek(offset); lines = []
+        while len(lines) < max_lines and (line := f.readline()): lines.append(line)
+        return lines, f.tell()
+
+def _count_import_lines(path: str) -> int:
+    count, last = 0, b"\n"
+    with open(path, "rb") as f:
+        while chunk := f.read(1 << 16): count += chunk.count(b"\n"); last = chunk[-1:]
+    return count + (last != b"\n")
+
+def import_batch_prompt(descriptions: list[str]) -> str:
+    numbered = "\n".join(f"{n}. {d}" for n, d in enumerate(descriptions, 1))
+    return (f"Оцени КБЖУ для каждого из {len(descriptions)} приемов пищи ниже. Верни ТОЛЬКО JSON-объект с массивом meals из {len(descriptions)} элементов в том же порядке (без текста до/после, все значения КБЖУ - числа):\n"
+            '{"meals": [{"index": 1, "items": [{"name": "...", "quantity": "...", "calories": X, "protein": Y, "fat": Z, "carbs": W}], "total": {"calories": X, "protein": Y, "fat": Z, "carbs": W}}]}\n\n'
+            f"Приемы пищи:\n{numbered}")
+
+def parse_import_batch_reply(reply: str, count: int) -> list[dict | None] | None:
+    """Ответ на import_batch_prompt -> оценка или None для каждого приема; None целиком, если в ответе нет массива приемов.
+    Оборванный ответ после repair_json дает первые целые приемы, остальные уйдут в повторный запрос."""
+    data = parse_ai_json(reply)
+    meals = data.get("meals") if isinstance(data, dict) else data
+    if not isinstance(meals, list): return None
+    estimates = [None] * count
+    for position, entry in enumerate(meals):
+        try: entry = IMPORT_MEAL_VALIDATOR(entry)
+        except ValueError: continue # Невалидный прием не портит остальные в пачке
+        index = entry["index"] - 1 if 1 <= entry.get("index", 0) <= count else position
+        if index < count: estimates[index] = {"items": entry["items"], "total": entry["total"]}
+    return estimates
+
+async def estimate_import_meals(descriptions: list[str]) -> list[dict | None]:
+    """Локальная таблица и кэш, затем остальное пачками по IMPORT_AI_BATCH в AI; не оцененные с первого раза - еще одна попытка."""
+    results: list[dict | None] = [None] * len(descriptions); pending = []
+    for i, description in enumerate(descriptions):
+        local_items, unknown_items = analyze_meal_locally(description, FOOD_INDEX)
+        if local_items and not unknown_items:
+            results[i] = {"items": local_items, "total": sum_meal_items(local_items)}; MEAL_ESTIMATES.inc(1, "local"); continue
+        cache_key = normalize_meal_description(description)
+        cached_estimate = MEAL_CACHE.get(cache_key) if cache_key else None
+        if cached_estimate is not None: results[i] = cached_estimate; MEAL_ESTIMATES.inc(1, "cache")
+        else: pending.append(i)
+    for attempt in range(2):
+        unavailable = 0
+        for start in range(0, len(pending), IMPORT_AI_BATCH):
+            batch = pending[start:start + IMPORT_AI_BATCH]
+            if attempt: _ai_json_counters["rerequested"] += 1
+            reply, outcome = await ask_groq_queued(import_batch_prompt([descriptions[i] for i in batch]), temperature=0.1, response_format=json_response_format(IMPORT_BATCH_SCHEMA))
+            estimates = parse_import_batch_reply(reply, len(batch)) if outcome in AI_REPLY_OUTCOMES else None
+            if estimates is None:
+                logger.warning("Импорт: AI не оценил пачку из %s приемов пищи (%s): %s", len(batch), outcome, reply[:200])
+                unavailable += outcome not in AI_REPLY_OUTCOMES; continue
+            MEAL_ESTIMATES.inc(sum(e is not None for e in estimates), "ai")
+            for i, estimate in zip(batch, estimates):
+                if estimate is None: continue
+                results[i] = estimate
+                if cache_key := normalize_meal_description(descriptions[i]): MEAL_CACHE.put(cache_key, estimate)
+        if pending and unavailable == -(-len(pending) // IMPORT_AI_BATCH): raise ImportPaused(reply) # Не ответила ни одна пачка
+        pending = [i for i in pending if results[i] is None]
+        if not pending: break
+    if MEAL_CACHE.needs_save: await asyncio.to_thread(MEAL_CACHE.save)
+    return results
+
+def import_progress_text(job: dict) -> str:
+    percent = job["lines_done"] * 100 // job["total_lines"] if job["total_lines"] else 100
+    header = {"running": f"📥 Импорт: {percent}% ({job['lines_done']} из {job['total_lines']} строк)", "done": "✅ Импорт завершен!",
+              "paused": f"⏸️ Импорт приостановлен на {percent}%: AI сейчас недоступен. Продолжить - /import", "failed": "💥 Импорт прерван из-за внутренней ошибки."}[job["status"]]
+    return f"{header}\nЗаписано приемов пищи: {job['imported']}\nНе удалось оценить: {job['failed']}\nПропущено строк: {job['skipped']}"
+
+async def _edit_import_progress(bot, job: dict) -> None:
+    if not job["message_id"]: return
+    try: await bot.edit_message_text(import_progress_text(job), chat_id=job["chat_id"], message_id=job["message_id"])
+    except RetryAfter as e: logger.info("Импорт %s: прогресс не обновлен, Telegram просит подождать %.0f с", job["id"], _retry_after_seconds(e))
+    except BadRequest as e: logger.info("Импорт %s: прогресс не обновлен: %s", job["id"], e) # Например, сообщение удалено
+    except TelegramError as e: logger.warning("Импорт %s: прогресс не обновлен, ошибка Telegram: %s", job["id"], e) # Сеть или таймаут не должны останавливать импорт
+
+async def run_import_job(bot, job: dict) -> None:
+    """Обрабатывает файл задания с job["byte_offset"] до конца; каждая пачка строк пишется вместе с новой позицией одной транзакцией."""
+    logger.info("User %s: импорт %s с байта %s (%s/%s строк)", job["user_id"], job["id"], job["byte_offset"], job["lines_done"], job["total_lines"])
+    last_progress = time.monotonic()
+    try:
+        while True:
+            lines, next_offset = await asyncio.to_thread(_read_import_chunk, job["path"], job["byte_offset"], IMPORT_READ_LINES)
+            if not lines: break
+            entries, today = [], (datetime.now(timezone.utc) + timedelta(hours=14)).date() # Пояс пользователя здесь неизвестен - отсекаем только даты, которых нет еще нигде (UTC+14)
+            for raw in lines:
+                line = _decode_import_line(raw)
+                if not line.strip(): continue
+                parsed = parse_import_line(line)
+                if parsed is None or parsed[0].date() > today: job["skipped"] += 1
+                else: entries.append(parsed)
+            estimates = await estimate_import_meals([description for _, _, description in entries])
+            meals = [(when.date(), MealRecord.from_estimate(meal_name, description, estimate, when.timestamp())) for (when, meal_name, description), estimate in zip(entries, estimates) if estimate is not None]
+            job["failed"] += len(entries) - len(meals); job["imported"] += len(meals)
+            job["byte_offset"], job["lines_done"] = next_offset, job["lines_done"] + len(lines)
+            await MEAL_HISTORY.record_import_batch(job, meals)
+            if time.monotonic() - last_progress >= IMPORT_PROGRESS_INTERVAL:
+                await _edit_import_progress(bot, job); last_progress = time.monotonic()
+        job["status"] = "done"; job["lines_done"] = max(job["lines_done"], job["total_lines"])
+        await MEAL_HISTORY.set_import_status(job["id"], "done")
+        logger.info("User %s: импорт %s завершен: %s записано, %s не оценено, %s пропущено", job["user_id"], job["id"], job["imported"], job["failed"], job["skipped"])
+        try: os.remove(job["path"])
+        except OSError as e: logger.warning("Не удалось удалить файл импорта %s: %s", job["path"], e)
+    except ImportPaused as e:
+        logger.warning("User %s: импорт %s приостановлен, AI недоступен: %s", job["user_id"], job["id"], e)
+        job["status"] = "paused"; await MEAL_HISTORY.set_import_status(job["id"], "paused")
+    except Exception as e: # Любая непредвиденная ошибка: задание не должно остаться "running" без сообщения пользователю
+        logger.error("User %s: импорт %s прерван: %s", job["user_id"], job["id"], e, exc_info=True)
+        job["status"] = "failed"
+        try: await MEAL_HISTORY.set_import_status(job["id"], "failed")
+        except sqlite3.Error as e: logger.error("Импорт %s: статус failed не записан: %s", job["id"], e)
+    finally: _import_tasks.pop(job["user_id"], None)
+    await _edit_import_progress(bot, job)
+
+def start_import(bot, job: dict) -> None:
+    _import_tasks[job["user_id"]] = asyncio.create_task(run_import_job(bot, job), name=f"import-{job['id']}")
+
+async def resume_imports(app) -> None:
+    """После рестарта продолжает незавершенные задания; при SHARED_STATE - только брошенные другими воркерами дольше IMPORT_STALE_AFTER."""
+    jobs = await MEAL_HISTORY.claim_imports(IMPORT_OWNER, time.time() - IMPORT_STALE_AFTER if SHARED_STATE else float("inf"))
+    for job in jobs: start_import(app.bot, job)
+    if jobs: logger.info("Продолжаются прерванные импорты: %s", [job["id"] for job in jobs])
+
+async def stop_imports() -> None:
+    tasks = list(_import_tasks.values())
+    for task in tasks: task.cancel()
+    await asyncio.gather(*tasks, return_exceptions=True)
+    if MEAL_HISTORY is not None: await MEAL_HISTORY.release_imports(IMPORT_OWNER)
+
+# --- Часовые пояса пользователей, смена дня по расписанию и ежедневные напоминания с учетом flood-лимитов Telegram ---
+DEFAULT_TIMEZONE = os.getenv("DEFAULT_TIMEZONE", "") # Пояс пользователей, не выбравших свой (IANA или UTC+03:00); пусто - пояс сервера
+DAY_ROLLOVER_INTERVAL = float(os.getenv("DAY_ROLLOVER_INTERVAL", "300")) # Как часто JobQueue закрывает прошедшие дни
+DAY_ROLLOVER_BATCH = int(os.getenv("DAY_ROLLOVER_BATCH", "1000")) # Пользователей за шаг; между шагами цикл событий обрабатывает апдейты
+REMINDERS_POLL_INTERVAL = float(os.getenv("REMINDERS_POLL_INTERVAL", "30"))
+REMINDERS_BATCH = int(os.getenv("REMINDERS_BATCH", "500")) # Напоминаний, забираемых из базы одним запросом
+REMINDERS_MAX_LATENESS = float(os.getenv("REMINDERS_MAX_LATENESS", "7200")) # Опоздавшее сильнее (бот лежал) не отправляется, а переносится на завтра
+REMINDER_DEFAULT_TIME = os.getenv("REMINDER_DEFAULT_TIME", "21:00")
+BROADCAST_RATE = float(os.getenv("BROADCAST_RATE", "25")) # Сообщений/с на бота: лимит Telegram ~30, остаток - ответам на апдейты
+BROADCAST_CHAT_INTERVAL = float(os.getenv("BROADCAST_CHAT_INTERVAL", "1")) # Не чаще одного сообщения в чат за N секунд
+BROADCAST_CONCURRENCY = int(os.getenv("BROADCAST_CONCURRENCY", "16")) # Одновременных sendMessage (темп все равно задает BROADCAST_RATE)
+BROADCAST_QUEUE_MAX = int(os.getenv("BROADCAST_QUEUE_MAX", "5000")) # Больше напоминаний из базы не забирается, пока очередь не разойдется
+BROADCAST_MAX_ATTEMPTS = 3
+_UTC_OFFSET_RE = re.compile(r"(?:UTC|GMT)?\s*([+\-−])\s*(\d{1,2})(?:[:.]?(\d{2}))?", re.IGNORECASE)
+_REMINDER_TIME_RE = re.compile(r"([01]?\d|2[0-3])[:.]([0-5]\d)")
+TIMEZONE_CHOICES = (("Калининград", "Europe/Kaliningrad"), ("Москва", "Europe/Moscow"), ("Самара", "Europe/Samara"), ("Екатеринбург", "Asia/Yekaterinburg"), ("Омск", "Asia/Omsk"), ("Новосибирск", "Asia/Novosibirsk"),
+                    ("Красноярск", "Asia/Krasnoyarsk"), ("Иркутск", "Asia/Irkutsk"), ("Якутск", "Asia/Yakutsk"), ("Владивосток", "Asia/Vladivostok"), ("Магадан", "Asia/Magadan"), ("Камчатка", "Asia/Kamchatka"))
+_REMINDERS_SCHEMA = """
+CREATE TABLE IF NOT EXISTS reminders (user_id INTEGER PRIMARY KEY, chat_id INTEGER NOT NULL, local_time TEXT NOT NULL, tz TEXT, next_due_utc REAL NOT NULL);
+CREATE INDEX IF NOT EXISTS reminders_due ON reminders (next_due_utc);
+"""
+
+@functools.lru_cache(maxsize=1)
+def _iana_timezones() -> dict[str, str]:
+    return {name.lower(): name for name in available_timezones()}
+
+def parse_timezone(text: str) -> str | None:
+    """Ввод пользователя -> каноническое имя пояса: IANA без учета регистра ("europe/moscow" -> "Europe/Moscow") или смещение ("+3", "UTC+5:30" -> "UTC+05:30")."""
+    text = text.strip()
+    if text.upper() in ("UTC", "GMT", "Z"): return "UTC"
+    match = _UTC_OFFSET_RE.fullmatch(text)
+    if match:
+        hours, minutes = int(match.group(2)), int(match.group(3) or 0)
+        if minutes >= 60 or hours * 60 + minutes > 14 * 60: return None
+        return f"UTC{'+' if match.group(1) == '+' else '-'}{hours:02d}:{minutes:02d}"
+    return _iana_timezones().get(text.lower())
+
+@functools.lru_cache(maxsize=None) # Разных поясов - сотни, а не по одному на пользователя
+def get_timezone(name: str | None) -> tzinfo | None:
+    """Имя из parse_timezone -> tzinfo; None - пояс сервера (datetime.now(None) дает местное время, как раньше date.today())."""
+    name = name or DEFAULT_TIMEZONE
+    if not name: return None
+    if name.startswith("UTC") and len(name) > 3:
+        hours, minutes = name[4:].split(":")
+        offset = timedelta(hours=int(hours), minutes=int(minutes))
+        return timezone(-offset if name[3] == "-" else offset, name)
+    try: return ZoneInfo(name)
+    except (ZoneInfoNotFoundError, ValueError) as e:
+        logger.warning("Неизвестный часовой пояс %r (%s), используется пояс сервера.", name, e); return None
+
+def describe_timezone(name: str | None) -> str:
+    now = datetime.now(get_timezone(name))
+    if now.tzinfo is None: now = now.astimezone()
+    minutes = int(now.utcoffset().total_seconds() // 60)
+    return f"`{name or DEFAULT_TIMEZONE or 'пояс сервера'}` (UTC{'+' if minutes >= 0 else '-'}{abs(minutes) // 60:02d}:{abs(minutes) % 60:02d}, сейчас {now:%H:%M})"
+
+def user_today(ud: dict) -> date: return datetime.now(get_timezone(ud.get(TIMEZONE))).date()
+
+def ensure_current_day(ud: dict) -> bool:
+    """Начинает новый день в поясе пользователя: если сегодня позже LAST_MEAL_DATE, TODAY_MEALS сбрасываются
+    (сами приемы пищи остаются в архиве MealHistory). True - день сменился.
+    Если после смены пояса на запад местная дата стала раньше LAST_MEAL_DATE, день продолжается: эти приемы пищи съедены сегодня."""
+    today_str, last = user_today(ud).isoformat(), ud.get(LAST_MEAL_DATE)
+    if last is not None and last >= today_str: return False # ISO-даты сравниваются как строки
+    ud[TODAY_MEALS] = MealLog(); ud[LAST_MEAL_DATE] = today_str
+    return True
+
+def reset_user_data(ud: dict) -> None:
+    """Сброс профиля (новый /start или отмена онбординга). Часовой пояс - настройка, а не часть профиля, он сохраняется."""
+    zone = ud.get(TIMEZONE); ud.clear()
+    if zone: ud[TIMEZONE] = zone
+    ensure_current_day(ud)
+
+def next_local_time(tz: tzinfo | None, local_time: dtime, after: float) -> float:
+    """Ближайший момент (epoch) позже after, когда в поясе tz на часах local_time."""
+    day = datetime.fromtimestamp(after, tz).date()
+    for shift in range(3): # Переход на летнее время может "съесть" local_time сегодня
+        due = datetime.combine(day + timedelta(days=shift), local_time, tzinfo=tz).timestamp()
+        if due > after: return due
+    raise ValueError(f"Не удалось вычислить время {local_time} после {after}")
+
+_rollover_counters = {"in_memory": 0, "stored": 0}
+register_metric(CallbackMetric("fitbot_day_rollovers_total", "Дни, закрытые задачей смены дня: у пользователей в памяти (in_memory) и только в базе (stored)", lambda: dict(_rollover_counters), "counter", ("source",)))
+
+async def rollover_days(context: ContextTypes.DEFAULT_TYPE) -> None:
+    """Задача JobQueue: закрывает прошедшие дни пачками по DAY_ROLLOVER_BATCH, между пачками отпуская цикл событий.
+    Сначала - пользователи в памяти (их данные сразу уходят в хранилище), затем остальные - прямо в базе."""
+    app = context.application
+    persistence = app.persistence if isinstance(app.persistence, SQLitePersistence) else None
+    users, in_memory = list(app.user_data.items()), 0
+    for start in range(0, len(users), DAY_ROLLOVER_BATCH):
+        for user_id, ud in users[start:start + DAY_ROLLOVER_BATCH]:
+            if LAST_MEAL_DATE not in ud or not ensure_current_day(ud): continue
+            in_memory += 1
+            # В общем режиме данные в памяти могут быть устаревшими - в базе день закроет finalize_stale_days, а воркер перечитает профиль по версии
+            if persistence is not None and not persistence.shared: await persistence.update_user_data(user_id, ud)
+        await asyncio.sleep(0)
+    stored = 0
+    if persistence is not None:
+        await persistence.wait_written() # Пользователи из памяти уже записаны с новой датой и в выборку не попадут
+        try: stored = await persistence.finalize_stale_days(DAY_ROLLOVER_BATCH)
+        except sqlite3.Error as e: logger.error("Смена дня в базе прервана: %s", e)
+    _rollover_counters["in_memory"] += in_memory; _rollover_counters["stored"] += stored
+    if in_memory or stored: logger.info("Смена дня: закрыто дней в памяти - %s, в базе - %s.", in_memory, stored)
+
+class ReminderSchedule:
+    """Подписки на ежедневное напоминание с итогом дня. next_due_utc - следующая отправка (epoch) с учетом пояса пользователя:
+    созревшие находятся по индексу одним запросом, а забрать строку - значит сдвинуть next_due_utc на завтра,
+    поэтому при нескольких воркерах одно напоминание уходит один раз."""
+    def __init__(self, path: str):
+        self._conn = open_bot_db(path)
+        self._db_lock = threading.Lock()
+        with self._db_lock, self._conn: self._conn.executescript(_REMINDERS_SCHEMA)
+        self.late_skipped = 0
+    def _set(self, user_id: int, chat_id: int, local_time: str, zone: str | None) -> float:
+        due = next_local_time(get_timezone(zone), dtime.fromisoformat(local_time), time.time())
+        with self._db_lock, self._conn:
+            self._conn.execute("INSERT INTO reminders VALUES (?, ?, ?, ?, ?) ON CONFLICT(user_id) DO UPDATE SET chat_id = excluded.chat_id, local_time = excluded.local_time, tz = excluded.tz, next_due_utc = excluded.next_due_utc", (user_id, chat_id, local_time, zone, due))
+        return due
+    async def set(self, user_id: int, chat_id: int, local_time: str, zone: str | None) -> float:
+        return await asyncio.to_thread(self._set, user_id, chat_id, local_time, zone)
+    def _get(self, user_id: int) -> tuple | None:
+        with self._db_lock: return self._conn.execute("SELECT chat_id, local_time, tz, next_due_utc FROM reminders WHERE user_id = ?", (user_id,)).fetchone()
+    async def get(self, user_id: int) -> tuple | None: return await asyncio.to_thread(self._get, user_id)
+    async def set_timezone(self, user_id: int, zone: str | None) -> None:
+        """Пересчитывает время ближайшего напоминания под новый пояс пользователя."""
+        row = await self.get(user_id)
+        if row is not None: await self.set(user_id, row[0], row[1], zone)
+    async def disable(self, user_id: int) -> None:
+        def delete():
+            with self._db_lock, self._conn: self._conn.execute("DELETE FROM reminders WHERE user_id = ?", (user_id,))
+        await asyncio.to_thread(delete)
+    async def disable_chat(self, chat_id: int) -> None:
+        """Чат больше недоступен (бот заблокирован) - напоминания в него отключаются."""
+        def delete():
+            with self._db_lock, self._conn: self._conn.execute("DELETE FROM reminders WHERE chat_id = ?", (chat_id,))
+        await asyncio.to_thread(delete)
+        logger.info("Напоминания в чат %s отключены: чат недоступен.", chat_id)
+    def _claim_due(self, now: float, limit: int) -> tuple[list[dict], int]:
+        claimed = []
+        with self._db_lock:
+            rows = self._conn.execute(f"SELECT r.user_id, r.chat_id, r.local_time, r.tz, r.next_due_utc, p.{TARGET_CALORIES} FROM reminders r LEFT JOIN profiles p USING (user_id) WHERE r.next_due_utc <= ? ORDER BY r.next_due_utc LIMIT ?", (now, limit)).fetchall()
+            with self._conn:
+                for user_id, chat_id, local_time, zone, due, target in rows:
+                    tz = get_timezone(zone)
+                    next_due = next_local_time(tz, dtime.fromisoformat(local_time), max(now, due))
+                    if self._conn.execute("UPDATE reminders SET next_due_utc = ? WHERE user_id = ? AND next_due_utc = ?", (next_due, user_id, due)).rowcount != 1: continue # Забрал другой воркер
+                    if now - due > REMINDERS_MAX_LATENESS: self.late_skipped += 1; continue
+                    day = datetime.fromtimestamp(due, tz).date().isoformat()
+                    totals = self._conn.execute("SELECT calories, meals FROM daily_totals WHERE user_id = ? AND period = ?", (user_id, day)).fetchone() or (0, 0)
+                    claimed.append({"user_id": user_id, "chat_id": chat_id, "calories": totals[0], "meals": totals[1], "target": target})
+        return claimed, len(rows)
+    async def claim_due(self, now: float, limit: int) -> tuple[list[dict], int]:
+        """(напоминания с итогами дня для отправки, сколько строк созрело); следующая отправка каждого уже перенесена на завтра."""
+        return await asyncio.to_thread(self._claim_due, now, limit)
+
+REMINDERS: ReminderSchedule | None = None # Создается в on_startup, если задан BOT_DB_PATH
+
+class BroadcastQueue:
+    """Отправка сообщений, которые не отвечают на апдейт (напоминания). Общий token bucket держит темп rate сообщений/с на бота,
+    в один чат - не чаще раза в chat_interval. RetryAfter от Telegram приостанавливает всю рассылку на указанное время, сообщение
+    уходит повторно. Работает в фоновой задаче: цикл обработки апдейтов не ждет рассылку."""
+    def __init__(self, rate: float, chat_interval: float, concurrency: int, max_size: int):
+        self.bucket, self.chat_interval, self.max_size = TokenBucket(1, rate), chat_interval, max_size # Емкость 1 - ровный темп без всплесков
+        self._heap: list[tuple[float, int, int, str, int]] = [] # (не раньше, порядковый номер, chat_id, текст, попытка)
+        self._seq = 0
+        self._chat_next: dict[int, float] = {} # chat_id -> когда в этот чат можно следующее сообщение (по факту отправки)
+        self._slots = asyncio.Semaphore(concurrency)
+        self._wakeup = asyncio.Event()
+        self._task: asyncio.Task | None = None
+        self._sending: set[asyncio.Task] = set()
+        self.on_forbidden = None # async (chat_id) -> None: бот заблокирован в чате
+        self.sent = self.failed = self.retried = self.rate_limited = 0
+    @property
+    def depth(self) -> int: return len(self._heap)
+    def free_slots(self) -> int: return max(0, self.max_size - len(self._heap))
+    def put(self, chat_id: int, text: str) -> bool:
+        if len(self._heap) >= self.max_size: return False
+        self._push(chat_id, text, 0, 0.0); return True
+    def _push(self, chat_id: int, text: str, attempt: int, not_before: float) -> None:
+        self._seq += 1; heapq.heappush(self._heap, (max(time.monotonic(), not_before), self._seq, chat_id, text, attempt))
+        self._wakeup.set()
+    def start(self, bot) -> None:
+        if self._task is None or self._task.done(): self._task = asyncio.create_task(self._run(bot), name="broadcast")
+    async def stop(self) -> None:
+        if self._task is not None:
+            self._task.cancel(); await asyncio.gather(self._task, return_exceptions=True); self._task = None
+        await asyncio.gather(*self._sending, return_exceptions=True)
+        if self._heap: logger.warning("Рассылка остановлена, не отправлено сообщений: %s", len(self._heap))
+    async def _run(self, bot) -> None:
+        while True:
+            now = time.monotonic()
+            if not self._heap:
+                self._chat_next = {chat_id: at for chat_id, at in self._chat_next.items() if at > now}
+                self._wakeup.clear(); await self._wakeup.wait(); continue
+            wait = self._heap[0][0] - now
+            if wait <= 0: wait = self.bucket.wait_time(1)
+            if wait > 0: # Новое сообщение может оказаться готовым раньше - ждем его или таймаут
+                self._wakeup.clear()
+                try: await asyncio.wait_for(self._wakeup.wait(), wait)
+                except asyncio.TimeoutError: pass
+                continue
+            _, seq, chat_id, text, attempt = heapq.heappop(self._heap)
+            chat_ready = self._chat_next.get(chat_id, 0.0)
+            if chat_ready > now: # В этот чат недавно уже отправляли - сообщение ждет своей очереди, не занимая общий темп
+                heapq.heappush(self._heap, (chat_ready, seq, chat_id, text, attempt)); continue
+            self.bucket.take(1); self._chat_next[chat_id] = now + self.chat_interval
+            await self._slots.acquire()
+            task = asyncio.create_task(self._send(bot, chat_id, text, attempt))
+            self._sending.add(task); task.add_done_callback(self._sending.discard)
+    async def _send(self, bot, chat_id: int, text: str, attempt: int) -> None:
+        try:
+            await bot.send_message(chat_id, text, parse_mode=ParseMode.MARKDOWN); self.sent += 1
+        except RetryAfter as e: # Лимит превышен для всего бота: пауза для всех, попытка не тратится
+            seconds = _retry_after_seconds(e); self.rate_limited += 1
+            logger.warning("Рассылка: Telegram просит подождать %.0f с", seconds)
+            self.bucket.block_for(seconds); self._push(chat_id, text, attempt, time.monotonic() + seconds)
+        except Forbidden as e:
+            self.failed += 1; logger.info("Рассылка: чат %s недоступен: %s", chat_id, e)
+            if self.on_forbidden is not None: await self.on_forbidden(chat_id)
+        except BadRequest as e: self.failed += 1; logger.warning("Рассылка: сообщение в чат %s отклонено: %s", chat_id, e)
+        except TelegramError as e: # Сеть или таймаут - повтор с нарастающей паузой
+            if attempt + 1 >= BROADCAST_MAX_ATTEMPTS:
+                self.failed += 1; logger.warning("Рассылка: сообщение в чат %s не отправлено за %s попыток: %s", chat_id, attempt + 1, e)
+            else: self.retried += 1; self._push(chat_id, text, attempt + 1, time.monotonic() + 2 ** attempt)
+        finally: self._slots.release()
+    def stats(self) -> dict:
+        return {"queued": len(self._heap), "sending": len(self._sending), "sent": self.sent, "failed": self.failed, "retried": self.retried, "rate_limited": self.rate_limited}
+
+BROADCASTER = BroadcastQueue(BROADCAST_RATE, BROADCAST_CHAT_INTERVAL, BROADCAST_CONCURRENCY, BROADCAST_QUEUE_MAX)
+register_metric(CallbackMetric("fitbot_broadcast_messages_total", "Сообщения рассылки: отправлено, не доставлено, повторено после ошибки сети, получено 429 от Telegram",
+                               lambda: {"sent": BROADCASTER.sent, "failed": BROADCASTER.failed, "retried": BROADCASTER.retried, "rate_limited": BROADCASTER.rate_limited}, "counter", ("result",)))
+register_metric(CallbackMetric("fitbot_broadcast_queue_depth", "Сообщения рассылки, ждущие отправки", lambda: BROADCASTER.depth))
+
+def reminder_text(reminder: dict) -> str:
+    if not reminder["meals"]: return "🔔 Сегодня еще нет записей о питании. Запиши, что ты ел(а), - /addmeal\n\nВыключить напоминания: /reminders off"
+    text = f"🔔 *Итог дня:* {display_number(reminder['calories'])} ккал, приемов пищи: {reminder['meals']}."
+    target = reminder["target"]
+    if isinstance(target, (int, float)) and target:
+        remaining = target - reminder["calories"]
+        text += f"\n🎯 Цель: {display_number(target)} ккал - " + (f"осталось *{remaining:.0f} ккал*." if remaining >= 0 else f"перебор *{abs(remaining):.0f} ккал*.")
+    return text + "\n\nДобавить прием пищи - /addmeal, подробности - /todaycalories."
+
+async def send_due_reminders(context: ContextTypes.DEFAULT_TYPE) -> None:
+    """Задача JobQueue: забирает созревшие напоминания (не больше, чем помещается в очередь рассылки) и ставит их в BROADCASTER.
+    Не поместившиеся остаются в базе и заберутся следующим запуском - опоздают, но не потеряются."""
+    if REMINDERS is None: return
+    queued = 0
+    while (room := min(REMINDERS_BATCH, BROADCASTER.free_slots())) > 0:
+        due, seen = await REMINDERS.claim_due(time.time(), room)
+        for reminder in due: BROADCASTER.put(reminder["chat_id"], reminder_text(reminder))
+        queued += len(due)
+        if seen < room: break
+    if queued: logger.info("Напоминания: %s в очереди рассылки (всего в очереди %s).", queued, BROADCASTER.depth)
+
+def schedule_day_jobs(app) -> None:
+    if app.job_queue is None:
+        logger.warning("JobQueue недоступна (pip install \"python-telegram-bot[job-queue]\") - день сменится только при обращении пользователя, напоминания не отправляются."); return
+    app.job_queue.run_repeating(singleton_job(rollover_days, 2 * DAY_ROLLOVER_INTERVAL), interval=DAY_ROLLOVER_INTERVAL, first=DAY_ROLLOVER_INTERVAL, name="rollover_days")
+    if REMINDERS is not None: app.job_queue.run_repeating(send_due_reminders, interval=REMINDERS_POLL_INTERVAL, first=1, name="send_due_reminders")
+
+async def _apply_timezone(update: Update, context: ContextTypes.DEFAULT_TYPE, text: str) -> str:
+    zone = parse_timezone(text)
+    if zone is None: return "🤔 Не знаю такой часовой пояс. Пришли название вроде `Europe/Moscow` или смещение от UTC, например `+5` или `UTC+5:30`."
+    ud, user_id = context.user_data, update.effective_user.id
+    ud[TIMEZONE] = zone
+    if LAST_MEAL_DATE in ud and ensure_current_day(ud): logger.info("User %s: после смены часового пояса начался новый день.", user_id)
+    if REMINDERS is not None: await REMINDERS.set_timezone(user_id, zone)
+    logger.info("User %s: часовой пояс %s.", user_id, zone)
+    return f"✅ Часовой пояс: {describe_timezone(zone)}.\nНовый день и напоминания теперь считаются по нему."
+
+async def timezone_command(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    if context.args:
+        await update.message.reply_text(await _apply_timezone(update, context, " ".join(context.args)), parse_mode=ParseMode.MARKDOWN); return
+    buttons = [InlineKeyboardButton(city, callback_data=f"tz_{name}") for city, name in TIMEZONE_CHOICES]
+    await update.message.reply_text(f"🕒 Твой часовой пояс: {describe_timezone(context.user_data.get(TIMEZONE))}.\n\nВыбери город или пришли свой пояс: `/timezone Europe/Berlin` или `/timezone +5`.",
+                                    reply_markup=InlineKeyboardMarkup([buttons[i:i + 3] for i in range(0, len(buttons), 3)]), parse_mode=ParseMode.MARKDOWN)
+
+async def timezone_callback(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    query = update.callback_query; await query.answer()
+    await query.edit_message_text(await _apply_timezone(update, context, query.data.removeprefix("tz_")), parse_mode=ParseMode.MARKDOWN)
+
+async def reminders_command(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    ud, user_id = context.user_data, update.effective_user.id
+    if not ud.get(PROFILE_COMPLETE):
+        await update.message.reply_text("Сначала создай профиль через /start, чтобы я мог присылать итоги дня. 🌟"); return
+    if REMINDERS is None:
+        await update.message.reply_text("🔔 Напоминания сейчас недоступны (хранилище не настроено)."); return
+    arg = " ".join(context.args or ()).strip().lower()
+    if arg in ("off", "выкл", "нет"):
+        await REMINDERS.disable(user_id); logger.info("User %s: напоминания выключены.", user_id)
+        await update.message.reply_text("🔕 Напоминания выключены. Включить снова - /reminders on"); return
+    match = _REMINDER_TIME_RE.fullmatch(REMINDER_DEFAULT_TIME if arg in ("on", "вкл", "да") else arg)
+    if match:
+        local_time = f"{int(match.group(1)):02d}:{match.group(2)}"
+        due = await REMINDERS.set(user_id, update.effective_chat.id, local_time, ud.get(TIMEZONE))
+        logger.info("User %s: напоминания в %s (%s).", user_id, local_time, ud.get(TIMEZONE) or "пояс по умолчанию")
+        await update.message.reply_text(f"🔔 Готово! Каждый день в *{local_time}* пришлю итог дня.\nЧасовой пояс: {describe_timezone(ud.get(TIMEZONE))} - сменить: /timezone\n"
+                                        f"Ближайшее напоминание: {datetime.fromtimestamp(due, get_timezone(ud.get(TIMEZONE))):%d.%m в %H:%M}. Выключить - /reminders off", parse_mode=ParseMode.MARKDOWN)
+        return
+    current = await REMINDERS.get(user_id)
+    status = f"включены, каждый день в *{current[1]}*" if current else "выключены"
+    await update.message.reply_text(("🤔 Не понял время. " if arg else "") + f"🔔 Напоминания с итогом дня: {status}.\n\n"
+                                    f"`/reminders 21:30` - присылать в указанное время\n`/reminders on` - в {REMINDER_DEFAULT_TIME}\n`/reminders off` - выключить", parse_mode=ParseMode.MARKDOWN)
+
+async def import_command(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    user_id = update.effective_user.id
+    if not context.user_data.get(PROFILE_COMPLETE):
+        await update.message.reply_text("Сначала создай профиль через /start, чтобы я мог вести статистику питания. 🌟")
+        return
+    if MEAL_HISTORY is None:
+        await update.message.reply_text("📥 Импорт сейчас недоступен (хранилище не настроено).")
+        return
+    job = await MEAL_HISTORY.active_import(user_id)
+    if job is None:
+        await update.message.reply_text(IMPORT_HELP_TEXT.format(max_mb=IMPORT_MAX_BYTES // (1024 * 1024)), parse_mode=ParseMode.MARKDOWN)
+        return
+    claimed = [] if user_id in _import_tasks else await MEAL_HISTORY.claim_imports(IMPORT_OWNER, time.time() - IMPORT_STALE_AFTER, user_id, include_paused=True)
+    if not claimed:
+        await update.message.reply_text(import_progress_text(job))
+        return
+    job = claimed[0]
+    message = await update.message.reply_text(import_progress_text(job))
+    job["message_id"] = message.message_id # Прогресс дальше - в новом сообщении, внизу чата
+    start_import(context.bot, job)
+
+async def import_document(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    user_id, document = update.effective_user.id, update.message.document
+    if not context.user_data.get(PROFILE_COMPLETE) or MEAL_HISTORY is None:
+        await import_command(update, context); return
+    if document.file_size and document.file_size > IMPORT_MAX_BYTES:
+        await update.message.reply_text(f"📥 Файл слишком большой: максимум {IMPORT_MAX_BYTES // (1024 * 1024)} МБ. Раздели его на части и пришли по очереди.")
+        return
+    if await MEAL_HISTORY.active_import(user_id) is not None:
+        await update.message.reply_text("📥 Предыдущий импорт еще не закончен. Статус и продолжение - /import")
+        return
+    os.makedirs(IMPORT_DIR, exist_ok=True)
+    path = os.path.join(IMPORT_DIR, f"{user_id}_{document.file_unique_id}{os.path.splitext(document.file_name or '')[1].lower()}")
+    telegram_file = await document.get_file()
+    await telegram_file.download_to_drive(path)
+    total_lines = await asyncio.to_thread(_count_import_lines, path)
+    logger.info("User %s: получен файл импорта %s (%s байт, %s строк)", user_id, path, document.file_size, total_lines)
+    message = await update.message.reply_text(f"📥 Файл получен: {total_lines} строк. Начинаю импорт...")
+    start_import(context.bot, await MEAL_HISTORY.create_import(user_id, update.effective_chat.id, message.message_id, path, total_lines, IMPORT_OWNER))
+
+# --- Аналитика по всем профилям для администраторов (/adminstats): колоночный снимок в NumPy, обновляется инкрементально ---
+ADMIN_IDS = {int(x) for x in os.getenv("ADMIN_IDS", "").replace(" ", "").split(",") if x} # Telegram id через запятую; пусто - /adminstats выключена
+ADMIN_STATS_MAX_AGE = float(os.getenv("ADMIN_STATS_MAX_AGE", "60")) # JobQueue пересчитывает агрегаты раз в N секунд; /adminstats только читает готовые
+ADMIN_STATS_DAYS = int(os.getenv("ADMIN_STATS_DAYS", "7")) # Окно для соблюдения цели по калориям
+ADHERENCE_BOUNDS = (0.8, 1.1) # Доля от цели: меньше 80% / 80-110% / больше 110%
+ADHERENCE_LABELS = ("меньше 80% цели", "80-110% цели", "больше 110% цели")
+_SNAPSHOT_COLUMNS = (CURRENT_WEIGHT, HEIGHT, AGE, GENDER, ACTIVITY_LEVEL, GOAL, PROFILE_COMPLETE, TARGET_CALORIES)
+
+class CohortAnalytics:
+    """Колоночный снимок всех профилей (массивы NumPy, упорядоченные по user_id) и суточные калории за ADMIN_STATS_DAYS дней.
+    refresh() дочитывает только изменившееся: профили - по updated_at, приемы пищи - по id в append-only meal_archive;
+    полная перезагрузка профилей - лишь когда их число в базе разошлось со снимком (кто-то удален).
+    Снимок строится при запуске и обновляется задачей JobQueue в потоке (asyncio.to_thread); запросы администраторов читают готовый summary.
+    shared=True - считает один воркер (singleton_job), а готовые агрегаты публикуются в admin_stats, откуда их читают остальные."""
+    def __init__(self, path: str, window_days: int, shared: bool = False):
+        self.window_days, self.shared = window_days, shared
+        self._conn = open_bot_db(path)
+        self._db_lock = threading.Lock()
+        with self._db_lock, self._conn:
+            self._conn.execute("CREATE INDEX IF NOT EXISTS profiles_updated ON profiles (updated_at)")
+            self._conn.execute("CREATE TABLE IF NOT EXISTS admin_stats (id INTEGER PRIMARY KEY CHECK (id = 1), summary TEXT NOT NULL, refreshed_at REAL NOT NULL)")
+        self.user_ids = np.empty(0, dtype=np.int64)
+        self.columns = {name: np.empty(0) for name in ("weight", "height", "age", "target")}
+        self.codes = {name: np.empty(0, dtype=np.int8) for name in (GENDER, ACTIVITY_LEVEL, GOAL)}
+        self.complete = np.empty(0, dtype=bool)
+        self._profiles_seen_at = -1.0 # updated_at самого нового прочитанного профиля
+        self._archive_id = 0 # Последний прочитанный id в meal_archive
+        self._intake: dict[str, tuple] = {} # день -> (user_id по возрастанию, калории за день)
+        self.summary: dict | None = None
+        self.refreshed_at = 0.0
+        self._refresh_lock = asyncio.Lock()
+
+    @staticmethod
+    def _encode(values, keys) -> "np.ndarray":
+        index = {key: i + 1 for i, key in enumerate(keys)}
+        return np.fromiter((index.get(str(value).lower(), 0) if value else 0 for value in values), dtype=np.int8, count=len(values))
+    def _read_profiles(self, since: float) -> tuple:
+        rows = self._conn.execute(f"SELECT user_id, {', '.join(_SNAPSHOT_COLUMNS)}, updated_at FROM profiles WHERE updated_at >= ? ORDER BY user_id", (since,)).fetchall()
+        user_ids, weight, height, age, gender, activity, goal, complete, target, updated_at = zip(*rows) if rows else [()] * (len(_SNAPSHOT_COLUMNS) + 2)
+        numeric = lambda values: np.array(values, dtype=float) # None -> NaN
+        columns = {"weight": numeric(weight), "height": numeric(height), "age": numeric(age), "target": numeric(target)}
+        codes = {GENDER: self._encode(gender, GENDER_CODES), ACTIVITY_LEVEL: self._encode(activity, ACTIVITY_FACTORS), GOAL: self._encode(goal, GOAL_FACTORS)}
+        return np.array(user_ids, dtype=np.int64), columns, codes, np.array([bool(c) for c in complete], dtype=bool), max(updated_at, default=since)
+    def _merge_profiles(self, user_ids, columns: dict, codes: dict, complete) -> int:
+        """Изменившиеся профили - на свои места в снимке, новые - в конец с пересортировкой; возвращает число новых."""
+        pos = np.searchsorted(self.user_ids, user_ids)
+        known = pos < len(self.user_ids)
+        known[known] = self.user_ids[pos[known]] == user_ids[known]
+        for target, source in ((self.columns, columns), (self.codes, codes)):
+            for name in target: target[name][pos[known]] = source[name][known]
+        self.complete[pos[known]] = complete[known]
+        added = ~known
+        if added.any():
+            self.user_ids = np.concatenate([self.user_ids, user_ids[added]])
+            order = np.argsort(self.user_ids, kind="stable"); self.user_ids = self.user_ids[order]
+            for target, source in ((self.columns, columns), (self.codes, codes)):
+                for name in target: target[name] = np.concatenate([target[name], source[name][added]])[order]
+            self.complete = np.concatenate([self.complete, complete[added]])[order]
+        return int(added.sum())
+    def _refresh_profiles(self) -> int:
+        user_ids, columns, codes, complete, seen_at = self._read_profiles(self._profiles_seen_at)
+        changed = len(user_ids)
+        if changed: self._merge_profiles(user_ids, columns, codes, complete)
+        self._profiles_seen_at = seen_at # >= в запросе: профиль, записанный в ту же секунду позже чтения, не потеряется
+        if self._conn.execute("SELECT COUNT(*) FROM profiles").fetchone()[0] != len(self.user_ids): # Профили удалялись - перечитываем все
+            self.user_ids, self.columns, self.codes, self.complete, self._profiles_seen_at = self._read_profiles(-1.0)
+            changed = len(self.user_ids)
+        return changed
+    def _refresh_intake(self, first_day: str) -> int:
+        last_id = self._conn.execute("SELECT MAX(id) FROM meal_archive").fetchone()[0] or 0
+        rows = self._conn.execute("SELECT user_id, day, calories FROM meal_archive WHERE id > ? AND id <= ? AND day >= ?", (self._archive_id, last_id, first_day)).fetchall()
+        self._archive_id = last_id
+        for day in [day for day in self._intake if day < first_day]: del self._intake[day]
+        if not rows: return 0
+        user_ids, days, calories = zip(*rows)
+        user_ids, days, calories = np.array(user_ids, dtype=np.int64), np.array(days), np.nan_to_num(np.array(calories, dtype=float))
+        for day in map(str, np.unique(days)):
+            mask = days == day
+            ids, kcal = user_ids[mask], calories[mask]
+            if day in self._intake: ids, kcal = np.concatenate([self._intake[day][0], ids]), np.concatenate([self._intake[day][1], kcal])
+            unique_ids, inverse = np.unique(ids, return_inverse=True)
+            self._intake[day] = (unique_ids, np.bincount(inverse, weights=kcal))
+        return len(rows)
+
+    def _summarize(self) -> dict:
+        """Агрегаты по пользователям с завершенным профилем: категории ИМТ, распределение TDEE, цели, соблюдение цели по калориям."""
+        mask = self.complete
+        weight, height, age = (self.columns[name][mask] for name in ("weight", "height", "age"))
+        bmi = calculate_bmi_batch(weight, height)
+        tdee = calculate_tdee_batch(calculate_bmr_batch(weight, height, age, self.codes[GENDER][mask]), self.codes[ACTIVITY_LEVEL][mask])
+        target = calculate_target_calories_batch(tdee, self.codes[GOAL][mask])
+        target = np.where(np.isnan(target), self.columns["target"][mask], target) # Профиль без части полей - берем сохраненную цель
+        categories = bmi_category_batch(bmi)
+        # Средние калории за день учета в окне; пользователи без профиля в снимке не учитываются
+        user_ids, logged_days, calories = self.user_ids[mask], np.zeros(int(mask.sum())), np.zeros(int(mask.sum()))
+        for ids, kcal in self._intake.values():
+            pos = np.searchsorted(user_ids, ids)
+            found = pos < len(user_ids)
+            found[found] = user_ids[pos[found]] == ids[found]
+            np.add.at(calories, pos[found], kcal[found]); np.add.at(logged_days, pos[found], 1)
+        tracked = (logged_days > 0) & (target > 0)
+        with np.errstate(divide="ignore", invalid="ignore"): ratio = calories[tracked] / logged_days[tracked] / target[tracked]
+        valid_tdee = tdee[~np.isnan(tdee)]
+        return {"profiles": len(self.user_ids), "complete": int(mask.sum()),
+                "bmi": {label: int((categories == i).sum()) for i, label in enumerate(BMI_CATEGORY_LABELS)} | {"не рассчитан": int((categories == -1).sum())},
+                "tdee": dict(zip(("p10", "p50", "p90"), np.percentile(valid_tdee, (10, 50, 90)).round().astype(int).tolist())) | {"mean": round(float(valid_tdee.mean()))} if len(valid_tdee) else {},
+                "goals": {goal: int((self.codes[GOAL][mask] == i + 1).sum()) for i, goal in enumerate(GOAL_FACTORS)},
+                "adherence": dict(zip(ADHERENCE_LABELS, np.bincount(np.digitize(ratio, ADHERENCE_BOUNDS), minlength=3).tolist())) | {"нет записей": int((~tracked).sum())}}
+    def _refresh(self) -> dict:
+        started = time.perf_counter()
+        with self._db_lock:
+            profiles = self._refresh_profiles()
+            meals = self._refresh_intake((datetime.now(timezone.utc).date() - timedelta(days=self.window_days - 1)).isoformat())
+        summarized = time.perf_counter()
+        self.summary = self._summarize() | {"profiles_read": profiles, "meals_read": meals, "refresh_s": round(summarized - started, 3), "summary_s": round(time.perf_counter() - summarized, 3)}
+        self.refreshed_at = time.time()
+        if self.shared:
+            with self._db_lock, self._conn: self._conn.execute("INSERT OR REPLACE INTO admin_stats VALUES (1, ?, ?)", (json.dumps(self.summary, ensure_ascii=False), self.refreshed_at))
+        return self.summary
+    def _load_published(self) -> None:
+        with self._db_lock: row = self._conn.execute("SELECT summary, refreshed_at FROM admin_stats WHERE id = 1").fetchone()
+        if row is not None and row[1] > self.refreshed_at: self.summary, self.refreshed_at = json.loads(row[0]), row[1]
+    async def refresh(self) -> dict:
+        """Пересчитывает агрегаты в потоке; запуск задачи, пока идет предыдущий, ждет его, а не считает параллельно."""
+        async with self._refresh_lock: return await asyncio.to_thread(self._refresh)
+    async def latest(self) -> dict | None:
+        """Готовые агрегаты без пересчета; при shared=True - свежайшие из своих и опубликованных считающим воркером."""
+        if self.shared: await asyncio.to_thread(self._load_published)
+        return self.summary
+
+COHORT_ANALYTICS: CohortAnalytics | None = None # Создается в on_startup, если заданы BOT_DB_PATH и ADMIN_IDS и установлен numpy
+
+async def refresh_admin_stats(context: ContextTypes.DEFAULT_TYPE | None = None) -> None:
+    """Задача JobQueue: первый снимок при запуске, дальше - дочитывание изменений раз в ADMIN_STATS_MAX_AGE."""
+    try: summary = await COHORT_ANALYTICS.refresh()
+    except sqlite3.Error as e: logger.error("Не удалось обновить аналитику: %s", e, exc_info=True); return
+    logger.debug("Аналитика обновлена: дочитано профилей %s, приемов пищи %s за %.3f с, расчет %.3f с.", summary["profiles_read"], summary["meals_read"], summary["refresh_s"], summary["summary_s"])
+
+def schedule_admin_stats(app) -> None:
+    ttl = 2 * ADMIN_STATS_MAX_AGE
+    if app.job_queue is None:
+        logger.warning("JobQueue недоступна (pip install \"python-telegram-bot[job-queue]\") - аналитика для /adminstats посчитается только один раз при запуске.")
+        async def refresh_once():
+            if await holds_job_lease(app, "refresh_admin_stats", ttl): await refresh_admin_stats()
+        asyncio.create_task(refresh_once(), name="refresh_admin_stats"); return
+    app.job_queue.run_repeating(singleton_job(refresh_admin_stats, ttl), interval=ADMIN_STATS_MAX_AGE, first=0, name="refresh_admin_stats")
+
+def _share(count: int, total: int) -> str: return f"{count * 100 / total:.0f}% ({count})" if total else str(count)
+
+def admin_stats_text(summary: dict, age: float) -> str:
+    complete = summary["complete"]
+    text = f"📈 *Аналитика по пользователям*\nПрофилей: {summary['profiles']}, заполненных: {complete}\n\n*ИМТ:*\n"
+    text += "".join(f"  {label}: {_share(count, complete)}\n" for label, count in summary["bmi"].items() if count)
+    tdee = summary["tdee"]
+    if tdee: text += f"\n*TDEE, ккал/день:* p10 {tdee['p10']}, медиана {tdee['p50']}, p90 {tdee['p90']} (среднее {tdee['mean']})\n"
+    text += "\n*Цели:*\n" + "".join(f"  {goal.capitalize()}: {_share(count, complete)}\n" for goal, count in summary["goals"].items())
+    text += f"\n*Калории от цели за {ADMIN_STATS_DAYS} дн.* (в среднем за день учета):\n" + "".join(f"  {label}: {_share(count, complete)}\n" for label, count in summary["adherence"].items())
+    return text + f"\n_Обновлено {age:.0f} с назад. Дочитано профилей: {summary['profiles_read']}, приемов пищи: {summary['meals_read']} за {summary['refresh_s']} с; расчет - {summary['summary_s']} с._"
+
+async def admin_stats_command(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    user_id = update.effective_user.id
+    if user_id not in ADMIN_IDS:
+        logger.warning("User %s: /adminstats без прав администратора.", user_id); return # Для остальных команды как будто нет
+    if COHORT_ANALYTICS is None:
+        reason = "не установлен numpy (pip install numpy)" if np is None else "хранилище не настроено"
+        await update.message.reply_text(f"📈 Аналитика недоступна: {reason}."); return
+    try: summary = await COHORT_ANALYTICS.latest() # Только готовый снимок: пересчет идет в refresh_admin_stats
+    except sqlite3.Error as e:
+        logger.error("Не удалось прочитать аналитику: %s", e, exc_info=True)
+        await update.message.reply_text("💥 Не удалось прочитать аналитику, подробности в логе."); return
+    if summary is None:
+        await update.message.reply_text("📈 Аналитика еще считается после запуска, попробуй через минуту."); return
+    age = time.time() - COHORT_ANALYTICS.refreshed_at
+    logger.info("Admin %s: /adminstats (снимку %.0f с).", user_id, age)
+    await update.message.reply_text(admin_stats_text(summary, age), parse_mode=ParseMode.MARKDOWN)
+
 # --- Обычные команды (как в v2.7, с обновленным меню и help) ---
 # (Вставь сюда menu_command, help_command, my_profile_command, weight_command_entry, train_command_entry, handle_train_location_and_generate из v2.7)
 # --- Копипаста обычных команд ---
@@ -352,7 +2551,7 @@ async def menu_command(update: Update, context: ContextTypes.DEFAULT_TYPE): # К
     menu_buttons = [[KeyboardButton("✍️ Записать еду (/addmeal)"), KeyboardButton("🗓️ Мои калории (/todaycalories)")],[KeyboardButton("🏋️‍♂️ Тренировка (/train)"), KeyboardButton("⚖️ Обновить вес (/weight)")],[KeyboardButton("📊 Мой профиль (/myprofile)"), KeyboardButton("❓ Помощь (/help)")],]
     await update.message.reply_text("👇 Вот что мы можем сделать:", reply_markup=ReplyKeyboardMarkup(menu_buttons, resize_keyboard=True, one_time_keyboard=False))
 async def help_command(update: Update, context: ContextTypes.DEFAULT_TYPE): # Как в v2.7
-    help_text = ("👋 Привет! Я *ФитГуру* – твой гид в мире фитнеса и здорового питания.\n\n📌 *Основные команды:*\n/start - Начать работу, создать или просмотреть профиль.\n/menu - Показать главное меню с кнопками.\n/myprofile - Твой текущий фитнес-профиль и показатели.\n/train - Предложить варианты тренировок.\n/weight - Обновить свой текущий вес.\n/addmeal - Записать прием пищи.\n/todaycalories - Посмотреть итоги по КБЖУ за сегодня.\n/cancel - (Во время диалога) Отменить текущее действие.\n/help - Это сообщение.\n\n🤖 Я могу помочь с тренировками, расчетом показателей и записью питания!")
+    help_text = ("👋 Привет! Я *ФитГуру* – твой гид в мире фитнеса и здорового питания.\n\n📌 *Основные команды:*\n/start - Начать работу, создать или просмотреть профиль.\n/menu - Показать главное меню с кнопками.\n/myprofile - Твой текущий фитнес-профиль и показатели.\n/train - Предложить варианты тренировок.\n/weight - Обновить свой текущий вес.\n/addmeal - Записать прием пищи.\n/todaycalories - Посмотреть итоги по КБЖУ за сегодня.\n/stats - Статистика питания за 7, 30 и 365 дней.\n/import - Импорт истории питания из CSV/TXT файла.\n/reminders - Ежедневное напоминание с итогом дня.\n/timezone - Часовой пояс (когда начинается новый день).\n/cancel - (Во время диалога) Отменить текущее действие.\n/help - Это сообщение.\n\n🤖 Я могу помочь с тренировками, расчетом показателей и записью питания!")
     await update.message.reply_text(help_text, parse_mode=ParseMode.MARKDOWN)
 async def my_profile_command(update: Update, context: ContextTypes.DEFAULT_TYPE): # Как в v2.7
     # ... (код my_profile_command из v2.7) ...
@@ -381,7 +2580,7 @@ async def handle_weight_update(update: Update, context: ContextTypes.DEFAULT_TYP
         if not 30 <= new_weight <= 300: raise ValueError("Некорректный вес")
         ud = context.user_data
         if not all(ud.get(key) for key in [HEIGHT, AGE, GENDER, ACTIVITY_LEVEL, GOAL]):
-            logger.error(f"User {update.effective_user.id}: Missing profile data for weight update recalcs.")
+            logger.error("User %s: Missing profile data for weight update recalcs.", update.effective_user.id)
             await update.message.reply_text("Не удалось обновить показатели, не хватает данных профиля. Попробуй /myprofile или /start.")
             ud.pop(AWAITING_WEIGHT_UPDATE, None); return
         ud[CURRENT_WEIGHT] = new_weight; ud[BMI] = calculate_bmi(new_weight, ud.get(HEIGHT)); ud[BMR] = calculate_bmr(new_weight, ud.get(HEIGHT), ud.get(AGE), ud.get(GENDER)); ud[TDEE] = calculate_tdee(ud.get(BMR), ud.get(ACTIVITY_LEVEL)); ud[TARGET_CALORIES] = calculate_target_calories(ud.get(TDEE), ud.get(GOAL))
@@ -392,10 +2591,10 @@ async def handle_weight_update(update: Update, context: ContextTypes.DEFAULT_TYP
             if weekly_weight_change_kg < -0.05: weight_change_prediction_text = f"📈 Прогноз: *{abs(weekly_weight_change_kg):.1f} кг/нед.* в минус\n"
             elif weekly_weight_change_kg > 0.05: weight_change_prediction_text = f"📈 Прогноз: *{weekly_weight_change_kg:.1f} кг/нед.* в плюс\n"
         await update.message.reply_text(f"✅ Вес *{new_weight} кг* успешно обновлен! Твои показатели пересчитаны:\n  - ИМТ: *{ud.get(BMI, 'N/A')}*{bmi_interp}\n  - Рекомендуемые калории: `{ud.get(TARGET_CALORIES, 'N/A')}` *ккал/день*\n{weight_change_prediction_text}",parse_mode=ParseMode.MARKDOWN)
-        logger.info(f"Пользователь {update.effective_user.id} обновил вес: {new_weight} кг.")
+        logger.info("Пользователь %s обновил вес: %s кг.", update.effective_user.id, new_weight)
     except ValueError: await update.message.reply_text("🤔 Вес должен быть числом (например, 70.5). Попробуй еще раз /weight или введи вес снова.")
     except Exception as e:
-        logger.error(f"Ошибка в handle_weight_update: {e}", exc_info=True)
+        logger.error("Ошибка в handle_weight_update: %s", e, exc_info=True)
         await update.message.reply_text("💥 Ой, произошла ошибка при обновлении веса.")
         context.user_data.pop(AWAITING_WEIGHT_UPDATE, None)
 async def train_command_entry(update: Update, context: ContextTypes.DEFAULT_TYPE): # Как в v2.6
@@ -410,22 +2609,39 @@ async def train_command_entry(update: Update, context: ContextTypes.DEFAULT_TYPE
 async def handle_train_location_and_generate(update: Update, context: ContextTypes.DEFAULT_TYPE): # Как в v2.6
     # ... (код handle_train_location_and_generate из v2.6) ...
     query = update.callback_query; await query.answer(); user_id = update.effective_user.id 
-    logger.info(f"User {user_id}: Запрос тренировки, выбор: {query.data}"); location_choice = query.data
-    location_text, equipment_text = "", ""
-    if location_choice == "train_home": location_text, equipment_text = "для дома", "без специального оборудования"
-    elif location_choice == "train_gym": location_text, equipment_text = "для тренажерного зала", "с использованием стандартного оборудования зала"
-    elif location_choice == "train_street": location_text, equipment_text = "для улицы", "с минимальным оборудованием или без него"
+    logger.info("User %s: Запрос тренировки, выбор: %s", user_id, query.data); location_choice = query.data
     ud = context.user_data
-    profile_info = (f"ВАЖНО: Это данные профиля пользователя, используй их: Пол:{ud.get(GENDER,'N/A')}, Возраст:{ud.get(AGE,'N/A')}, Рост:{ud.get(HEIGHT,'N/A')}см, Вес:{ud.get(CURRENT_WEIGHT,'N/A')}кг, Активность:{ud.get(ACTIVITY_LEVEL,'N/A')}, Цель:{ud.get(GOAL,'N/A')}. ИМТ:{ud.get(BMI,'N/A')}, Рекомендуемые калории для цели:{ud.get(TARGET_CALORIES,'N/A')}. Не запрашивай эти данные у пользователя снова, они уже предоставлены.")
-    prompt = (f"{profile_info} Пользователь хочет тренировку {location_text}, {equipment_text}. Твоя задача - сгенерировать программу тренировок. Ответ должен быть полностью на русском языке, очень грамотным и естественным, без выдуманных слов или странных фраз. Для каждого упражнения четко укажи:\n1. *Название упражнения* (жирный шрифт, без Markdown заголовков перед названием).\n2. Техника выполнения: Краткое и понятное описание техники (2-3 предложения).\n3. Подходы: Количество (например, 3-4).\n4. Повторения: Количество в каждом подходе (например, 10-15 или до около отказа).\n5. Отдых: Время между подходами (например, 60-90 секунд).\nНе обсуждай рабочий вес, если это не тренировка в зале или не просили отдельно. Раздели тренировку на секции: '## Разминка (5-7 минут)', '## Основная часть (20-30 минут)', '## Заминка (5 минут)'. Используй именно такие Markdown заголовки. В самом конце, отдельным абзацем, четко укажи: '🔥 Примерно сожжено калорий за эту тренировку: X-Y ккал.'. Замени X-Y на реалистичную оценку. Стиль — дружелюбный тренер. Ответ хорошо структурирован с Markdown (списки -, жирный шрифт *).")
-    await query.edit_message_text("🏋️‍♂️ Подбираю для тебя *персонализированную тренировку*... Это может занять до 30 секунд.", parse_mode=ParseMode.MARKDOWN)
-    logger.info(f"User {user_id}: Отправка промпта для тренировки в AI...")
-    reply = await ask_groq(prompt, temperature=0.45)
-    if reply and not any(err_word in reply for err_word in ["Ошибка", "Упс", "Извини", "К сожалению", "не могу", "не удалось"]):
-        logger.info(f"User {user_id}: Получен валидный ответ от AI для тренировки.")
+    bucket = workout_bucket(ud, location_choice) if WORKOUT_POOL is not None else None
+    if bucket is not None:
+        cursor = ud.setdefault(TRAIN_PLAN_CURSOR, {}).get(bucket, 0)
+        plan, variants = await WORKOUT_POOL.pick(bucket, cursor)
+        if plan is not None: # Готовый план из пула - без ожидания AI
+            ud[TRAIN_PLAN_CURSOR][bucket] = (cursor + 1) % variants
+            logger.info("User %s: Тренировка из пула (корзина %s, вариант %s/%s).", user_id, bucket, cursor % variants + 1, variants)
+            await query.edit_message_text("🏋️‍♂️ Вот твоя тренировка:")
+            try: await query.message.reply_text(plan, parse_mode=ParseMode.MARKDOWN)
+            except BadRequest: await query.message.reply_text(plan)
+            return
+        prompt = workout_prompt_for_bucket(bucket) # Холодная корзина: генерируем по признакам корзины и кладем результат в пул
+    else:
+        profile_info = (f"ВАЖНО: Это данные профиля пользователя, используй их: Пол:{ud.get(GENDER,'N/A')}, Возраст:{ud.get(AGE,'N/A')}, Рост:{ud.get(HEIGHT,'N/A')}см, Вес:{ud.get(CURRENT_WEIGHT,'N/A')}кг, Активность:{ud.get(ACTIVITY_LEVEL,'N/A')}, Цель:{ud.get(GOAL,'N/A')}. ИМТ:{ud.get(BMI,'N/A')}, Рекомендуемые калории для цели:{ud.get(TARGET_CALORIES,'N/A')}. Не запрашивай эти данные у пользователя снова, они уже предоставлены.")
+        prompt = workout_prompt(profile_info, location_choice)
+    await query.edit_message_text("🏋️‍♂️ Подбираю для тебя *персонализированную тренировку*..." + (" Текст появится через пару секунд." if GROQ_STREAMING else " Это может занять до 30 секунд."), parse_mode=ParseMode.MARKDOWN)
+    logger.info("User %s: Отправка промпта для тренировки в AI...", user_id)
+    if GROQ_STREAMING: # Ответ показывается по мере генерации
+        try: reply, completed = await run_ai_job(lambda: stream_groq_reply(query.message, prompt, temperature=0.45), query.message)
+        except AIQueueFullError:
+            await query.message.reply_text(AI_QUEUE_FULL_TEXT); return
+        logger.info("User %s: Тренировка отправлена стримингом (%s символов).", user_id, len(reply))
+        if bucket is not None and completed: await WORKOUT_POOL.add(bucket, reply)
+        return
+    reply, outcome = await ask_groq_queued(prompt, query.message, temperature=0.45)
+    if outcome in AI_REPLY_OUTCOMES and reply.strip():
+        logger.info("User %s: Получен валидный ответ от AI для тренировки.", user_id)
         await query.message.reply_text(reply, parse_mode=ParseMode.MARKDOWN)
+        if bucket is not None: await WORKOUT_POOL.add(bucket, reply)
     else:
-        logger.warning(f"User {user_id}: AI вернул сообщение, похожее на ошибку, или пустой ответ: {reply}")
+        logger.warning("User %s: AI не вернул тренировку (%s): %s", user_id, outcome, reply)
         await query.message.reply_text(reply if reply else "Не удалось сгенерировать тренировку. Попробуйте позже.", parse_mode=ParseMode.MARKDOWN)
 # --- Конец копипасты обычных команд ---
 
@@ -440,16 +2656,35 @@ async def general_message_handler(update: Update, context: ContextTypes.DEFAULT_
     if user_message == "📊 Мой профиль (/myprofile)": await my_profile_command(update, context); return
     if user_message == "❓ Помощь (/help)": await help_command(update, context); return
     if context.user_data.get(AWAITING_WEIGHT_UPDATE) is True: await handle_weight_update(update, context); return
-    logger.info(f"Получено обычное текстовое сообщение от {update.effective_user.id} ({update.effective_user.username}): '{user_message}'. AI не будет вызван.")
+    logger.info("Получено обычное текстовое сообщение от %s (%s): '%s'. AI не будет вызван.", update.effective_user.id, update.effective_user.username, user_message)
     await update.message.reply_text("🤖 Хм, я не совсем понял твой запрос. Если нужна помощь, используй /help или кнопки в /menu. Я могу помочь с тренировками, расчетом показателей и записью твоего питания! 😊", parse_mode=ParseMode.MARKDOWN)
 
 # --- Основная функция (как в v2.7, с добавлением add_meal_conv_handler) ---
-def main():
-    if not TELEGRAM_TOKEN: logger.critical("TELEGRAM_TOKEN не найден! Бот не может запуститься."); return
-    app = ApplicationBuilder().token(TELEGRAM_TOKEN).build()
-    onboarding_conv_handler = ConversationHandler(entry_points=[CommandHandler("start", start_command)], states={PROFILE_GENDER: [CallbackQueryHandler(handle_gender_and_ask_age, pattern="^(мужской|женский)$")], PROFILE_AGE: [MessageHandler(filters.TEXT & ~filters.COMMAND, handle_age_and_ask_height)], PROFILE_HEIGHT: [MessageHandler(filters.TEXT & ~filters.COMMAND, handle_height_and_ask_weight)], PROFILE_WEIGHT: [MessageHandler(filters.TEXT & ~filters.COMMAND, handle_weight_and_ask_activity)], PROFILE_ACTIVITY: [CallbackQueryHandler(handle_activity_and_ask_goal, pattern="^(минимальная|легкая|средняя|высокая|экстремальная)$")], PROFILE_GOAL: [CallbackQueryHandler(process_final_profile, pattern="^(похудеть|поддерживать вес|набрать массу)$")],}, fallbacks=[CommandHandler("cancel", cancel_onboarding), CommandHandler("start", start_command)], allow_reentry=True, per_user=True, per_chat=True,)
+# --- Режимы запуска: polling или webhook (в том числе несколько воркеров над общей базой) ---
+BOT_MODE = os.getenv("BOT_MODE", "polling").lower() # polling | webhook
+WEBHOOK_URL = os.getenv("WEBHOOK_URL", "") # Публичный https-адрес без пути, например https://bot.example.com
+WEBHOOK_PATH = os.getenv("WEBHOOK_PATH", "telegram").strip("/")
+WEBHOOK_LISTEN = os.getenv("WEBHOOK_LISTEN", "0.0.0.0")
+WEBHOOK_PORT = int(os.getenv("WEBHOOK_PORT", os.getenv("PORT", "8443")))
+WEBHOOK_SECRET = os.getenv("WEBHOOK_SECRET", "") # Проверяется в заголовке X-Telegram-Bot-Api-Secret-Token каждого запроса
+WEBHOOK_WORKERS = max(1, int(os.getenv("WEBHOOK_WORKERS", "1"))) # Воркер i слушает WEBHOOK_PORT + i, балансировщик раскидывает запросы между ними
+WEBHOOK_MAX_CONNECTIONS = int(os.getenv("WEBHOOK_MAX_CONNECTIONS", "40"))
+SHARED_STATE = WEBHOOK_WORKERS > 1 or os.getenv("SHARED_STATE", "").lower() in ("1", "true", "yes") # Базу делят несколько процессов/хостов
+DROP_PENDING_UPDATES = os.getenv("DROP_PENDING_UPDATES", "").lower() in ("1", "true", "yes") # По умолчанию накопившиеся апдейты обрабатываются после рестарта
+
+def build_application(request=None):
+    """Собирает Application со всеми обработчиками; режим запуска выбирает main().
+    request - свой BaseRequest для Bot API (bench_bot.py подставляет фейковый Telegram)."""
+    persistence = SQLitePersistence(BOT_DB_PATH, update_interval=PERSISTENCE_FLUSH_INTERVAL, shared=SHARED_STATE) if BOT_DB_PATH else None
+    shared_state = persistence if SHARED_STATE else None
+    builder = ApplicationBuilder().token(TELEGRAM_TOKEN).post_init(on_startup).post_shutdown(on_shutdown).concurrent_updates(PerUserUpdateProcessor(BOT_CONCURRENT_UPDATES, shared_state))
+    if request is not None: builder = builder.request(request).get_updates_request(request)
+    if persistence is not None: builder = builder.persistence(persistence)
+    else: logger.warning("BOT_DB_PATH пуст - профили и приемы пищи не сохраняются между рестартами.")
+    app = builder.build()
+    onboarding_conv_handler = SharedConversationHandler(entry_points=[CommandHandler("start", start_command)], states={PROFILE_GENDER: [CallbackQueryHandler(handle_gender_and_ask_age, pattern="^(мужской|женский)$")], PROFILE_AGE: [MessageHandler(filters.TEXT & ~filters.COMMAND, handle_age_and_ask_height)], PROFILE_HEIGHT: [MessageHandler(filters.TEXT & ~filters.COMMAND, handle_height_and_ask_weight)], PROFILE_WEIGHT: [MessageHandler(filters.TEXT & ~filters.COMMAND, handle_weight_and_ask_activity)], PROFILE_ACTIVITY: [CallbackQueryHandler(handle_activity_and_ask_goal, pattern="^(минимальная|легкая|средняя|высокая|экстремальная)$")], PROFILE_GOAL: [CallbackQueryHandler(process_final_profile, pattern="^(похудеть|поддерживать вес|набрать массу)$")],}, fallbacks=[CommandHandler("cancel", cancel_onboarding), CommandHandler("start", start_command)], allow_reentry=True, per_user=True, per_chat=True, name="onboarding", persistent=bool(BOT_DB_PATH),)
     app.add_handler(onboarding_conv_handler)
-    add_meal_conv_handler = ConversationHandler(entry_points=[CommandHandler("addmeal", add_meal_start)], states={ADDMEAL_CHOOSE_TYPE: [CallbackQueryHandler(add_meal_choose_type, pattern="^meal_(Завтрак|Обед|Ужин|Перекус)$")], ADDMEAL_GET_DESCRIPTION: [MessageHandler(filters.TEXT & ~filters.COMMAND, add_meal_get_description)],}, fallbacks=[CommandHandler("cancel", add_meal_cancel)], per_user=True, per_chat=True,)
+    add_meal_conv_handler = SharedConversationHandler(entry_points=[CommandHandler("addmeal", add_meal_start)], states={ADDMEAL_CHOOSE_TYPE: [CallbackQueryHandler(add_meal_choose_type, pattern="^meal_(Завтрак|Обед|Ужин|Перекус)$")], ADDMEAL_GET_DESCRIPTION: [MessageHandler(filters.TEXT & ~filters.COMMAND, add_meal_get_description)],}, fallbacks=[CommandHandler("cancel", add_meal_cancel)], per_user=True, per_chat=True, name="add_meal", persistent=bool(BOT_DB_PATH),)
     app.add_handler(add_meal_conv_handler)
     app.add_handler(CommandHandler("train", train_command_entry))
     app.add_handler(CallbackQueryHandler(handle_train_location_and_generate, pattern="^train_(home|gym|street)$"))
@@ -458,9 +2693,43 @@ def main():
     app.add_handler(CommandHandler("myprofile", my_profile_command))
     app.add_handler(CommandHandler("weight", weight_command_entry))
     app.add_handler(CommandHandler("todaycalories", today_calories_command))
+    app.add_handler(CommandHandler("stats", stats_command))
+    app.add_handler(CommandHandler("import", import_command))
+    app.add_handler(CommandHandler("timezone", timezone_command))
+    app.add_handler(CallbackQueryHandler(timezone_callback, pattern="^tz_"))
+    app.add_handler(CommandHandler("reminders", reminders_command))
+    app.add_handler(CommandHandler("adminstats", admin_stats_command))
+    app.add_handler(MessageHandler(filters.Document.FileExtension("csv") | filters.Document.FileExtension("txt"), import_document))
     app.add_handler(MessageHandler(filters.TEXT & ~filters.COMMAND, general_message_handler))
+    if METRICS_ENABLED:
+        for handlers in app.handlers.values(): instrument_handlers(handlers)
+    return app
+
+def _run_webhook_worker(index: int) -> None:
+    global GROQ_RATE_LIMITS, BROADCASTER, WORKER_INDEX
+    WORKER_INDEX = index
+    if WEBHOOK_WORKERS > 1: # Лимиты Groq общие на ключ, а flood-лимит Telegram - на бота: делим между воркерами
+        GROQ_RATE_LIMITS = GroqRateLimits(GROQ_RPM / WEBHOOK_WORKERS, GROQ_TPM / WEBHOOK_WORKERS)
+        BROADCASTER = BroadcastQueue(BROADCAST_RATE / WEBHOOK_WORKERS, BROADCAST_CHAT_INTERVAL, BROADCAST_CONCURRENCY, BROADCAST_QUEUE_MAX)
+    app = build_application()
+    logger.info("🤖 Воркер %s/%s принимает webhook на %s:%s/%s", index + 1, WEBHOOK_WORKERS, WEBHOOK_LISTEN, WEBHOOK_PORT + index, WEBHOOK_PATH)
+    # Все воркеры регистрируют один и тот же адрес и секрет, поэтому повторный setWebhook безвреден
+    app.run_webhook(listen=WEBHOOK_LISTEN, port=WEBHOOK_PORT + index, url_path=WEBHOOK_PATH, webhook_url=f"{WEBHOOK_URL.rstrip('/')}/{WEBHOOK_PATH}", secret_token=WEBHOOK_SECRET, max_connections=WEBHOOK_MAX_CONNECTIONS, drop_pending_updates=DROP_PENDING_UPDATES)
+
+def main():
+    if not TELEGRAM_TOKEN: logger.critical("TELEGRAM_TOKEN не найден! Бот не может запуститься."); return
     logger.info("🤖 Бот ФитГуру v2.7 (с записью приемов пищи) запускается...")
-    app.run_polling(drop_pending_updates=True)
+    if BOT_MODE != "webhook":
+        if SHARED_STATE: logger.warning("SHARED_STATE включен в режиме polling - getUpdates может читать только один процесс на токен.")
+        build_application().run_polling(drop_pending_updates=DROP_PENDING_UPDATES); return
+    if not WEBHOOK_URL.startswith("https://"): logger.critical("Для BOT_MODE=webhook нужен WEBHOOK_URL вида https://host."); return
+    if not re.fullmatch(r"[A-Za-z0-9_-]{1,256}", WEBHOOK_SECRET): logger.critical("Для BOT_MODE=webhook нужен WEBHOOK_SECRET (1-256 символов A-Z, a-z, 0-9, _ и -)."); return
+    if SHARED_STATE and not BOT_DB_PATH: logger.critical("Несколько воркеров делят состояние через BOT_DB_PATH - он не может быть пустым."); return
+    if WEBHOOK_WORKERS == 1: _run_webhook_worker(0); return
+    ctx = multiprocessing.get_context("spawn") # Чистый процесс без унаследованного event loop и соединений SQLite
+    workers = [ctx.Process(target=_run_webhook_worker, args=(index,), name=f"webhook-worker-{index}") for index in range(WEBHOOK_WORKERS)]
+    for worker in workers: worker.start()
+    for worker in workers: worker.join()
 
 if __name__ == "__main__":
     main()
\ No newline at end of file
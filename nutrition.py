@@ -0,0 +1,313 @@
+import csv
+import logging
+import re
+import sys
+from array import array
+from collections import defaultdict
+from typing import NamedTuple
+
+logger = logging.getLogger(__name__)
+
+# --- Локальная таблица КБЖУ (на 100 г / 100 мл) ---
+# piece_g - вес одной штуки (если продукт считают штуками), portion_g - порция, если количество не указано.
+class Food(NamedTuple):
+    name: str
+    aliases: tuple
+    calories: float
+    protein: float
+    fat: float
+    carbs: float
+    piece_g: float | None
+    portion_g: float
+
+FOODS = [
+    Food("Гречка отварная", ("гречка", "греча", "гречневая каша", "гречка отварная"), 110, 4.2, 1.1, 21.3, None, 200),
+    Food("Рис отварной", ("рис", "рис отварной", "рисовая каша"), 130, 2.7, 0.3, 28.2, None, 200),
+    Food("Овсянка на воде", ("овсянка", "овсяная каша", "геркулес", "овсянка на воде"), 88, 3.0, 1.7, 15.0, None, 250),
+    Food("Овсянка на молоке", ("овсянка на молоке", "овсяная каша на молоке", "геркулес на молоке"), 102, 3.2, 4.1, 14.2, None, 250),
+    Food("Макароны отварные", ("макароны", "паста", "спагетти", "макароны отварные"), 158, 5.5, 0.9, 30.9, None, 200),
+    Food("Картофель отварной", ("картофель", "картошка", "картофель отварной", "вареная картошка"), 82, 2.0, 0.4, 16.7, 100, 200),
+    Food("Картофельное пюре", ("пюре", "картофельное пюре", "пюре картофельное"), 106, 2.5, 4.2, 14.7, None, 200),
+    Food("Картофель фри", ("картофель фри", "картошка фри", "фри"), 312, 3.4, 15.0, 41.0, None, 150),
+    Food("Хлеб белый", ("хлеб", "хлеб белый", "батон", "белый хлеб"), 265, 8.0, 3.2, 49.0, 30, 30),
+    Food("Хлеб ржаной", ("хлеб ржаной", "черный хлеб", "ржаной хлеб", "бородинский хлеб"), 210, 6.6, 1.2, 40.0, 30, 30),
+    Food("Яйцо куриное", ("яйцо", "яйца", "яйцо куриное", "вареное яйцо", "яйцо вареное"), 155, 12.6, 10.6, 1.1, 55, 55),
+    Food("Омлет", ("омлет", "яичница"), 184, 9.6, 15.4, 1.9, None, 150),
+    Food("Куриная грудка отварная", ("курица", "куриная грудка", "грудка", "куриное филе", "филе курицы"), 137, 29.8, 1.8, 0.5, None, 150),
+    Food("Курица жареная", ("курица жареная", "жареная курица", "куриные бедра", "окорочок"), 210, 26.0, 12.0, 0.0, None, 150),
+    Food("Говядина тушеная", ("говядина", "говядина тушеная", "тушеная говядина"), 232, 16.8, 18.3, 0.0, None, 150),
+    Food("Свинина жареная", ("свинина", "свинина жареная", "жареная свинина"), 300, 18.0, 25.0, 0.0, None, 150),
+    Food("Котлета", ("котлета", "котлеты", "котлета мясная"), 220, 14.0, 15.0, 7.0, 80, 80),
+    Food("Сосиска", ("сосиска", "сосиски"), 266, 11.0, 24.0, 1.6, 50, 50),
+    Food("Колбаса вареная", ("колбаса", "колбаса вареная", "докторская колбаса"), 257, 13.0, 22.8, 0.0, None, 30),
+    Food("Лосось", ("лосось", "семга", "красная рыба", "форель"), 208, 20.0, 13.0, 0.0, None, 150),
+    Food("Треска", ("треска", "белая рыба", "минтай"), 78, 17.7, 0.7, 0.0, None, 150),
+    Food("Тунец консервированный", ("тунец", "тунец консервированный"), 96, 21.0, 1.0, 0.0, None, 100),
+    Food("Пельмени", ("пельмени", "пельмень"), 275, 11.9, 12.4, 29.0, 12, 250),
+    Food("Творог 5%", ("творог", "творог 5%"), 121, 17.2, 5.0, 1.8, None, 150),
+    Food("Молоко 2.5%", ("молоко", "молоко 2.5%"), 52, 2.8, 2.5, 4.7, None, 200),
+    Food("Кефир 1%", ("кефир",), 40, 3.0, 1.0, 4.0, None, 200),
+    Food("Йогурт натуральный", ("йогурт", "йогурт натуральный", "греческий йогурт"), 66, 5.0, 3.2, 3.5, None, 150),
+    Food("Сметана 15%", ("сметана",), 162, 2.6, 15.0, 3.0, None, 20),
+    Food("Сыр твердый", ("сыр", "сыр твердый", "российский сыр"), 356, 23.0, 29.0, 0.0, None, 30),
+    Food("Масло сливочное", ("масло сливочное", "сливочное масло", "масло"), 748, 0.5, 82.5, 0.8, None, 10),
+    Food("Масло растительное", ("масло растительное", "подсолнечное масло", "оливковое масло", "растительное масло"), 899, 0.0, 99.9, 0.0, None, 10),
+    Food("Банан", ("банан", "бананы"), 96, 1.5, 0.2, 21.8, 120, 120),
+    Food("Яблоко", ("яблоко", "яблоки"), 47, 0.4, 0.4, 9.8, 180, 180),
+    Food("Апельсин", ("апельсин", "апельсины"), 43, 0.9, 0.2, 8.1, 200, 200),
+    Food("Мандарин", ("мандарин", "мандарины"), 38, 0.8, 0.2, 7.5, 80, 80),
+    Food("Груша", ("груша", "груши"), 47, 0.4, 0.3, 10.3, 170, 170),
+    Food("Виноград", ("виноград",), 72, 0.6, 0.6, 15.4, None, 150),
+    Food("Огурец", ("огурец", "огурцы"), 15, 0.8, 0.1, 2.8, 120, 120),
+    Food("Помидор", ("помидор", "помидоры", "томат", "томаты"), 20, 0.6, 0.2, 4.2, 120, 120),
+    Food("Салат овощной", ("салат овощной", "овощной салат", "салат из овощей", "салат"), 40, 1.0, 2.5, 3.5, None, 150),
+    Food("Капуста", ("капуста", "капуста свежая"), 27, 1.8, 0.1, 4.7, None, 100),
+    Food("Морковь", ("морковь", "морковка"), 35, 1.3, 0.1, 6.9, 80, 80),
+    Food("Авокадо", ("авокадо",), 160, 2.0, 14.7, 1.8, 150, 150),
+    Food("Борщ", ("борщ",), 49, 1.1, 2.2, 6.7, None, 300),
+    Food("Суп куриный", ("суп", "суп куриный", "куриный суп", "бульон"), 36, 3.0, 1.5, 2.5, None, 300),
+    Food("Щи", ("щи",), 37, 1.1, 2.5, 2.6, None, 300),
+    Food("Плов", ("плов",), 150, 5.5, 5.5, 20.0, None, 250),
+    Food("Блины", ("блины", "блин", "блинчики"), 233, 6.1, 12.3, 26.0, 50, 100),
+    Food("Сырники", ("сырники", "сырник"), 220, 15.0, 10.0, 18.0, 60, 120),
+    Food("Пицца", ("пицца",), 266, 11.0, 10.0, 33.0, 120, 240),
+    Food("Шаурма", ("шаурма", "шаверма"), 215, 10.0, 11.0, 19.0, 350, 350),
+    Food("Бургер", ("бургер", "гамбургер", "чизбургер"), 254, 13.0, 12.0, 24.0, 200, 200),
+    Food("Роллы", ("роллы", "суши", "ролл"), 150, 6.0, 4.0, 22.0, 30, 240),
+    Food("Салат Цезарь", ("цезарь", "салат цезарь"), 190, 10.0, 14.0, 7.0, None, 200),
+    Food("Оливье", ("оливье", "салат оливье"), 198, 5.5, 16.5, 7.0, None, 200),
+    Food("Шоколад молочный", ("шоколад", "шоколад молочный"), 547, 7.6, 31.0, 59.0, None, 20),
+    Food("Печенье", ("печенье", "печенька"), 417, 7.5, 11.8, 74.9, 12, 36),
+    Food("Мед", ("мед",), 329, 0.8, 0.0, 81.5, None, 20),
+    Food("Сахар", ("сахар",), 399, 0.0, 0.0, 99.8, 5, 5),
+    Food("Орехи грецкие", ("орехи", "грецкие орехи", "грецкий орех"), 656, 16.0, 65.0, 11.0, None, 30),
+    Food("Арахис", ("арахис",), 552, 26.0, 45.0, 9.9, None, 30),
+    Food("Гранола", ("гранола",), 471, 10.0, 20.0, 64.0, None, 50),
+    Food("Мюсли", ("мюсли",), 352, 10.0, 6.0, 66.0, None, 50),
+    Food("Протеин (сухая смесь)", ("протеин", "протеиновый коктейль", "сывороточный протеин"), 370, 75.0, 5.0, 8.0, None, 30),
+    Food("Кофе черный", ("кофе", "кофе черный", "американо", "эспрессо"), 2, 0.2, 0.0, 0.3, None, 200),
+    Food("Капучино", ("капучино", "латте", "кофе с молоком"), 42, 2.2, 2.0, 3.6, None, 250),
+    Food("Чай без сахара", ("чай", "чай без сахара", "зеленый чай", "черный чай"), 1, 0.0, 0.0, 0.3, None, 250),
+    Food("Сок апельсиновый", ("сок", "сок апельсиновый", "апельсиновый сок"), 45, 0.7, 0.2, 10.4, None, 200),
+    Food("Кола", ("кола", "кока-кола", "coca-cola"), 42, 0.0, 0.0, 10.6, None, 330),
+    Food("Пиво", ("пиво",), 43, 0.5, 0.0, 3.6, None, 500),
+    Food("Вода", ("вода", "минералка"), 0, 0.0, 0.0, 0.0, None, 250),
+]
+
+# --- Нормализация и индекс для нечеткого поиска ---
+_WORD_RE = re.compile(r"[а-яa-z0-9%.\-]+")
+_RU_ENDINGS = sorted(["ами", "ями", "ого", "его", "ому", "ему", "ыми", "ими", "ой", "ей", "ая", "яя", "ое", "ее", "ые", "ие", "ый", "ий", "ом", "ем", "ах", "ях", "ов", "ев", "ам", "ям", "а", "я", "о", "е", "ы", "и", "у", "ю", "ь", "й"], key=len, reverse=True)
+
+def normalize_food_name(text: str) -> str:
+    return " ".join(_WORD_RE.findall(text.lower().replace("ё", "е")))
+
+def _stem_word(word: str) -> str:
+    for ending in _RU_ENDINGS:
+        if word.endswith(ending) and len(word) - len(ending) >= 3: return word[:-len(ending)]
+    return word
+
+def stem_food_name(text: str) -> str:
+    return " ".join(_stem_word(w) for w in normalize_food_name(text).split())
+
+def _word_trigrams(word: str) -> frozenset:
+    """Триграммы слова без дополнения пробелами (граничные "  к" есть почти у каждого ключа); короткое слово - одна "триграмма"."""
+    return frozenset(word[i:i + 3] for i in range(len(word) - 2)) if len(word) > 3 else frozenset((word,))
+
+def _dice(a: frozenset, b: frozenset) -> float: return 2 * len(a & b) / (len(a) + len(b))
+
+class FoodIndex:
+    """Точный поиск по алиасам и по основам слов, затем нечеткий поиск через инвертированный индекс триграмм.
+    Триграммный индекс просматривает только кандидатов с общими триграммами, поэтому остается быстрым на десятках тысяч записей.
+    Нечеткое совпадение принимается, только если слова запроса и ключа покрывают друг друга целиком (с опечатками и в любом порядке):
+    "чай с сахаром", "шоколадный торт", "свиная котлета" не сводятся к "чай", "шоколад", "котлета" и уходят в AI."""
+    def __init__(self, foods=(), min_similarity: float = 0.6, max_candidates: int = 8):
+        self.min_similarity, self.max_candidates = min_similarity, max_candidates
+        self._foods: list[Food] = []
+        self._exact: dict[str, int] = {}
+        self._stemmed: dict[str, int] = {}
+        self._keys: list[tuple[tuple, int, int]] = [] # (триграммы слов основы алиаса, индекс продукта, число триграмм)
+        self._postings: dict[str, list[int]] = defaultdict(list)
+        for food in foods: self.add(food)
+    def __len__(self) -> int: return len(self._foods)
+    def add(self, food: Food) -> None:
+        food_id = len(self._foods); self._foods.append(food)
+        for alias in (food.name, *food.aliases):
+            normalized = normalize_food_name(alias); stemmed = stem_food_name(alias)
+            if not normalized: continue
+            self._exact.setdefault(normalized, food_id); self._stemmed.setdefault(stemmed, food_id)
+            words = tuple(_word_trigrams(word) for word in stemmed.split()); grams = frozenset().union(*words)
+            key_id = len(self._keys)
+            self._keys.append((words, food_id, len(grams)))
+            for gram in grams: self._postings[gram].append(key_id)
+
+    def _words_match(self, a: frozenset, b: frozenset) -> bool:
+        # Короткие слова ("с", "без", "на", "рис") - только точно, иначе "чай с ..." совпал бы с чем угодно
+        return a == b or (len(a) > 1 and len(b) > 1 and _dice(a, b) >= self.min_similarity)
+    def _covers(self, query_words: tuple, key_words: tuple) -> bool:
+        """Каждое слово запроса нашлось в ключе и каждое слово ключа - в запросе: нет лишних "с"/"без" и неучтенных продуктов."""
+        return (all(any(self._words_match(q, k) for k in key_words) for q in query_words)
+                and all(any(self._words_match(k, q) for q in query_words) for k in key_words))
+
+    def lookup(self, query: str) -> Food | None:
+        normalized = normalize_food_name(query)
+        if not normalized: return None
+        if normalized in self._exact: return self._foods[self._exact[normalized]]
+        stemmed = stem_food_name(normalized)
+        if stemmed in self._stemmed: return self._foods[self._stemmed[stemmed]]
+        query_words = tuple(_word_trigrams(word) for word in stemmed.split())
+        query_grams = frozenset().union(*query_words)
+        overlaps: dict[int, int] = defaultdict(int)
+        for gram in query_grams:
+            for key_id in self._postings.get(gram, ()): overlaps[key_id] += 1
+        scored = []
+        for key_id, overlap in overlaps.items():
+            score = 2 * overlap / (len(query_grams) + self._keys[key_id][2]) # Коэффициент Дайса
+            if score >= self.min_similarity: scored.append((score, key_id))
+        for _, key_id in sorted(scored, reverse=True)[:self.max_candidates]:
+            key_words, food_id, _ = self._keys[key_id]
+            if self._covers(query_words, key_words): return self._foods[food_id]
+        return None
+    def load_csv(self, path: str) -> int:
+        """Дополнительные продукты из CSV (разделитель ';'): name;aliases через |;kcal;protein;fat;carbs;piece_g;portion_g."""
+        added = 0
+        with open(path, encoding="utf-8", newline="") as f:
+            for row in csv.reader(f, delimiter=";"):
+                if not row or row[0].startswith("#"): continue
+                try:
+                    name, aliases, kcal, protein, fat, carbs, piece_g, portion_g = (row + [""] * 8)[:8]
+                    self.add(Food(name, tuple(a for a in aliases.split("|") if a), float(kcal), float(protein), float(fat), float(carbs), float(piece_g) if piece_g else None, float(portion_g) if portion_g else 100.0))
+                    added += 1
+                except ValueError: logger.warning("Пропущена некорректная строка таблицы КБЖУ %s: %s", path, row)
+        return added
+
+# --- Разбор описания приема пищи ---
+_ITEM_SPLIT_RE = re.compile(r"\s*[,;\n+]\s*")
+_AND_SPLIT_RE = re.compile(r"\s+и\s+")
+_WITH_RE = re.compile(r"(?:^|\s)(?:с|со|без)\s") # "кофе с сахаром и молоком" - "и молоком" относится к кофе, а не отдельная позиция
+_AMOUNT_UNIT_RE = re.compile(r"(\d+(?:[.,]\d+)?)\s*(килограммов|килограмма|килограмм|кг|граммов|грамма|грамм|гр|г|миллилитров|миллилитра|миллилитр|мл|литров|литра|литр|л|штук|штуки|штука|шт)(?=[^а-яa-z]|$)")
+_LEADING_COUNT_RE = re.compile(r"^(\d+(?:[.,]\d+)?|одна|один|одно|две|два|три|четыре|пять|пол|половина)\s+")
+_UNIT_GRAMS = {"кг": 1000, "л": 1000, "г": 1, "мл": 1}
+_UNIT_CANON = {"килограммов": "кг", "килограмма": "кг", "килограмм": "кг", "граммов": "г", "грамма": "г", "грамм": "г", "гр": "г", "миллилитров": "мл", "миллилитра": "мл", "миллилитр": "мл", "литров": "л", "литра": "л", "литр": "л", "штук": "шт", "штуки": "шт", "штука": "шт"}
+_TRAILING_COUNT_RE = re.compile(r"\s+(\d+)$")
+_COUNT_WORDS = {"одна": 1, "один": 1, "одно": 1, "две": 2, "два": 2, "три": 3, "четыре": 4, "пять": 5, "пол": 0.5, "половина": 0.5}
+
+class ParsedItem(NamedTuple):
+    raw: str
+    name: str
+    amount: float | None # Количество в единицах unit
+    unit: str | None # "г", "мл", "кг", "л", "шт" или None, если количество не указано
+
+def _split_items(description: str) -> list[str]:
+    parts = []
+    for chunk in _ITEM_SPLIT_RE.split(description.lower().replace("ё", "е")):
+        for i, part in enumerate(_AND_SPLIT_RE.split(chunk)):
+            if i and _WITH_RE.search(parts[-1]): parts[-1] += " и " + part
+            else: parts.append(part)
+    return parts
+
+def parse_meal_items(description: str) -> list[ParsedItem]:
+    """'гречка 150г, 2 яйца, кофе' -> [('гречка', 150, 'г'), ('яйца', 2, 'шт'), ('кофе', None, None)]"""
+    items = []
+    for raw in _split_items(description):
+        raw = raw.strip(" .")
+        if not raw: continue
+        amount, unit, name = None, None, raw
+        match = _AMOUNT_UNIT_RE.search(raw)
+        if match:
+            amount, unit = float(match.group(1).replace(",", ".")), _UNIT_CANON.get(match.group(2), match.group(2))
+            name = (raw[:match.start()] + " " + raw[match.end():]).strip()
+        else:
+            match = _LEADING_COUNT_RE.match(raw)
+            if match:
+                count = match.group(1)
+                amount, unit = _COUNT_WORDS.get(count) or float(count.replace(",", ".")), "шт"
+                name = raw[match.end():].strip()
+            elif (match := _TRAILING_COUNT_RE.search(raw)):
+                amount, unit, name = float(match.group(1)), "шт", raw[:match.start()].strip()
+        items.append(ParsedItem(raw, name, amount, unit))
+    return items
+
+def _format_amount(amount: float) -> str: return f"{amount:g}"
+
+def estimate_item(food: Food, item: ParsedItem) -> dict:
+    """КБЖУ позиции в формате, который хранится в TODAY_MEALS (как от AI)."""
+    if item.unit in _UNIT_GRAMS: grams, quantity = item.amount * _UNIT_GRAMS[item.unit], f"{_format_amount(item.amount)} {item.unit}"
+    elif item.unit == "шт":
+        grams = item.amount * (food.piece_g or food.portion_g)
+        quantity = f"{_format_amount(item.amount)} шт (≈{grams:.0f} г)"
+    else: grams, quantity = food.portion_g, f"порция (≈{food.portion_g:.0f} г)"
+    factor = grams / 100
+    return {"name": food.name, "quantity": quantity, "calories": round(food.calories * factor), "protein": round(food.protein * factor, 1), "fat": round(food.fat * factor, 1), "carbs": round(food.carbs * factor, 1)}
+
+def sum_meal_items(items: list[dict]) -> dict:
+    total = {k: sum(item.get(k, 0) or 0 for item in items) for k in ("calories", "protein", "fat", "carbs")}
+    return {"calories": round(total["calories"]), "protein": round(total["protein"], 1), "fat": round(total["fat"], 1), "carbs": round(total["carbs"], 1)}
+
+def analyze_meal_locally(description: str, index: "FoodIndex") -> tuple[list[dict], list[str]]:
+    """Возвращает (оцененные локально позиции, исходные тексты позиций, которых нет в таблице)."""
+    resolved, unknown = [], []
+    for item in parse_meal_items(description):
+        food = index.lookup(item.name) if item.name else None
+        if food is None: unknown.append(item.raw)
+        else: resolved.append(estimate_item(food, item))
+    return resolved, unknown
+
+# --- Компактное хранение приемов пищи за день ---
+# Названия продуктов и количества повторяются у тысяч пользователей - храним их интернированными строками,
+# КБЖУ - плоским array('d') (4 числа на позицию), время - секундами epoch. Итог дня обновляется при добавлении.
+NUTRIENTS = ("calories", "protein", "fat", "carbs")
+
+def _number(value) -> float:
+    try: return float(value or 0)
+    except (TypeError, ValueError): return 0.0
+
+def _intern(value) -> str: return sys.intern(str(value)) if value is not None else "?"
+
+def display_number(value: float, digits: int = 1):
+    """150.0 -> 150, 12.345 -> 12.3: числа для текста ответа без хвостов float."""
+    value = round(value, digits)
+    return int(value) if value == int(value) else value
+
+class MealRecord:
+    """Один прием пищи: название, описание пользователя, время (epoch), КБЖУ приема и позиции."""
+    __slots__ = ("meal_name", "description", "timestamp", "totals", "item_names", "item_quantities", "item_values")
+    def __init__(self, meal_name: str, description: str, timestamp: float, totals, item_names: tuple = (), item_quantities: tuple = (), item_values=None):
+        self.meal_name, self.description, self.timestamp = _intern(meal_name), description, timestamp
+        self.totals = array("d", totals)
+        self.item_names, self.item_quantities = item_names, item_quantities
+        self.item_values = item_values if item_values is not None else array("d")
+
+    @classmethod
+    def from_estimate(cls, meal_name: str, description: str, estimate: dict, timestamp: float) -> "MealRecord":
+        """Из оценки вида {"items": [...], "total": {...}} (AI, кэш или локальная таблица)."""
+        items = [item for item in estimate.get("items") or [] if isinstance(item, dict)]
+        total = estimate.get("total") or {}
+        return cls(meal_name, description, timestamp, (_number(total.get(k)) for k in NUTRIENTS),
+                   tuple(_intern(item.get("name")) for item in items), tuple(_intern(item.get("quantity")) for item in items),
+                   array("d", (_number(item.get(k)) for item in items for k in NUTRIENTS)))
+
+    def __len__(self) -> int: return len(self.item_names)
+    @property
+    def calories(self) -> float: return self.totals[0]
+    def items(self):
+        """(название, количество, ккал, белки, жиры, углеводы) по позициям."""
+        values = self.item_values
+        for i, (name, quantity) in enumerate(zip(self.item_names, self.item_quantities)): yield (name, quantity, *values[4 * i:4 * i + 4])
+    def items_as_dicts(self) -> list[dict]:
+        return [dict(zip(("name", "quantity", *NUTRIENTS), item)) for item in self.items()]
+    def totals_as_dict(self) -> dict: return dict(zip(NUTRIENTS, self.totals))
+
+class MealLog:
+    """Приемы пищи за день с накопленным итогом (totals обновляется в append, итог не пересчитывается при показе)."""
+    __slots__ = ("meals", "totals")
+    def __init__(self, meals=()):
+        self.meals: list[MealRecord] = []
+        self.totals = array("d", (0.0, 0.0, 0.0, 0.0))
+        for meal in meals: self.append(meal)
+    def append(self, meal: MealRecord) -> None:
+        self.meals.append(meal)
+        for i, value in enumerate(meal.totals): self.totals[i] += value
+    def __len__(self) -> int: return len(self.meals)
+    def __iter__(self): return iter(self.meals)
+    def __bool__(self) -> bool: return bool(self.meals)
+    def totals_as_dict(self) -> dict: return dict(zip(NUTRIENTS, self.totals))
@@ -0,0 +1,7 @@
+import os
+import sys
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+# fitness_bot читает настройки при импорте и без токена завершает процесс
+os.environ.setdefault("TELEGRAM_TOKEN", "123456:test-token")
+os.environ.setdefault("BOT_DB_PATH", "")
@@ -0,0 +1,49 @@
+import pytest
+
+import fitness_bot as fb
+
+@pytest.mark.parametrize("text, expected", [
+    ('Вот ответ: {"a": 1, "b": [1, 2,],} Надеюсь, помог', {"a": 1, "b": [1, 2]}),
+    ('{"items":[{"name":"a","calories":1},{"name":"b","cal', {"items": [{"name": "a", "calories": 1}]}),
+    ('{"items":[{"name":"a","calories":1},{"name":"b","calories":2,"pro', {"items": [{"name": "a", "calories": 1}]}),
+    ('{"meals":[{"index":1,"items":[{"name":"a"}],"total":{"calories":1}},{"index":2,"items":[{"name":"x"},{"na',
+     {"meals": [{"index": 1, "items": [{"name": "a"}], "total": {"calories": 1}}]}),
+    ('{"meals":[{"index":1,"it', {"meals": []}),
+    ('[1, 2, [3, 4', [1, 2]),
+    ('{"calories": 100, "protein": 5, "fa', {"calories": 100, "protein": 5}),
+    ('{"total": {"calories": 100, "protein": 5, "fa', {"total": {"calories": 100, "protein": 5}}),
+    ('{"name": "a, b", "note": "скобка } в строке", "x', {"name": "a, b", "note": "скобка } в строке"}),
+])
+def test_repair_json(text, expected):
+    assert fb.repair_json(text) == expected
+
+@pytest.mark.parametrize("text", ["нет json", '{"a": 1]', '{"a', '{"a": tru}'])
+def test_repair_json_gives_up(text):
+    assert fb.repair_json(text) is None
+
+def test_compile_schema_cleans_meal_estimate():
+    data = {"items": [{"name": "гречка", "calories": "165 ккал", "protein": 6, "fat": "1,6 г", "carbs": 33, "extra": True}],
+            "total": {"calories": 165, "protein": 6, "fat": 1.6, "carbs": 33}, "comment": "лишнее"}
+    assert fb.MEAL_ESTIMATE_VALIDATOR(data) == {"items": [{"name": "гречка", "quantity": "?", "calories": 165, "protein": 6, "fat": 1.6, "carbs": 33}],
+                                                "total": {"calories": 165, "protein": 6, "fat": 1.6, "carbs": 33}}
+
+@pytest.mark.parametrize("value, error", [
+    ({"items": []}, r"\$\.total: нет обязательного поля"),
+    ({"total": {"calories": "много", "protein": 1, "fat": 1, "carbs": 1}}, r"\$\.total\.calories: ожидалось число"),
+    ({"total": {"calories": True, "protein": 1, "fat": 1, "carbs": 1}}, r"ожидалось число"),
+    ({"items": {}, "total": {"calories": 1, "protein": 1, "fat": 1, "carbs": 1}}, r"\$\.items: ожидался массив"),
+])
+def test_compile_schema_rejects(value, error):
+    with pytest.raises(ValueError, match=error): fb.MEAL_ESTIMATE_VALIDATOR(value)
+
+def test_compile_schema_integer_minimum():
+    check = fb.compile_schema({"type": "integer", "minimum": 1})
+    assert check("3") == 3 and check(2.0) == 2
+    with pytest.raises(ValueError): check(0)
+    with pytest.raises(ValueError): check(1.5)
+
+def test_import_batch_reply_keeps_complete_meals_of_truncated_reply():
+    reply = ('{"meals":[{"index":1,"items":[],"total":{"calories":100,"protein":1,"fat":1,"carbs":1}},'
+             '{"index":2,"items":[],"total":{"calories":200,"pro')
+    estimates = fb.parse_import_batch_reply(reply, 2)
+    assert estimates[0]["total"]["calories"] == 100 and estimates[1] is None
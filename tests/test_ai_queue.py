@@ -0,0 +1,51 @@
+import asyncio
+
+import pytest
+
+import fitness_bot as fb
+
+async def submit_all(queue: fb.AIWorkQueue, count: int, notice_delay: float = 0.0):
+    """Блокирующая задача занимает единственный слот, затем приходят count запросов; возвращает (номера в очереди, порядок выполнения)."""
+    release, positions, order = asyncio.Event(), {}, []
+    async def on_queued(name, position):
+        await asyncio.sleep(notice_delay) # Медленный Telegram не должен менять ни номера, ни порядок
+        positions[name] = position
+    async def job(name):
+        order.append(name)
+        if name == "blocker": await release.wait()
+        return name
+    tasks = [asyncio.create_task(queue.run(lambda: job("blocker")))]
+    await asyncio.sleep(0)
+    for n in range(count):
+        tasks.append(asyncio.create_task(queue.run(lambda n=n: job(n), lambda position, n=n: on_queued(n, position))))
+    await asyncio.sleep(0)
+    release.set()
+    results = await asyncio.gather(*tasks, return_exceptions=True)
+    await asyncio.sleep(notice_delay + 0.01)
+    return positions, order, results
+
+@pytest.mark.parametrize("notice_delay", [0.0, 0.05])
+def test_queue_positions_are_distinct_and_fifo(notice_delay):
+    positions, order, _ = asyncio.run(submit_all(fb.AIWorkQueue(1, 10), 4, notice_delay))
+    assert positions == {0: 1, 1: 2, 2: 3, 3: 4}
+    assert order == ["blocker", 0, 1, 2, 3]
+
+def test_queue_full_rejects_overflow():
+    queue = fb.AIWorkQueue(1, 2)
+    positions, order, results = asyncio.run(submit_all(queue, 3))
+    assert isinstance(results[-1], fb.AIQueueFullError)
+    assert (positions, order, queue.rejected, queue.waiting) == ({0: 1, 1: 2}, ["blocker", 0, 1], 1, 0)
+
+def test_late_arrival_does_not_overtake_waiters():
+    async def scenario():
+        queue, order, release = fb.AIWorkQueue(1, 10), [], asyncio.Event()
+        async def job(name, wait=False):
+            order.append(name)
+            if wait: await release.wait()
+        first = asyncio.create_task(queue.run(lambda: job("first", wait=True))); await asyncio.sleep(0)
+        waiter = asyncio.create_task(queue.run(lambda: job("waiter"))); await asyncio.sleep(0)
+        release.set(); await first # Слот освободился; новый запрос приходит раньше, чем ожидающий успел проснуться
+        late = asyncio.create_task(queue.run(lambda: job("late")))
+        await asyncio.gather(waiter, late)
+        return order
+    assert asyncio.run(scenario()) == ["first", "waiter", "late"]
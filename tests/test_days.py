@@ -0,0 +1,20 @@
+from datetime import date, timedelta
+
+import fitness_bot as fb
+
+def user_with_meal(zone: str) -> dict:
+    ud = {fb.TIMEZONE: zone}; fb.ensure_current_day(ud)
+    ud[fb.TODAY_MEALS] = ["обед"]
+    return ud
+
+def test_day_kept_when_timezone_moves_date_back():
+    ud = user_with_meal("UTC+14:00"); day = ud[fb.LAST_MEAL_DATE]
+    ud[fb.TIMEZONE] = "UTC-12:00" # местная дата на сутки раньше
+    assert not fb.ensure_current_day(ud)
+    assert (ud[fb.LAST_MEAL_DATE], ud[fb.TODAY_MEALS]) == (day, ["обед"])
+
+def test_new_day_resets_meals():
+    ud = user_with_meal("UTC")
+    ud[fb.LAST_MEAL_DATE] = (date.fromisoformat(ud[fb.LAST_MEAL_DATE]) - timedelta(days=1)).isoformat()
+    assert fb.ensure_current_day(ud)
+    assert (ud[fb.LAST_MEAL_DATE], len(ud[fb.TODAY_MEALS])) == (fb.user_today(ud).isoformat(), 0)
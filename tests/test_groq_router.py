@@ -0,0 +1,73 @@
+"""ModelRouter против локального fake_groq: хедж, переход к следующей модели, circuit breaker."""
+import asyncio
+
+import pytest
+
+import fitness_bot as fb
+from fake_groq import FakeGroqServer
+
+PRIMARY, SECONDARY = "primary-model", "secondary-model"
+
+@pytest.fixture
+def routing(monkeypatch):
+    router = fb.ModelRouter([PRIMARY, SECONDARY], window=20)
+    for name, value in {"GROQ_ROUTER": router, "GROQ_RATE_LIMITS": fb.GroqRateLimits(6000, 10_000_000), "GROQ_API_KEY": "test", "GROQ_MAX_RETRIES": 0,
+                        "GROQ_HEDGE": True, "GROQ_HEDGE_DEFAULT_DELAY": 0.2, "GROQ_BREAKER_CONSECUTIVE": 3, "GROQ_BREAKER_COOLDOWN": 0.2}.items():
+        monkeypatch.setattr(fb, name, value)
+    return router
+
+def serve(models: dict, **kwargs):
+    return FakeGroqServer(first_token_delay=0.01, models=models, responder=lambda request: f"ответ {request['model']}", **kwargs)
+
+def run_with(server: FakeGroqServer, *messages: str) -> list[tuple[str, str]]:
+    async def run():
+        async with server:
+            fb.GROQ_API_URL = server.url
+            return [await fb.ask_groq(message, system_prompt_override="test") for message in messages]
+    return asyncio.run(run())
+
+def test_slow_primary_is_hedged(routing):
+    server = serve({PRIMARY: {"first_token_delay": 2.0}})
+    assert run_with(server, "привет") == [(f"ответ {SECONDARY}", "ok")]
+    assert routing.decisions[(PRIMARY, "primary")] == routing.decisions[(SECONDARY, "hedge")] == routing.decisions[(SECONDARY, "hedge_won")] == 1
+    assert routing.models[PRIMARY].state == "closed"
+
+def test_failing_primary_opens_breaker_then_recovers(routing):
+    server = serve({PRIMARY: {"error_rate": 1.0}})
+    replies = run_with(server, *(f"вопрос {i}" for i in range(4)))
+    assert replies == [(f"ответ {SECONDARY}", "ok")] * 4
+    assert routing.models[PRIMARY].state == "open"
+    assert server.requests_by_model[PRIMARY] == 3 # После открытия breaker основную модель не спрашивают
+    assert routing.pick() == [SECONDARY]
+
+    server = serve({})
+    async def recover():
+        await asyncio.sleep(fb.GROQ_BREAKER_COOLDOWN)
+        assert routing.pick() == [PRIMARY, SECONDARY] and routing.models[PRIMARY].state == "half_open"
+        async with server:
+            fb.GROQ_API_URL = server.url
+            return await fb.ask_groq("пробный", system_prompt_override="test")
+    assert asyncio.run(recover()) == (f"ответ {PRIMARY}", "ok")
+    assert routing.models[PRIMARY].state == "closed"
+
+def test_rate_limited_model_fails_over_without_tripping_breaker(routing):
+    server = serve({PRIMARY: {"error_rate": 1.0, "error_status": 429}}, retry_after=30)
+    replies = run_with(server, *(f"вопрос {i}" for i in range(4)))
+    assert replies == [(f"ответ {SECONDARY}", "ok")] * 4
+    assert routing.models[PRIMARY].state == "closed" and routing.models[PRIMARY].error_rate() == 0
+    assert fb.GROQ_RATE_LIMITS[SECONDARY].requests.wait_time(1) == 0 # Пауза после 429 - только у модели, ответившей 429
+    assert fb.GROQ_RATE_LIMITS[PRIMARY].requests.wait_time(1) > 20
+
+def test_decommissioned_model_is_dropped(routing):
+    server = serve({PRIMARY: {"decommissioned": True}})
+    assert run_with(server, "привет") == [(f"ответ {SECONDARY}", "ok")]
+    assert routing.models[PRIMARY].state == "decommissioned"
+    assert routing.pick() == [SECONDARY]
+
+def test_all_models_failing_returns_failure_outcome(routing):
+    server = serve({PRIMARY: {"error_rate": 1.0}, SECONDARY: {"error_rate": 1.0}})
+    (reply, outcome), = run_with(server, "привет")
+    assert outcome == "http_error" and outcome not in fb.AI_REPLY_OUTCOMES
+    for _ in range(3): run_with(server, "еще")
+    assert routing.pick() == []
+    assert run_with(server, "последний") == [(fb.ALL_MODELS_DOWN_TEXT, "fail_fast")]
@@ -0,0 +1,58 @@
+import asyncio
+from datetime import datetime
+
+import pytest
+from telegram.error import TimedOut
+
+import fitness_bot as fb
+
+@pytest.mark.parametrize("line, expected", [
+    ("2024-05-01 08:30 Завтрак: овсянка 200г, банан", (datetime(2024, 5, 1, 8, 30), "Завтрак", "овсянка 200г, банан")),
+    ("01.05.2024 Обед: борщ, хлеб", (datetime(2024, 5, 1, 13), "Обед", "борщ, хлеб")),
+    ("2024-5-1,08:30,ужин,гречка", (datetime(2024, 5, 1, 8, 30), "Ужин", "гречка")),
+    ("2024-05-01;;перекус;банан", (datetime(2024, 5, 1, 16), "Перекус", "банан")),
+    ("2024-05-01\t08:30\tобед\tгречка", (datetime(2024, 5, 1, 8, 30), "Обед", "гречка")),
+    ("2024-05-01\tобед\tгречка", (datetime(2024, 5, 1, 13), "Обед", "гречка")),
+    ("2024-05-01T08:30 творог", (datetime(2024, 5, 1, 8, 30), "Прием пищи", "творог")),
+    ("﻿2024-05-01 | 19:00 | ужин | рыба", (datetime(2024, 5, 1, 19), "Ужин", "рыба")),
+])
+def test_parse_import_line(line, expected):
+    assert fb.parse_import_line(line) == expected
+
+@pytest.mark.parametrize("line", ["дата,время,прием,описание", "2024-13-01 обед", "2024-05-01 25:00 обед", "2024-05-01", "2024-05-01 " + "х" * 600])
+def test_parse_import_line_rejects(line):
+    assert fb.parse_import_line(line) is None
+
+class FakeHistory:
+    def __init__(self, fail_batch: bool = False):
+        self.fail_batch, self.statuses, self.meals = fail_batch, [], []
+
+    async def record_import_batch(self, job, meals):
+        if self.fail_batch: raise RuntimeError("boom")
+        self.meals += meals
+
+    async def set_import_status(self, job_id, status): self.statuses.append(status)
+
+class FlakyBot:
+    def __init__(self): self.edits = 0
+
+    async def edit_message_text(self, text, chat_id, message_id):
+        self.edits += 1; raise TimedOut()
+
+def run_job(tmp_path, monkeypatch, history):
+    path = tmp_path / "meals.tsv"
+    path.write_text("2024-05-01\t08:30\tзавтрак\tгречка 150г\n2024-05-02\t13:00\tобед\tрис 200г\n", encoding="utf-8")
+    monkeypatch.setattr(fb, "MEAL_HISTORY", history); monkeypatch.setattr(fb, "IMPORT_PROGRESS_INTERVAL", 0)
+    job = {"id": 1, "user_id": 7, "chat_id": 7, "message_id": 10, "path": str(path), "byte_offset": 0, "lines_done": 0, "total_lines": 2,
+           "imported": 0, "failed": 0, "skipped": 0, "status": "running"}
+    bot = FlakyBot(); asyncio.run(fb.run_import_job(bot, job))
+    return job, bot
+
+def test_import_survives_telegram_errors(tmp_path, monkeypatch):
+    job, bot = run_job(tmp_path, monkeypatch, history := FakeHistory())
+    assert (job["status"], job["imported"], history.statuses) == ("done", 2, ["done"])
+    assert bot.edits == 2 # прогресс после пачки и итог
+
+def test_import_marks_job_failed_on_unexpected_error(tmp_path, monkeypatch):
+    job, bot = run_job(tmp_path, monkeypatch, history := FakeHistory(fail_batch=True))
+    assert (job["status"], history.statuses, bot.edits) == ("failed", ["failed"], 1)
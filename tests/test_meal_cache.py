@@ -0,0 +1,23 @@
+import json
+import os
+import time
+
+import fitness_bot as fb
+
+def test_load_skips_malformed_entries(tmp_path):
+    path = tmp_path / "meal_cache.json"; now = time.time()
+    path.write_text(json.dumps([["гречка", now, {"total": {"calories": 165}}], ["битая"], ["рис", "вчера", {}], [1, now, {}], ["чай", now, "текст"], ["банан", now, {"total": {}}]]), encoding="utf-8")
+    cache = fb.MealEstimateCache(str(path), 100, 3600, 1); cache.load()
+    assert list(cache._entries) == ["гречка", "банан"]
+
+def test_load_ignores_non_list_file(tmp_path):
+    path = tmp_path / "meal_cache.json"; path.write_text('{"гречка": 1}', encoding="utf-8")
+    cache = fb.MealEstimateCache(str(path), 100, 3600, 1); cache.load()
+    assert not cache._entries
+
+def test_save_round_trip_leaves_no_tmp_file(tmp_path):
+    path = str(tmp_path / "meal_cache.json")
+    cache = fb.MealEstimateCache(path, 100, 3600, 1); cache.put("гречка", {"total": {"calories": 165}}); cache.save()
+    assert os.listdir(tmp_path) == ["meal_cache.json"]
+    loaded = fb.MealEstimateCache(path, 100, 3600, 1); loaded.load()
+    assert loaded.get("гречка") == {"total": {"calories": 165}}
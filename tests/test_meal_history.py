@@ -0,0 +1,72 @@
+"""MealHistory: покрытие окна месяцами/неделями/днями, итоги и счетчик дней с записями, /stats."""
+import asyncio
+from datetime import date, timedelta
+from types import SimpleNamespace
+
+import pytest
+
+import fitness_bot as fb
+from nutrition import MealRecord
+
+TODAY = date(2024, 3, 3) # Воскресенье: неделя 26.02-03.03 переходит через границу месяца
+MEALS = [(date(2023, 3, 1), 900), (date(2024, 1, 15), 400), (date(2024, 1, 15), 500), (date(2024, 2, 4), 300), (date(2024, 2, 10), 650),
+         (date(2024, 2, 26), 700), (date(2024, 2, 29), 200), (date(2024, 2, 29), 350), (date(2024, 2, 29), 450), (date(2024, 3, 1), 800),
+         (date(2024, 3, 3), 250), (date(2024, 3, 3), 550)]
+
+def meal(kcal: float) -> MealRecord:
+    return MealRecord.from_estimate("Обед", "еда", {"items": [], "total": {"calories": kcal, "protein": kcal / 100, "fat": kcal / 200, "carbs": kcal / 50}}, 1709251200.0)
+
+def expand(table: str, period: str) -> list[date]:
+    start = date.fromisoformat(period)
+    if table == "daily_totals": return [start]
+    if table == "weekly_totals": return [start + timedelta(days=n) for n in range(7)]
+    return [start + timedelta(days=n) for n in range(31) if (start + timedelta(days=n)).month == start.month]
+
+@pytest.mark.parametrize("days", fb.STATS_PERIODS)
+def test_rollup_periods_cover_window_exactly_once(days):
+    for end in (date(2023, 12, 20) + timedelta(days=n) for n in range(120)):
+        start = end - timedelta(days=days - 1)
+        covered = [d for table, periods in fb._rollup_periods(start, end).items() for period in periods for d in expand(table, period)]
+        assert sorted(covered) == [start + timedelta(days=n) for n in range(days)]
+
+def test_rollup_periods_prefers_months_and_weeks():
+    assert fb._rollup_periods(date(2024, 1, 31), date(2024, 3, 3)) == {"monthly_totals": ["2024-02-01"], "weekly_totals": [], "daily_totals": ["2024-01-31", "2024-03-01", "2024-03-02", "2024-03-03"]}
+    assert fb._rollup_periods(date(2024, 2, 26), TODAY) == {"monthly_totals": [], "weekly_totals": ["2024-02-26"], "daily_totals": []}
+
+@pytest.fixture
+def history(tmp_path):
+    history = fb.MealHistory(str(tmp_path / "bot.db"))
+    async def record():
+        for day, kcal in MEALS: await history.record_meal(1, day, meal(kcal))
+    asyncio.run(record())
+    return history
+
+def test_rollup_rows_count_distinct_days(history):
+    rows = lambda table: dict(history._conn.execute(f"SELECT period, days FROM {table} WHERE user_id = 1"))
+    assert rows("daily_totals")["2024-02-29"] == 1
+    assert rows("weekly_totals")["2024-02-26"] == 4 # 26.02, 29.02, 01.03, 03.03 - неделя через границу месяца
+    assert (rows("monthly_totals")["2024-02-01"], rows("monthly_totals")["2024-03-01"], rows("monthly_totals")["2024-01-01"]) == (4, 2, 1)
+
+@pytest.mark.parametrize("days", fb.STATS_PERIODS)
+def test_summarize_matches_raw_meals(history, days):
+    window = [(day, kcal) for day, kcal in MEALS if TODAY - timedelta(days=days - 1) <= day <= TODAY]
+    summary = asyncio.run(history.summarize(1, days, TODAY))
+    assert (summary["meals"], summary["days"]) == (len(window), len({day for day, _ in window}))
+    assert summary["calories"] == pytest.approx(sum(kcal for _, kcal in window)) and summary["carbs"] == pytest.approx(sum(kcal / 50 for _, kcal in window))
+
+def test_summarize_window_across_month_boundary(history):
+    assert {days: (s["meals"], s["days"], s["calories"]) for days in (7, 30) for s in [asyncio.run(history.summarize(1, days, TODAY))]} == {7: (7, 4, 3300), 30: (9, 6, 4250)}
+    assert asyncio.run(history.summarize(2, 30, TODAY))["days"] == 0
+
+def test_stats_command_reports_daily_averages(history, monkeypatch):
+    monkeypatch.setattr(fb, "MEAL_HISTORY", history); monkeypatch.setattr(fb, "user_today", lambda ud: TODAY)
+    replies = []
+    async def reply_text(text, parse_mode=None): replies.append(text)
+    def stats(user_id: int) -> str:
+        update = SimpleNamespace(message=SimpleNamespace(reply_text=reply_text), effective_user=SimpleNamespace(id=user_id))
+        asyncio.run(fb.stats_command(update, SimpleNamespace(user_data={fb.PROFILE_COMPLETE: True, fb.TARGET_CALORIES: 1650})))
+        return replies[-1]
+    text = stats(1)
+    assert "*За 7 дн.:* записей 7 за 4 дн.\n  В среднем в день: *825 ккал*" in text and "От цели (1650 ккал): *50%*" in text
+    assert "*За 30 дн.:* записей 9 за 6 дн." in text
+    assert stats(2).count("записей нет.") == len(fb.STATS_PERIODS)
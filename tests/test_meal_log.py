@@ -0,0 +1,49 @@
+"""MealLog: накопленный итог дня совпадает с суммой приемов пищи - после append, после загрузки из SQLite и в /todaycalories."""
+import asyncio
+from types import SimpleNamespace
+
+import fitness_bot as fb
+from nutrition import NUTRIENTS, MealLog, MealRecord
+
+ESTIMATES = [{"items": [{"name": "овсянка", "quantity": "200 г", "calories": 176.3, "protein": 6.1, "fat": 3.3, "carbs": 30.7}, {"name": "банан", "quantity": "1 шт", "calories": 105.1, "protein": 1.3, "fat": 0.4, "carbs": 27}],
+              "total": {"calories": 281.4, "protein": 7.4, "fat": 3.7, "carbs": 57.7}},
+             {"items": [], "total": {"calories": 640.25, "protein": 38.1, "fat": 22.9, "carbs": 61.3}},
+             {"items": [{"name": "кефир", "quantity": "250 мл", "calories": 127.5, "protein": 7.5, "fat": 6.3, "carbs": 10}], "total": {"calories": "127.5", "protein": 7.5, "fat": None, "carbs": 10}}]
+
+def meals() -> list[MealRecord]:
+    return [MealRecord.from_estimate(name, "описание", estimate, 1714550000.0 + 3600 * n) for n, (name, estimate) in enumerate(zip(("Завтрак", "Обед", "Ужин"), ESTIMATES))]
+
+def summed(records) -> list[float]: return [sum(meal.totals[i] for meal in records) for i in range(len(NUTRIENTS))]
+
+def test_totals_follow_appends():
+    log, records = MealLog(), meals()
+    assert list(log.totals) == [0.0] * 4 and not log
+    for n, meal in enumerate(records, 1):
+        log.append(meal)
+        assert list(log.totals) == summed(records[:n])
+    assert log.totals_as_dict() == dict(zip(NUTRIENTS, summed(records))) and log.totals_as_dict()["fat"] == 3.7 + 22.9 # fat: None в оценке - 0
+    assert list(MealLog(records).totals) == summed(records)
+
+def test_totals_after_persistence_reload(tmp_path):
+    path = str(tmp_path / "bot.db")
+    async def scenario():
+        writer = fb.SQLitePersistence(path)
+        await writer.update_user_data(1, {fb.PROFILE_COMPLETE: True, fb.TODAY_MEALS: MealLog(meals()[:2])})
+        await writer.wait_written()
+        reloaded = {}; await fb.SQLitePersistence(path).refresh_user_data(1, reloaded)
+        log = reloaded[fb.TODAY_MEALS]; log.append(meals()[2]) # Итог загруженного дня продолжает накапливаться
+        return log
+    log = asyncio.run(scenario())
+    assert isinstance(log, MealLog) and len(log) == 3
+    assert list(log.totals) == summed(log) == summed(meals())
+
+def test_today_calories_shows_running_totals():
+    replies = []
+    async def reply_text(text, parse_mode=None): replies.append(text)
+    ud = {fb.PROFILE_COMPLETE: True, fb.TARGET_CALORIES: 2000, fb.TODAY_MEALS: MealLog(meals())}
+    ud[fb.LAST_MEAL_DATE] = fb.user_today(ud).isoformat()
+    update = SimpleNamespace(effective_user=SimpleNamespace(id=1), message=SimpleNamespace(reply_text=reply_text))
+    asyncio.run(fb.show_today_calories(update, SimpleNamespace(user_data=ud)))
+    kcal, protein, fat, carbs = summed(meals())
+    assert f"*📊 Итого за сегодня (приемов пищи: 3):*\n  Ккал: *{fb.display_number(kcal)}*,\n  Белки: {protein:.1f} г,\n  Жиры: {fat:.1f} г,\n  Углеводы: {carbs:.1f} г\n" in replies[0]
+    assert f"Осталось потребить: *{2000 - kcal:.0f} ккал*" in replies[0] and "  - банан (1 шт) ≈ 105.1 ккал" in replies[0]
@@ -0,0 +1,56 @@
+import pytest
+
+from nutrition import FOODS, Food, FoodIndex, analyze_meal_locally, parse_meal_items
+
+@pytest.fixture(scope="module")
+def index() -> FoodIndex: return FoodIndex(FOODS)
+
+@pytest.mark.parametrize("query, expected", [
+    ("гречка", "Гречка отварная"), ("гречневой каши", "Гречка отварная"), ("гречкаа", "Гречка отварная"),
+    ("куринная грудка", "Куриная грудка отварная"), ("йогурт греческий", "Йогурт натуральный"),
+    ("кофе с молоком", "Капучино"), ("овсянка на молоке", "Овсянка на молоке"), ("бананы", "Банан"),
+])
+def test_lookup_finds_known_foods(index, query, expected):
+    assert index.lookup(query).name == expected
+
+@pytest.mark.parametrize("query", [
+    "чай с сахаром", "шоколадный торт", "куриная грудка с рисом", "салат с курицей", "свиная котлета", "кофе с сахаром",
+    "пиво светлое", "торт", "с", "",
+])
+def test_lookup_rejects_partial_matches(index, query):
+    assert index.lookup(query) is None
+
+def test_lookup_on_large_index_uses_token_coverage():
+    foods = [Food(f"Продукт {i}", (f"продукт{i} особый",), 100, 1, 1, 1, None, 100) for i in range(5000)]
+    index = FoodIndex([*FOODS, *foods])
+    assert index.lookup("продукт123 особый").name == "Продукт 123"
+    assert index.lookup("продукт123 особый с сыром") is None
+    assert not any(" " in gram for gram in index._postings) # без граничных "  п", общих почти для всех ключей
+
+def test_parse_meal_items_amounts():
+    items = parse_meal_items("Гречка 150г, 2 яйца; кофе 200 мл + банан 1, полкило творога")
+    assert [(i.name, i.amount, i.unit) for i in items] == [
+        ("гречка", 150, "г"), ("яйца", 2, "шт"), ("кофе", 200, "мл"), ("банан", 1, "шт"), ("полкило творога", None, None)]
+
+def test_parse_meal_items_keeps_with_phrase_together():
+    assert [i.raw for i in parse_meal_items("банан и яблоко, кофе с сахаром и молоком")] == ["банан", "яблоко", "кофе с сахаром и молоком"]
+
+@pytest.mark.parametrize("description, local, unknown", [
+    ("чай с сахаром", [], ["чай с сахаром"]),
+    ("шоколадный торт", [], ["шоколадный торт"]),
+    ("куриная грудка с рисом 200г", [], ["куриная грудка с рисом 200г"]),
+    ("салат с курицей", [], ["салат с курицей"]),
+    ("свиная котлета", [], ["свиная котлета"]),
+    ("кофе с сахаром и молоком", [], ["кофе с сахаром и молоком"]),
+    ("гречка 150г, 2 яйца, свиная котлета", ["Гречка отварная", "Яйцо куриное"], ["свиная котлета"]),
+])
+def test_analyze_meal_locally_sends_uncertain_items_to_ai(index, description, local, unknown):
+    resolved, unresolved = analyze_meal_locally(description, index)
+    assert [item["name"] for item in resolved] == local
+    assert unresolved == unknown
+
+def test_analyze_meal_locally_scales_by_amount(index):
+    (rice, eggs), unknown = analyze_meal_locally("рис 150 г, 2 яйца", index)
+    assert unknown == []
+    assert (rice["quantity"], rice["calories"]) == ("150 г", 195)
+    assert (eggs["quantity"], eggs["calories"]) == ("2 шт (≈110 г)", 170)
@@ -0,0 +1,112 @@
+"""SQLitePersistence: пропуск неизмененных пользователей, повтор упавшей записи, ленивая загрузка и закрытие дней."""
+import asyncio
+import sqlite3
+from datetime import date, timedelta
+
+import pytest
+
+import fitness_bot as fb
+from nutrition import MealLog, MealRecord
+
+def meal(name: str, kcal: float, at: float = 1714550000.0) -> MealRecord:
+    return MealRecord.from_estimate(name, f"{name} описание", {"items": [{"name": name, "quantity": "100 г", "calories": kcal, "protein": 1, "fat": 2, "carbs": 3}],
+                                                             "total": {"calories": kcal, "protein": 1, "fat": 2, "carbs": 3}}, at)
+
+def profile(**extra) -> dict:
+    return {fb.AGE: 30, fb.HEIGHT: 180, fb.CURRENT_WEIGHT: 80.5, fb.PROFILE_COMPLETE: True, fb.LAST_MEAL_DATE: date.today().isoformat(), fb.TODAY_MEALS: MealLog(), **extra}
+
+@pytest.fixture
+def db_path(tmp_path) -> str: return str(tmp_path / "bot.db")
+
+async def read(db_path: str, user_id: int) -> dict:
+    data = {}; await fb.SQLitePersistence(db_path).refresh_user_data(user_id, data)
+    return data
+
+def load(db_path: str, user_id: int) -> dict: return asyncio.run(read(db_path, user_id))
+
+def test_unchanged_user_is_not_written_again(db_path):
+    async def scenario():
+        persistence = fb.SQLitePersistence(db_path)
+        data = profile()
+        await persistence.update_user_data(1, data); await persistence.wait_written()
+        await persistence.update_user_data(1, data); await persistence.update_user_data(1, profile())
+        assert not persistence._pending_users
+        data[fb.AGE] = 31; await persistence.update_user_data(1, data); await persistence.wait_written()
+        return persistence.flush_stats
+    assert asyncio.run(scenario()) == {"flushes": 2, "users_written": 2, "users_skipped": 2}
+    assert load(db_path, 1)[fb.AGE] == 31
+
+def test_refresh_loads_user_once_and_keeps_newer_memory(db_path):
+    async def scenario():
+        writer, reader = fb.SQLitePersistence(db_path), fb.SQLitePersistence(db_path)
+        await writer.update_user_data(1, profile()); await writer.wait_written()
+        user_data = {fb.AGE: 35} # Уже изменено в памяти до первого чтения
+        await reader.refresh_user_data(1, user_data)
+        first = dict(user_data)
+        await writer.update_user_data(1, profile(**{fb.HEIGHT: 190})); await writer.wait_written()
+        await reader.refresh_user_data(1, user_data) # Без shared база читается только при первом обращении
+        return first, user_data
+    first, again = asyncio.run(scenario())
+    assert (first[fb.AGE], first[fb.HEIGHT]) == (35, 180) and again[fb.HEIGHT] == 180
+
+def test_meal_log_round_trip(db_path):
+    meals = MealLog([meal("Завтрак", 350.5), meal("Обед", 640)])
+    async def scenario():
+        persistence = fb.SQLitePersistence(db_path)
+        await persistence.update_user_data(1, profile(**{fb.TODAY_MEALS: meals, "note": "extra"})); await persistence.wait_written()
+    asyncio.run(scenario())
+    loaded = load(db_path, 1)
+    assert isinstance(loaded[fb.TODAY_MEALS], MealLog) and loaded["note"] == "extra" and loaded[fb.PROFILE_COMPLETE] is True
+    assert [(m.meal_name, m.description, m.timestamp, m.items_as_dicts()) for m in loaded[fb.TODAY_MEALS]] == [(m.meal_name, m.description, m.timestamp, m.items_as_dicts()) for m in meals]
+    assert list(loaded[fb.TODAY_MEALS].totals) == list(meals.totals)
+
+@pytest.mark.parametrize("failed, newer, expected", [
+    (("P1", "M1"), None, ("P1", "M1")),
+    (("P1", "M1"), (None, "M2"), ("P1", "M2")), # Новая частичная запись дополняется профилем из незаписанной пачки
+    (("P1", "M1"), ("P2", None), ("P2", "M1")),
+    (("P1", "M1"), (None, None), (None, None)), # Удаление новее - записывать старое нельзя
+    ((None, None), ("P2", "M2"), ("P2", "M2")),
+])
+def test_requeue_merges_failed_batch_with_newer_writes(db_path, failed, newer, expected):
+    persistence = fb.SQLitePersistence(db_path)
+    persistence._written[1] = (1, 2)
+    if newer is not None: persistence._pending_users[1] = newer
+    persistence._requeue({1: failed}, {("add_meal", "[1, 1]"): 2})
+    assert persistence._pending_users[1] == expected
+    assert 1 not in persistence._written and persistence._pending_conversations == {("add_meal", "[1, 1]"): 2}
+
+def test_failed_write_is_retried_with_newer_data(db_path, monkeypatch):
+    monkeypatch.setattr(fb, "PERSISTENCE_WRITE_RETRIES", 3)
+    async def scenario():
+        persistence = fb.SQLitePersistence(db_path, update_interval=0.01)
+        write_batch, attempts = persistence._write_batch, []
+        def flaky(users, conversations):
+            attempts.append(dict(users))
+            if len(attempts) == 1: raise sqlite3.OperationalError("database is locked")
+            write_batch(users, conversations)
+        persistence._write_batch = flaky
+        data = profile()
+        await persistence.update_user_data(1, data)
+        while not attempts or 1 not in persistence._pending_users: await asyncio.sleep(0.001) # Первая попытка упала, пачка вернулась в очередь и ждет повтора
+        data[fb.TODAY_MEALS].append(meal("Обед", 500)); await persistence.update_user_data(1, data)
+        await persistence.wait_written()
+        return len(attempts)
+    assert asyncio.run(scenario()) == 2
+    loaded = load(db_path, 1)
+    assert loaded[fb.AGE] == 30 and [m.meal_name for m in loaded[fb.TODAY_MEALS]] == ["Обед"]
+
+def test_finalize_stale_days_skips_leased_users(db_path):
+    yesterday = (date.today() - timedelta(days=1)).isoformat()
+    async def scenario():
+        persistence = fb.SQLitePersistence(db_path, shared=True)
+        for user_id in (1, 2): await persistence.update_user_data(user_id, profile(**{fb.LAST_MEAL_DATE: yesterday, fb.TODAY_MEALS: MealLog([meal("Ужин", 700)])}))
+        await persistence.wait_written()
+        await persistence.acquire_user_lease(2) # Пользователя 2 сейчас обрабатывает воркер
+        first = await persistence.finalize_stale_days(10)
+        user1, user2 = await read(db_path, 1), await read(db_path, 2)
+        await persistence.release_user_lease(2)
+        return first, user1, user2, await persistence.finalize_stale_days(10)
+    first, user1, user2, second = asyncio.run(scenario())
+    assert (first, second) == (1, 1)
+    assert (user1[fb.LAST_MEAL_DATE], len(user1[fb.TODAY_MEALS])) == (date.today().isoformat(), 0)
+    assert (user2[fb.LAST_MEAL_DATE], len(user2[fb.TODAY_MEALS])) == (yesterday, 1)
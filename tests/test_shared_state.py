@@ -0,0 +1,98 @@
+import asyncio
+import itertools
+import time
+from datetime import datetime
+from types import SimpleNamespace
+
+import pytest
+from telegram import Chat, Message, Update, User
+from telegram.ext import CommandHandler
+from telegram.ext._utils.trackingdict import TrackingDict
+
+import fitness_bot as fb
+
+_db_names = itertools.count()
+
+@pytest.fixture
+def db_uri():
+    """Общая база в памяти: соединения двух "воркеров" видят одни и те же таблицы, пока открыто хотя бы одно."""
+    return f"file:shared-{next(_db_names)}?mode=memory&cache=shared"
+
+def worker(db_uri: str, name: str) -> fb.SQLitePersistence:
+    persistence = fb.SQLitePersistence(db_uri, shared=True); persistence.owner = name
+    return persistence
+
+def test_job_lease_has_one_owner_until_it_expires(db_uri):
+    async def scenario():
+        a, b = worker(db_uri, "a"), worker(db_uri, "b")
+        first = [await a.acquire_job_lease("rollover_days", 60), await b.acquire_job_lease("rollover_days", 60), await a.acquire_job_lease("rollover_days", 60)]
+        with a._conn: a._conn.execute("UPDATE job_leases SET expires_at = ?", (time.time() - 1,)) # Воркер a упал и не продлил аренду
+        return first, await b.acquire_job_lease("rollover_days", 60), await a.acquire_job_lease("rollover_days", 60)
+    assert asyncio.run(scenario()) == ([True, False, True], True, False)
+
+def test_singleton_job_runs_only_on_lease_owner(db_uri):
+    async def scenario():
+        runs = []
+        async def job(context): runs.append(context.application.persistence.owner)
+        wrapped, workers = fb.singleton_job(job, 60), {name: worker(db_uri, name) for name in "ab"}
+        for name in "aba":
+            await wrapped(SimpleNamespace(application=SimpleNamespace(persistence=workers[name]), job=SimpleNamespace(name="warm_workout_pool_3")))
+        return runs
+    assert asyncio.run(scenario()) == ["a", "a"]
+
+def test_shared_persistence_reloads_user_changed_by_other_worker(db_uri):
+    async def scenario():
+        a, b = worker(db_uri, "a"), worker(db_uri, "b")
+        ua, ub = {}, {}
+        await a.refresh_user_data(1, ua); ua[fb.AGE] = 30; await a.update_user_data(1, dict(ua)); await a.wait_written()
+        await b.refresh_user_data(1, ub); seen_by_b = ub.get(fb.AGE)
+        ub[fb.AGE] = 31; await b.update_user_data(1, dict(ub)); await b.wait_written()
+        await a.refresh_user_data(1, ua); reloaded = ua.get(fb.AGE)
+        ua["local_only"] = True; await a.refresh_user_data(1, ua) # Версия не менялась - данные в памяти не перечитываются
+        return seen_by_b, reloaded, ua.get("local_only"), a._versions[1] == b._versions[1]
+    assert asyncio.run(scenario()) == (30, 31, True, True)
+
+def test_user_lease_blocks_other_worker_until_released(db_uri):
+    async def scenario():
+        a, b = worker(db_uri, "a"), worker(db_uri, "b")
+        await a.acquire_user_lease(1)
+        try: await asyncio.wait_for(b.acquire_user_lease(1), 0.2); blocked = False
+        except asyncio.TimeoutError: blocked = True
+        await b.release_user_lease(1) # Чужую аренду снять нельзя
+        still_held = not await asyncio.to_thread(b._run, b._try_lease, 1)
+        await a.release_user_lease(1); await asyncio.wait_for(b.acquire_user_lease(1), 1)
+        return blocked, still_held
+    assert asyncio.run(scenario()) == (True, True)
+
+def make_handler() -> fb.SharedConversationHandler:
+    handler = fb.SharedConversationHandler(entry_points=[CommandHandler("addmeal", lambda update, context: None)], states={}, fallbacks=[], name="add_meal", persistent=True)
+    handler._conversations = TrackingDict() # Так после загрузки из хранилища
+    return handler
+
+def test_sync_state_replaces_state_without_marking_it_for_write():
+    handler = make_handler()
+    handler.sync_state((1, 1), 3)
+    assert (handler.current_state((1, 1)), handler._conversations.pop_accessed_keys()) == (3, set())
+    handler.sync_state((1, 1), None)
+    assert (handler.current_state((1, 1)), handler._conversations.pop_accessed_keys()) == (None, set())
+
+def test_process_shared_syncs_state_and_writes_user_before_releasing_lease(db_uri):
+    async def scenario():
+        a, b = worker(db_uri, "a"), worker(db_uri, "b")
+        await b.update_conversation("add_meal", (1, 1), 2); await b.wait_written() # Предыдущий шаг диалога обработал воркер b
+        handler, user_data, seen = make_handler(), {1: {}}, {}
+        processor = fb.PerUserUpdateProcessor(4, a); processor.application = SimpleNamespace(handlers={0: [handler]}, user_data=user_data)
+        release = a.release_user_lease
+        async def release_checked(user_id):
+            _, stored = b._load_user(user_id)
+            seen["at_release"] = (stored.get(fb.AGE), (await b.read_conversation_states([("add_meal", (1, 1))])).get(("add_meal", (1, 1))))
+            await release(user_id)
+        a.release_user_lease = release_checked
+        async def step():
+            seen["state_before"] = handler.current_state((1, 1))
+            user_data[1][fb.AGE] = 30; handler._conversations[(1, 1)] = 3
+        await processor.process_update(Update(1, message=Message(1, datetime.now(), Chat(1, "private"), from_user=User(1, "u", False), text="гречка")), step())
+        return seen, await asyncio.to_thread(b._try_lease, 1)
+    seen, lease_free = asyncio.run(scenario())
+    assert seen == {"state_before": 2, "at_release": (30, 3)}
+    assert lease_free
@@ -0,0 +1,120 @@
+"""Стриминг /train: повторы до первого чанка, Markdown-безопасные куски и темп правок сообщения."""
+import asyncio
+import json
+import time
+from datetime import timedelta
+
+import httpx
+import pytest
+from telegram.error import RetryAfter
+
+import fitness_bot as fb
+
+MODEL = "stream-model"
+
+def sse(*deltas: str) -> list[bytes]:
+    events = [b"data: " + json.dumps({"choices": [{"delta": {"content": d}}]}, ensure_ascii=False).encode() + b"\n\n" for d in deltas]
+    return events + [b"data: [DONE]\n\n"]
+
+def body(chunks: list[bytes], delay: float = 0.0, fail: Exception | None = None):
+    async def stream():
+        await asyncio.sleep(delay)
+        if fail is not None: raise fail
+        for chunk in chunks: yield chunk
+    return stream()
+
+@pytest.fixture
+def upstream(monkeypatch):
+    """Ответы Groq по очереди: исключение - сбой соединения, иначе поток байтов ответа 200."""
+    responses, calls = [], []
+    async def handler(request: httpx.Request) -> httpx.Response:
+        calls.append(request)
+        response = responses.pop(0)
+        if isinstance(response, Exception): raise response
+        return httpx.Response(200, headers={"content-type": "text/event-stream"}, content=response)
+    for name, value in {"_groq_client": httpx.AsyncClient(transport=httpx.MockTransport(handler)), "GROQ_RATE_LIMITS": fb.GroqRateLimits(6000, 10_000_000),
+                        "GROQ_API_KEY": "test", "GROQ_MAX_RETRIES": 2, "GROQ_BACKOFF_BASE": 0.01, "GROQ_CALL_DEADLINE": 5.0}.items():
+        monkeypatch.setattr(fb, name, value)
+    return responses, calls
+
+def collect() -> str:
+    async def run(): return "".join([delta async for delta in fb._ask_groq_stream_model("план", MODEL, "test")])
+    return asyncio.run(run())
+
+@pytest.mark.parametrize("failure", [
+    httpx.ConnectError("connection refused"),
+    body([], fail=httpx.RemoteProtocolError("peer closed connection without sending complete message body")),
+])
+def test_stream_retries_transient_errors_before_first_chunk(upstream, failure):
+    responses, calls = upstream
+    responses += [failure, body(sse("Присед ", "3x10"))]
+    assert collect() == "Присед 3x10"
+    assert len(calls) == 2
+
+def test_stream_does_not_retry_after_first_chunk(upstream):
+    responses, calls = upstream
+    async def broken():
+        yield sse("Присед ")[0]
+        raise httpx.RemoteProtocolError("peer closed connection")
+    responses += [broken(), body(sse("лишний повтор"))]
+    with pytest.raises(fb.GroqStreamError) as error: collect()
+    assert (error.value.outcome, len(calls)) == ("network_error", 1)
+
+def test_stream_first_chunk_is_bounded_by_deadline(upstream, monkeypatch):
+    responses, calls = upstream
+    monkeypatch.setattr(fb, "GROQ_CALL_DEADLINE", 0.2)
+    responses.append(body(sse("поздно"), delay=5))
+    started = time.monotonic()
+    with pytest.raises(fb.GroqStreamError) as error: collect()
+    assert error.value.outcome == "timeout" and time.monotonic() - started < 1
+
+@pytest.mark.parametrize("text, expected", [
+    ("*Разминка*: бег", "*Разминка*: бег"),
+    ("*Разминка", "*Разминка*"),
+    ("Присед *3x10", "Присед *3x10*"),
+    ("Жим лежа *", "Жим лежа"),
+    ("См. [видео](http://exa", "См."),
+    ("```\nкод * _", "```\nкод * _```"),
+    ("_план_ и `код", "_план_ и `код`"),
+])
+def test_close_open_markdown(text, expected):
+    assert fb.close_open_markdown(text) == expected
+
+def test_split_for_telegram_prefers_paragraphs():
+    text = "а" * 30 + "\n\n" + "б" * 30 + " " + "в" * 30
+    assert fb.split_for_telegram(text, 50) == ("а" * 30, "б" * 30 + " " + "в" * 30)
+    assert fb.split_for_telegram("короткий", 50) == ("короткий", "")
+    assert fb.split_for_telegram("х" * 120, 50) == ("х" * 50, "х" * 70)
+
+class FakeMessage:
+    def __init__(self, chat: "FakeChat"): self.chat = chat
+    async def edit_text(self, text, parse_mode=None): await self.chat.record("edit", text)
+
+class FakeChat:
+    def __init__(self, failures=()):
+        self.sent, self.failures = [], list(failures)
+    async def record(self, kind, text):
+        if self.failures and (failure := self.failures.pop(0)) is not None: raise failure
+        self.sent.append((kind, text))
+    async def reply_text(self, text, parse_mode=None):
+        await self.record("send", text); return FakeMessage(self)
+
+def test_streaming_reply_throttles_edits():
+    async def run():
+        chat = FakeChat(); reply = fb.StreamingReply(chat, edit_interval=60)
+        for delta in ("*Разминка", "* 5 минут", ", затем присед"): await reply.append(delta)
+        await reply.finish()
+        return chat.sent, reply.edits
+    sent, edits = asyncio.run(run())
+    assert sent == [("send", "*Разминка*"), ("edit", "*Разминка* 5 минут, затем присед")] and edits == 2
+
+def test_streaming_reply_waits_out_retry_after_on_final_edit():
+    async def run():
+        flood = RetryAfter(timedelta(milliseconds=20))
+        chat = FakeChat([None, flood, flood]); reply = fb.StreamingReply(chat, edit_interval=0)
+        await reply.append("Присед")
+        await reply.append(" 3x10") # RetryAfter на промежуточной правке - она пропускается, стрим не ждет
+        started = time.monotonic(); await reply.finish() # Итоговая правка ждет Retry-After и повторяется
+        return chat.sent, time.monotonic() - started
+    sent, waited = asyncio.run(run())
+    assert sent == [("send", "Присед"), ("edit", "Присед 3x10")] and waited >= 0.02
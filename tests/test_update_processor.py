@@ -0,0 +1,38 @@
+import asyncio
+from datetime import datetime
+
+from telegram import Chat, Message, Update, User
+
+import fitness_bot as fb
+
+def make_update(update_id: int, user_id: int) -> Update:
+    return Update(update_id, message=Message(update_id, datetime.now(), Chat(user_id, "private"), from_user=User(user_id, "u", False), text="/start"))
+
+def test_user_updates_are_ordered_and_waiters_do_not_hold_slots():
+    async def scenario():
+        processor, release, log = fb.PerUserUpdateProcessor(2), asyncio.Event(), []
+        async def handle(name, block=False):
+            log.append(f"{name}:start")
+            if block: await release.wait()
+            log.append(f"{name}:end")
+        tasks = [asyncio.create_task(processor.process_update(make_update(1, 1), handle("a1", block=True))),
+                 asyncio.create_task(processor.process_update(make_update(2, 1), handle("a2"))),
+                 asyncio.create_task(processor.process_update(make_update(3, 2), handle("b1"))),
+                 asyncio.create_task(processor.process_update(make_update(4, 2), handle("b2")))]
+        await asyncio.sleep(0.05)
+        blocked = (list(log), processor.current_concurrent_updates) # a2 ждет a1, но слот занимает только a1 - b проходит
+        release.set(); await asyncio.gather(*tasks)
+        return blocked, log, processor.current_concurrent_updates, processor._locks
+    (during, in_flight), log, after, locks = asyncio.run(scenario())
+    assert during == ["a1:start", "b1:start", "b1:end", "b2:start", "b2:end"]
+    assert in_flight == 2
+    assert log[5:] == ["a1:end", "a2:start", "a2:end"]
+    assert (after, locks) == (0, {})
+
+def test_updates_without_user_use_a_slot():
+    async def scenario():
+        processor, ran = fb.PerUserUpdateProcessor(1), []
+        async def handle(): ran.append(True)
+        await processor.process_update(object(), handle())
+        return ran, processor.current_concurrent_updates
+    assert asyncio.run(scenario()) == ([True], 0)
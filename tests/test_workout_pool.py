@@ -0,0 +1,66 @@
+"""Пул тренировок: корзины по профилю, ротация вариантов через TRAIN_PLAN_CURSOR и свежесть кэша между воркерами."""
+import asyncio
+from types import SimpleNamespace
+
+import pytest
+
+import fitness_bot as fb
+
+def user(age=30, bmi=22.0, **extra) -> dict:
+    return {fb.GENDER: "мужской", fb.AGE: age, fb.BMI: bmi, fb.ACTIVITY_LEVEL: "moderate", fb.GOAL: "lose", fb.PROFILE_COMPLETE: True, **extra}
+
+@pytest.mark.parametrize("age, bmi, bands", [
+    (17, 18.4, ("до 18", "до 18.5")),
+    (18, 18.5, ("18-29", "18.5-24.9")),
+    (29.9, 24.9, ("18-29", "18.5-24.9")),
+    (30, 25, ("30-44", "25-29.9")),
+    (59, 29.9, ("45-59", "25-29.9")),
+    (60, 30, ("60+", "30+")),
+])
+def test_workout_bucket_bands(age, bmi, bands):
+    assert fb.workout_bucket(user(age, bmi), "train_gym") == "|".join(["мужской", *bands, "moderate", "lose", "train_gym"])
+
+def test_workout_bucket_needs_age_bmi_and_known_location():
+    assert fb.workout_bucket(user(age=None), "train_home") is None
+    assert fb.workout_bucket(user(bmi="N/A"), "train_home") is None
+    assert fb.workout_bucket(user(), "train_space") is None
+    assert fb.workout_bucket(user(31), "train_home") == fb.workout_bucket(user(44), "train_home") # Одна корзина на весь диапазон
+
+class FakeQuery:
+    def __init__(self, data: str):
+        self.data, self.replies = data, []
+        self.message = SimpleNamespace(reply_text=self.reply_text)
+    async def answer(self): pass
+    async def edit_message_text(self, text, parse_mode=None): pass
+    async def reply_text(self, text, parse_mode=None): self.replies.append(text)
+
+def train(user_data: dict, location: str = "train_home") -> list[str]:
+    query = FakeQuery(location)
+    update = SimpleNamespace(callback_query=query, effective_user=SimpleNamespace(id=1))
+    asyncio.run(fb.handle_train_location_and_generate(update, SimpleNamespace(user_data=user_data)))
+    return query.replies
+
+@pytest.fixture
+def pool(tmp_path, monkeypatch):
+    pool = fb.WorkoutPlanPool(str(tmp_path / "bot.db"), 3)
+    monkeypatch.setattr(fb, "WORKOUT_POOL", pool)
+    return pool
+
+def test_train_rotates_pool_variants_per_user(pool):
+    bucket = fb.workout_bucket(user(), "train_home")
+    for n in range(3): pool._add(bucket, f"План {n}")
+    first, second = user(), user()
+    assert [train(first)[0] for _ in range(4)] == ["План 0", "План 1", "План 2", "План 0"]
+    assert first[fb.TRAIN_PLAN_CURSOR] == {bucket: 1}
+    assert train(second) == ["План 0"] # Курсор у каждого пользователя свой
+    assert (pool.served, pool.cold) == (5, 0)
+
+def test_full_bucket_cache_sees_plan_replaced_by_other_worker(pool, tmp_path):
+    bucket = fb.workout_bucket(user(), "train_gym")
+    for n in range(3): pool._add(bucket, f"План {n}")
+    assert pool._pick(bucket, 0) == ("План 0", 3)
+    other = fb.WorkoutPlanPool(str(tmp_path / "bot.db"), 3)
+    other._add(bucket, "Новый план") # Полная корзина: другой воркер заменяет самый старый вариант
+    assert pool._pick(bucket, 0) == ("Новый план", 3)
+    other._add(fb.workout_bucket(user(), "train_street"), "Улица")
+    assert pool._pick(fb.workout_bucket(user(), "train_street"), 5) == ("Улица", 1)